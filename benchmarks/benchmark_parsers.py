@@ -0,0 +1,132 @@
+# coding=utf-8
+"""Benchmark of the OSM way parsers used by osm_object_contributions.
+
+Usage::
+
+    python benchmarks/benchmark_parsers.py [--repeat 500] [--processes 0]
+        [file.osm ...]
+
+Without files, the test fixture is used as is and as a city-scale document
+made of the fixture repeated --repeat times. The chunked parser runs with
+--processes processes, 0 for one per core.
+
+:copyright: (c) 2013 by Tim Sutton
+:license: GPLv3, see LICENSE for more details.
+"""
+import argparse
+import os
+import sys
+import time
+import xml.sax
+from tempfile import mkstemp
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# pylint: disable=C0413
+from reporter import config  # noqa
+from reporter.osm_chunks import chunked_osm_object_counts  # noqa
+from reporter.osm_scanner import scan_osm_object_counts  # noqa
+from reporter.osm_way_parser import OsmExpatParser, OsmParser  # noqa
+from reporter.test.helpers import FIXTURE_PATH  # noqa
+# pylint: enable=C0413
+
+
+def parse_sax(file_path, tag_name):
+    parser = OsmParser(tag_name=tag_name)
+    with open(file_path, 'rb') as osm_file:
+        xml.sax.parse(osm_file, parser)
+    return parser.wayCountDict, parser.nodeCountDict, parser.userDayCountDict
+
+
+def parse_expat(file_path, tag_name):
+    parser = OsmExpatParser(tag_name=tag_name)
+    with open(file_path, 'rb') as osm_file:
+        parser.parse(osm_file)
+    return parser.wayCountDict, parser.nodeCountDict, parser.userDayCountDict
+
+
+def parse_chunked(file_path, tag_name):
+    return chunked_osm_object_counts(file_path, tag_name)
+
+
+def parse_scan(file_path, tag_name):
+    return scan_osm_object_counts(file_path, tag_name)
+
+
+PARSERS = [
+    ('sax', parse_sax),
+    ('expat', parse_expat),
+    ('chunked', parse_chunked),
+    ('scan', parse_scan)]
+
+
+def repeated_document(source_path, repeat):
+    """Write a document holding the elements of source_path repeat times.
+
+    :returns: The path of the new document.
+    :rtype: str
+    """
+    with open(source_path, 'rb') as source:
+        lines = source.read().splitlines(True)
+    start = next(
+        index for index, line in enumerate(lines)
+        if line.lstrip().startswith((b'<node', b'<way', b'<relation')))
+    end = max(
+        index for index, line in enumerate(lines)
+        if line.lstrip().startswith(b'</osm'))
+    handle, file_path = mkstemp(suffix='.osm')
+    with os.fdopen(handle, 'wb') as output:
+        output.writelines(lines[:start])
+        body = b''.join(lines[start:end])
+        for _ in range(repeat):
+            output.write(body)
+        output.writelines(lines[end:])
+    return file_path
+
+
+def best_time(function, *args):
+    """Best wall time of a few runs, in seconds."""
+    timings = []
+    for _ in range(3):
+        started = time.perf_counter()
+        result = function(*args)
+        timings.append(time.perf_counter() - started)
+    return min(timings), result
+
+
+def main():
+    arguments = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    arguments.add_argument('files', nargs='*')
+    arguments.add_argument('--repeat', type=int, default=500)
+    arguments.add_argument('--tag', default='building')
+    arguments.add_argument('--processes', type=int, default=0)
+    options = arguments.parse_args()
+    config.OSM_PARSER_PROCESSES = options.processes
+
+    files = options.files
+    generated = None
+    if not files:
+        generated = repeated_document(FIXTURE_PATH, options.repeat)
+        files = [FIXTURE_PATH, generated]
+    try:
+        for file_path in files:
+            size = os.path.getsize(file_path) / 1024. / 1024.
+            print('%s (%.1f MB)' % (os.path.basename(file_path), size))
+            timings = {}
+            results = {}
+            for name, function in PARSERS:
+                timings[name], results[name] = best_time(
+                    function, file_path, options.tag)
+                print('  %-7s %8.3fs %8.1f MB/s %5.1fx' % (
+                    name,
+                    timings[name],
+                    size / timings[name],
+                    timings['sax'] / timings[name]))
+                assert results[name] == results['sax'], 'Counts differ'
+    finally:
+        if generated:
+            os.remove(generated)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,173 @@
+# coding=utf-8
+"""Comparison of the shapefiles written by the python and postgis engines.
+
+Usage::
+
+    python benchmarks/benchmark_shapefile_export.py --database scratch_db
+        [--tolerance 0.000001] [--osm file.osm] [feature ...]
+
+The shapefile of each feature (buildings, building-points and roads by
+default) is written from --osm, the test fixture by default, by
+reporter.shapefile_export in the process and, with --database, by
+osm2pgsql, the .sql file of the feature and pgsql2shp in this scratch
+database (created from template_postgis beforehand, its tables are
+replaced), as the postgis engine does.
+
+The records are compared row by row. Records are paired by their
+attributes, then by their geometry: points at most --tolerance degrees
+apart, the same number of points in the same or reverse order for lines
+and rings. The records left unpaired are printed, and the script fails if
+there are any. Without --database, only the python engine runs.
+
+:copyright: (c) 2013 by Tim Sutton
+:license: GPLv3, see LICENSE for more details.
+"""
+import argparse
+import os
+import sys
+import time
+from subprocess import call
+from tempfile import mkdtemp
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# pylint: disable=C0413
+from reporter.osm import import_osm_file  # noqa
+from reporter.queries import SQL_QUERY_MAP  # noqa
+from reporter.shapefile_export import export_shapefile  # noqa
+from reporter.test.helpers import FIXTURE_PATH, read_dbf, read_shp  # noqa
+from reporter.utilities import which  # noqa
+# pylint: enable=C0413
+
+FEATURES = ['buildings', 'building-points', 'roads']
+
+
+def export_in_process(feature, osm_path, directory):
+    """Write the shapefile of a feature with the python engine."""
+    shape_path = os.path.join(directory, 'python', '%s.shp' % feature)
+    export_shapefile(feature, osm_path, shape_path)
+    return shape_path
+
+
+def export_in_postgres(feature, osm_path, directory, database):
+    """Write the shapefile of a feature with the postgis engine."""
+    shape_directory = os.path.join(directory, 'postgis')
+    if not os.path.exists(shape_directory):
+        os.makedirs(shape_directory)
+    shape_path = os.path.join(shape_directory, '%s.shp' % feature)
+    import_osm_file(database, feature, osm_path)
+    call('%s -f %s %s %s' % (
+        which('pgsql2shp')[0], shape_path, database, SQL_QUERY_MAP[feature]),
+        shell=True)
+    return shape_path
+
+
+def read_records(shape_path):
+    """Read the records of a shapefile as (attributes, points) pairs.
+
+    The numbers are compared as numbers, pgsql2shp and the python engine
+    may pad them differently.
+    """
+    names, rows = read_dbf(shape_path.replace('.shp', '.dbf'), strict=False)
+    _, shapes = read_shp(shape_path)
+    records = []
+    for row, points in zip(rows, shapes):
+        values = []
+        for name in names:
+            value = row[name]
+            try:
+                value = float(value)
+            except ValueError:
+                pass
+            values.append(value)
+        records.append((tuple(values), points))
+    return names, records
+
+
+def same_points(points, other_points, tolerance):
+    """Check that two geometries have the same points, in either order."""
+    if len(points) != len(other_points):
+        return False
+    for candidate in (other_points, other_points[::-1]):
+        if all(
+                abs(x - other_x) <= tolerance and abs(y - other_y) <= tolerance
+                for (x, y), (other_x, other_y) in zip(points, candidate)):
+            return True
+    return False
+
+
+def pair_records(records, other_records, tolerance):
+    """Pair the records of two shapefiles.
+
+    :returns: The records of each shapefile which could not be paired.
+    :rtype: (list, list)
+    """
+    by_values = {}
+    for values, points in other_records:
+        by_values.setdefault(values, []).append(points)
+    unpaired = []
+    for values, points in records:
+        candidates = by_values.get(values, [])
+        for index, other_points in enumerate(candidates):
+            if same_points(points, other_points, tolerance):
+                del candidates[index]
+                break
+        else:
+            unpaired.append((values, points))
+    other_unpaired = [
+        (values, points)
+        for values, candidates in by_values.items()
+        for points in candidates]
+    return unpaired, other_unpaired
+
+
+def compare(python_path, postgis_path, tolerance):
+    """Print the differences between the shapefiles of both engines."""
+    names, records = read_records(python_path)
+    postgis_names, postgis_records = read_records(postgis_path)
+    if names != postgis_names:
+        print('    fields differ: python %s, postgis %s' % (
+            names, postgis_names))
+        return False
+    unpaired, postgis_unpaired = pair_records(
+        records, postgis_records, tolerance)
+    print('  %s records, %s only in python, %s only in postgis' % (
+        len(records), len(unpaired), len(postgis_unpaired)))
+    for engine, engine_records in (
+            ('python', unpaired), ('postgis', postgis_unpaired)):
+        for values, points in engine_records[:5]:
+            print('    only in %s: %s, %s points from %s' % (
+                engine, dict(zip(names, values)), len(points),
+                points[0] if points else None))
+    return not unpaired and not postgis_unpaired
+
+
+def main():
+    arguments = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    arguments.add_argument('features', nargs='*')
+    arguments.add_argument('--osm', default=FIXTURE_PATH)
+    arguments.add_argument('--database')
+    arguments.add_argument('--tolerance', type=float, default=1e-6)
+    options = arguments.parse_args()
+
+    directory = mkdtemp()
+    identical = True
+    for feature in options.features or FEATURES:
+        started = time.perf_counter()
+        python_path = export_in_process(feature, options.osm, directory)
+        python_time = time.perf_counter() - started
+        print('%s: python %8.3fs' % (feature, python_time))
+        if not options.database:
+            continue
+        started = time.perf_counter()
+        postgis_path = export_in_postgres(
+            feature, options.osm, directory, options.database)
+        postgis_time = time.perf_counter() - started
+        print('  postgis %8.3fs %5.1fx' % (
+            postgis_time, postgis_time / python_time))
+        identical &= compare(python_path, postgis_path, options.tolerance)
+    assert identical, 'Shapefiles differ'
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,157 @@
+# coding=utf-8
+"""Benchmark of the timeline statistics used by contribution_records.
+
+Usage::
+
+    python benchmarks/benchmark_timelines.py [--users 2000] [--years 8]
+        [--active 0.1]
+
+Timelines are generated for --users users, each active on a --active share
+of the days of a random part of --years years. The statistics of the
+reports are computed with:
+
+* legacy: the functions of reporter.utilities as they were before the
+  compact timelines, parsing the dates of each user several times and
+  growing the json of the timeline one day at a time,
+* per-user: the functions of reporter.utilities, one user at a time,
+* batch: timeline_statistics, for all the users at once.
+
+:copyright: (c) 2013 by Tim Sutton
+:license: GPLv3, see LICENSE for more details.
+"""
+import argparse
+import os
+import random
+import sys
+import time
+from datetime import date, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# pylint: disable=C0413
+from reporter.timeline import Timeline, timeline_statistics  # noqa
+from reporter.utilities import (  # noqa
+    average_for_active_days,
+    best_active_day,
+    date_range,
+    date_range_iterator,
+    interpolated_timeline,
+    worst_active_day)
+# pylint: enable=C0413
+
+
+def legacy_date_range(timeline):
+    start_date = None
+    end_date = None
+    for next_date in timeline.keys():
+        year, month, day = next_date.split('-')
+        timeline_date = date(int(year), int(month), int(day))
+        if start_date is None or timeline_date < start_date:
+            start_date = timeline_date
+        if end_date is None or timeline_date > end_date:
+            end_date = timeline_date
+    return start_date, end_date
+
+
+def legacy_interpolated_timeline(timeline):
+    start_date, end_date = legacy_date_range(timeline)
+    time_line = '['
+    for current_date in date_range_iterator(start_date, end_date):
+        date_string = time.strftime('%Y-%m-%d', current_date.timetuple())
+        if date_string in timeline:
+            value = timeline[date_string]
+        else:
+            value = 0
+        if time_line != '[':
+            time_line += ','
+        time_line += '["%s",%i]' % (date_string, value)
+    time_line += ']'
+    return time_line
+
+
+def legacy_statistics(timelines):
+    statistics = {}
+    for user, timeline in timelines.items():
+        start_date, end_date = legacy_date_range(timeline)
+        values = [value for value in timeline.values() if value > 0]
+        statistics[user] = {
+            'timeline': legacy_interpolated_timeline(timeline),
+            'start': start_date,
+            'end': end_date,
+            'activeDays': len(timeline),
+            'best': max(values),
+            'worst': min(values),
+            'average': int(sum(values) / len(values))}
+    return statistics
+
+
+def per_user_statistics(timelines):
+    statistics = {}
+    for user, timeline in timelines.items():
+        start_date, end_date = date_range(timeline)
+        statistics[user] = {
+            'timeline': interpolated_timeline(timeline),
+            'start': start_date,
+            'end': end_date,
+            'activeDays': len(timeline),
+            'best': best_active_day(timeline),
+            'worst': worst_active_day(timeline),
+            'average': average_for_active_days(timeline)}
+    return statistics
+
+
+def random_timelines(users, years, active):
+    """Generate the timelines of users, as dicts of counts by day."""
+    generator = random.Random(0)
+    first = date(2020 - years, 1, 1)
+    days = years * 365
+    timelines = {}
+    for user in range(users):
+        start = generator.randrange(days)
+        length = generator.randrange(1, days - start + 1)
+        timeline = {}
+        for offset in range(length):
+            if offset == 0 or generator.random() < active:
+                day = first + timedelta(start + offset)
+                timeline[day.isoformat()] = generator.randrange(1, 50)
+        timelines['user%s' % user] = timeline
+    return timelines
+
+
+def best_time(function, *args):
+    """Best wall time of a few runs, in seconds."""
+    timings = []
+    for _ in range(3):
+        started = time.perf_counter()
+        result = function(*args)
+        timings.append(time.perf_counter() - started)
+    return min(timings), result
+
+
+def main():
+    arguments = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    arguments.add_argument('--users', type=int, default=2000)
+    arguments.add_argument('--years', type=int, default=8)
+    arguments.add_argument('--active', type=float, default=0.1)
+    options = arguments.parse_args()
+
+    timelines = random_timelines(options.users, options.years, options.active)
+    compact_timelines = dict(
+        (user, Timeline(timeline)) for user, timeline in timelines.items())
+    days = sum(len(timeline) for timeline in timelines.values())
+    print('%s users, %s active days' % (len(timelines), days))
+    runs = [
+        ('legacy', legacy_statistics, timelines),
+        ('per-user', per_user_statistics, compact_timelines),
+        ('batch', timeline_statistics, compact_timelines)]
+    timings = {}
+    results = {}
+    for name, function, argument in runs:
+        timings[name], results[name] = best_time(function, argument)
+        print('  %-8s %8.3fs %5.1fx' % (
+            name, timings[name], timings['legacy'] / timings[name]))
+        assert results[name] == results['legacy'], 'Statistics differ'
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,226 @@
+# coding=utf-8
+"""Benchmark of the sql classifying the features of the shapefiles.
+
+Usage::
+
+    python benchmarks/benchmark_transforms.py [--rows 100000]
+        [--database scratch_db] [feature ...]
+
+The .sql file of a feature sets the "type" of its rows in a single UPDATE
+with a CASE. The scripts it replaced, running one UPDATE per category, are
+kept in benchmarks/legacy_transforms. Both only differ in their
+classification statements (ALTER TABLE ... ADD COLUMN and UPDATE), which
+are run on --rows generated rows: each column tested by a legacy condition
+gets NULL, '' or one of the values the conditions look for, as is, upper
+cased or inside a longer value.
+
+The rows are classified in the process by the sql interpreter of
+reporter.shapefile_export and, with --database, by Postgres in a table of
+this scratch database (created beforehand, its tables are replaced). The
+types set by the legacy and the current scripts are compared row by row.
+
+:copyright: (c) 2013 by Tim Sutton
+:license: GPLv3, see LICENSE for more details.
+"""
+import argparse
+import csv
+import io
+import os
+import random
+import sys
+import time
+from subprocess import check_output
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# pylint: disable=C0413
+from reporter.shapefile_export import (  # noqa
+    apply_transform,
+    parse_transform,
+    tokenize)
+from reporter.utilities import overpass_resource_base_path  # noqa
+# pylint: enable=C0413
+
+LEGACY_PATH = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), 'legacy_transforms')
+
+FEATURES = [
+    'buildings',
+    'building-points',
+    'roads',
+    'potential-idp',
+    'evacuation-centers']
+
+# Column set by the scripts
+TYPE_COLUMN = 'type'
+
+
+def classification_statements(sql_path):
+    """Get the statements of a script adding and setting the type column.
+
+    The other statements of potential-idp and evacuation-centers build the
+    table from the osm2pgsql tables, they are the same in both scripts.
+    """
+    with open(sql_path) as sql_file:
+        lines = [
+            line for line in sql_file
+            if not line.strip().startswith('--')]
+    statements = []
+    for statement in ''.join(lines).split(';'):
+        words = statement.lower().split()
+        if words[:1] == ['update'] or (
+                words[:1] == ['alter'] and 'add' in words):
+            statements.append(statement.strip())
+    return statements
+
+
+def tested_values(statements):
+    """Get the values each column is compared to by the conditions."""
+    tokens = tokenize(';'.join(statements))
+    values = {}
+    for index in range(1, len(tokens) - 1):
+        kind, value = tokens[index]
+        if (kind, value) not in (
+                ('word', 'ilike'), ('word', 'like'), ('word', 'is'),
+                ('symbol', '='), ('symbol', '!='), ('symbol', '<>')):
+            continue
+        if tokens[index - 2] == ('word', 'set'):
+            continue
+        column = tokens[index - 1][1]
+        if column == TYPE_COLUMN:
+            continue
+        literals = values.setdefault(column, set())
+        if tokens[index + 1][0] == 'string':
+            literals.add(tokens[index + 1][1].replace('%', ''))
+    return values
+
+
+def generate_rows(values, count):
+    """Generate rows from the values tested by the conditions."""
+    generator = random.Random(0)
+    pools = {}
+    for column, literals in values.items():
+        pool = [None, None, None, '', 'other']
+        for literal in sorted(literals):
+            pool += [literal, literal.upper(), 'new %s 2' % literal]
+        pools[column] = pool
+    return [
+        dict((column, generator.choice(pool))
+             for column, pool in sorted(pools.items()))
+        for _ in range(count)]
+
+
+def classify_in_process(statements, rows):
+    """Classify copies of the rows with the sql interpreter."""
+    steps = parse_transform(';'.join(statements))
+    table = steps[0][0]
+    rows = [dict(row) for row in rows]
+    apply_transform(rows, table, steps)
+    return [row[TYPE_COLUMN] for row in rows]
+
+
+def psql(database, *arguments, **kwargs):
+    """Run psql on the scratch database."""
+    command = ['psql', '-X', '-q', '-v', 'ON_ERROR_STOP=1', '-d', database]
+    command.extend(arguments)
+    return check_output(command, **kwargs).decode('utf-8')
+
+
+def classify_in_postgres(statements, rows, database):
+    """Classify the rows in a table of the scratch database.
+
+    :returns: The types of the rows, and the seconds taken by the
+        statements.
+    :rtype: (list, float)
+    """
+    table = parse_transform(';'.join(statements))[0][0]
+    columns = sorted(rows[0]) if rows else []
+    psql(database, '-c', 'DROP TABLE IF EXISTS %s; CREATE TABLE %s (%s)' % (
+        table, table, ', '.join(
+            ['id integer'] + ['"%s" text' % column for column in columns])))
+    data = io.StringIO()
+    writer = csv.writer(data)
+    for index, row in enumerate(rows):
+        writer.writerow([index] + [
+            '\\N' if row[column] is None else row[column]
+            for column in columns])
+    psql(database, '-c', "\\copy %s FROM STDIN WITH CSV NULL '\\N'" % table,
+         input=data.getvalue().encode('utf-8'))
+
+    started = time.perf_counter()
+    psql(database, '-c', ';'.join(statements))
+    elapsed = time.perf_counter() - started
+
+    output = psql(
+        database, '-A', '-t', '-F', '\t', '-P', 'null=\\N', '-c',
+        'SELECT "%s" FROM %s ORDER BY id' % (TYPE_COLUMN, table))
+    types = [
+        None if line == '\\N' else line
+        for line in output.split('\n')[:len(rows)]]
+    return types, elapsed
+
+
+def compare(name, legacy_types, types, rows):
+    """Print the rows classified differently, if any."""
+    differences = [
+        index for index, (legacy_type, new_type)
+        in enumerate(zip(legacy_types, types)) if legacy_type != new_type]
+    if len(legacy_types) != len(types):
+        differences.append(min(len(legacy_types), len(types)))
+    for index in differences[:5]:
+        print('    %s differs: %r, legacy %r, now %r' % (
+            name, rows[index] if index < len(rows) else None,
+            legacy_types[index] if index < len(legacy_types) else None,
+            types[index] if index < len(types) else None))
+    return not differences
+
+
+def best_time(function, *args):
+    """Best wall time of a few runs, in seconds."""
+    timings = []
+    for _ in range(3):
+        started = time.perf_counter()
+        result = function(*args)
+        timings.append(time.perf_counter() - started)
+    return min(timings), result
+
+
+def main():
+    arguments = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    arguments.add_argument('features', nargs='*')
+    arguments.add_argument('--rows', type=int, default=100000)
+    arguments.add_argument('--database')
+    options = arguments.parse_args()
+
+    identical = True
+    for feature in options.features or FEATURES:
+        legacy = classification_statements(
+            os.path.join(LEGACY_PATH, '%s.sql' % feature))
+        current = classification_statements(
+            '%s.sql' % overpass_resource_base_path(feature))
+        rows = generate_rows(tested_values(legacy), options.rows)
+        print('%s: %s rows, %s statements, now %s' % (
+            feature, len(rows), len(legacy), len(current)))
+
+        legacy_time, legacy_types = best_time(
+            classify_in_process, legacy, rows)
+        current_time, types = best_time(classify_in_process, current, rows)
+        print('  %-10s legacy %8.3fs now %8.3fs %5.1fx' % (
+            'in process', legacy_time, current_time,
+            legacy_time / current_time))
+        identical &= compare('in process', legacy_types, types, rows)
+
+        if options.database:
+            legacy_types, legacy_time = classify_in_postgres(
+                legacy, rows, options.database)
+            types, current_time = classify_in_postgres(
+                current, rows, options.database)
+            print('  %-10s legacy %8.3fs now %8.3fs %5.1fx' % (
+                'postgres', legacy_time, current_time,
+                legacy_time / current_time))
+            identical &= compare('postgres', legacy_types, types, rows)
+    assert identical, 'Types differ'
+
+
+if __name__ == '__main__':
+    main()
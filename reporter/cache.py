@@ -0,0 +1,727 @@
+# coding=utf-8
+"""Helpers for managing the cache of downloaded OSM documents.
+:copyright: (c) 2013 by Tim Sutton
+:license: GPLv3, see LICENSE for more details.
+"""
+import os
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from datetime import date
+from shutil import rmtree
+from tempfile import mkstemp
+
+from reporter import config
+from reporter import LOGGER
+from reporter.utilities import (
+    CONTRIBUTIONS_INDEX_SUFFIX,
+    CONTRIBUTIONS_SNAPSHOT_SUFFIX,
+    bbox_contains,
+    work_dir_root)
+
+try:
+    # pylint: disable=F0401
+    import fcntl
+    # pylint: enable=F0401
+except ImportError:
+    # Not available on Windows, we only coalesce within the process there.
+    fcntl = None
+
+# Cache entry path -> [threading.Lock, number of threads using it]
+_LOCKS = {}
+_LOCKS_GUARD = threading.Lock()
+
+# The manager for config.CACHE_DIR, created on first use.
+_OSM_CACHE = None
+_OSM_CACHE_GUARD = threading.Lock()
+
+# Ending of the zipped shapefiles kept in config.CACHE_DIR, and their
+# manager, created on first use.
+EXPORT_SUFFIX = '.shp.zip'
+_EXPORT_CACHE = None
+
+# Suffix of the file holding the max age of an entry recorded with another
+# max age than its default, which its hashed name does not tell after a
+# restart, see CacheManager.record.
+MAX_AGE_SUFFIX = '.max-age'
+
+
+class CacheManager(object):
+    """Index of the files in a cache directory with bounded eviction.
+
+    The index lives in memory and is kept up to date by the request path
+    with a single stat per call (see record). The directory itself is only
+    listed by sweep, which normally runs in a background thread, so the
+    cost of a request does not grow with the number of cached files.
+
+    Entries older than their maximum age (plus stale_age, while expired
+    files may still be served) are removed, then least recently used
+    entries are removed until the cache is within max_bytes and
+    max_entries.
+
+    Files derived from an entry, named after it with one of the companion
+    suffixes, are removed with it. So is the file holding the max age of an
+    entry recorded with a max age other than its default, read back by
+    refresh when the entry is not indexed yet, e.g. after a restart.
+
+    One of the managers of a directory also removes the partial downloads
+    and the working directories left over, see sweep_leftovers.
+    """
+
+    def __init__(
+            self,
+            cache_dir,
+            max_age=3600,
+            stale_age=0,
+            max_bytes=0,
+            max_entries=0,
+            extensions=('.osm', '.osm.gz'),
+            companions=(),
+            max_ages=None,
+            sweep_leftovers=False):
+        """Constructor.
+
+        :param cache_dir: The directory holding the cached files.
+        :type cache_dir: str
+
+        :param max_age: Default age in seconds after which an entry expires.
+        :type max_age: int
+
+        :param stale_age: Seconds during which an expired entry is kept.
+        :type stale_age: int
+
+        :param max_bytes: Maximum total size of the entries, 0 for no limit.
+        :type max_bytes: int
+
+        :param max_entries: Maximum number of entries, 0 for no limit.
+        :type max_entries: int
+
+        :param extensions: File name endings of the files to manage.
+        :type extensions: tuple
+
+        :param companions: Suffixes added to the name of an entry by the
+            files derived from it.
+        :type companions: tuple
+
+        :param max_ages: Default max age of the entries by file name ending,
+            for the endings whose max age is not max_age.
+        :type max_ages: dict
+
+        :param sweep_leftovers: Whether to remove the partial files in the
+            cache directory and the working directories of temp_dir older
+            than max_age.
+        :type sweep_leftovers: bool
+        """
+        self.cache_dir = os.path.abspath(cache_dir)
+        self.max_age = max_age
+        self.stale_age = stale_age
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        self.extensions = tuple(extensions)
+        self.companions = tuple(companions) + (MAX_AGE_SUFFIX,)
+        self.max_ages = dict(max_ages or {})
+        self.sweep_leftovers = sweep_leftovers
+        # path -> (size, mtime, max_age), least recently used first
+        self._entries = OrderedDict()
+        self._total_bytes = 0
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._sweeper = None
+
+    def __len__(self):
+        return len(self._entries)
+
+    @property
+    def total_bytes(self):
+        """Total size of the indexed entries.
+
+        :rtype: int
+        """
+        return self._total_bytes
+
+    def record(self, file_path, max_age=None):
+        """Note that a cache entry has just been written or read.
+
+        :param file_path: Path of the entry. Paths outside the cache
+            directory are ignored.
+        :type file_path: str
+
+        :param max_age: Age in seconds after which this entry expires,
+            defaults to the max_age of the manager for its file name ending.
+            Another max age is stored next to the entry.
+        :type max_age: int
+        """
+        if max_age is None:
+            max_age = self._default_max_age(file_path)
+        file_path = os.path.abspath(file_path)
+        if os.path.dirname(file_path) != self.cache_dir:
+            return
+        try:
+            stat = os.stat(file_path)
+        except OSError:
+            self.forget(file_path)
+            return
+        with self._lock:
+            previous = self._pop(file_path)
+            self._entries[file_path] = (
+                stat.st_size, stat.st_mtime, max_age)
+            self._total_bytes += stat.st_size
+            over_limits = self._over_limits()
+        if previous is None or previous[2] != max_age:
+            self._store_max_age(file_path, max_age)
+        if over_limits:
+            # Evict from the sweeper thread, not from the request.
+            self._wake.set()
+
+    def forget(self, file_path):
+        """Drop an entry from the index without touching the disk.
+
+        :param file_path: Path of the entry.
+        :type file_path: str
+        """
+        with self._lock:
+            self._pop(os.path.abspath(file_path))
+
+    def remove(self, file_path):
+        """Remove an entry from the index and from the disk.
+
+        :param file_path: Path of the entry.
+        :type file_path: str
+        """
+        self.forget(file_path)
+        for suffix in ('',) + self.companions:
+            try:
+                os.remove(file_path + suffix)
+            except OSError:
+                # Already removed, maybe by another process.
+                pass
+
+    def refresh(self):
+        """Synchronise the index with the content of the cache directory.
+
+        Files we did not know about are treated as the least recently used.
+        """
+        try:
+            names = os.listdir(self.cache_dir)
+        except OSError:
+            return
+        on_disk = set()
+        for name in names:
+            if not name.endswith(self.extensions):
+                continue
+            file_path = os.path.join(self.cache_dir, name)
+            on_disk.add(file_path)
+            if file_path in self._entries:
+                continue
+            try:
+                stat = os.stat(file_path)
+            except OSError:
+                continue
+            max_age = self._stored_max_age(file_path)
+            with self._lock:
+                if file_path not in self._entries:
+                    self._entries[file_path] = (
+                        stat.st_size, stat.st_mtime, max_age)
+                    self._entries.move_to_end(file_path, last=False)
+                    self._total_bytes += stat.st_size
+        with self._lock:
+            for file_path in list(self._entries.keys()):
+                if file_path not in on_disk:
+                    self._pop(file_path)
+
+    def sweep(self):
+        """Remove expired entries, then evict until within the limits.
+
+        Companion files of removed entries are removed too, and with
+        sweep_leftovers the left over partial downloads and working
+        directories.
+        """
+        self.refresh()
+        now = time.time()
+        with self._lock:
+            expired = [
+                file_path
+                for file_path, (_, mtime, max_age) in self._entries.items()
+                if now - mtime > max_age + self.stale_age]
+            expired_set = set(expired)
+            evicted = []
+            count = len(self._entries) - len(expired)
+            total = self._total_bytes - sum(
+                self._entries[file_path][0] for file_path in expired)
+            for file_path, (size, _, _) in self._entries.items():
+                if not self._over_limits(total, count):
+                    break
+                if file_path in expired_set:
+                    continue
+                evicted.append(file_path)
+                total -= size
+                count -= 1
+        for file_path in expired + evicted:
+            LOGGER.debug('Removing %s from the cache', file_path)
+            self.remove(file_path)
+        self._remove_orphans()
+        if self.sweep_leftovers:
+            self._remove_stale_leftovers(now)
+
+    def start(self, interval):
+        """Start the background sweeper thread if it is not running yet.
+
+        :param interval: Seconds between two sweeps.
+        :type interval: int
+        """
+        with self._lock:
+            if self._sweeper is not None:
+                return
+            self._sweeper = threading.Thread(
+                target=self._run, args=(interval,), name='cache-sweeper')
+            self._sweeper.daemon = True
+            self._sweeper.start()
+
+    def _run(self, interval):
+        """Body of the sweeper thread.
+
+        :param interval: Seconds between two sweeps.
+        :type interval: int
+        """
+        while True:
+            try:
+                self.sweep()
+            except Exception:  # pylint: disable=W0703
+                LOGGER.exception('Failed to sweep %s', self.cache_dir)
+            self._wake.wait(interval)
+            self._wake.clear()
+
+    def _default_max_age(self, file_path):
+        """Get the max age of an entry recorded without one.
+
+        :param file_path: Path of the entry.
+        :type file_path: str
+
+        :rtype: int
+        """
+        for ending, max_age in self.max_ages.items():
+            if file_path.endswith(ending):
+                return max_age
+        return self.max_age
+
+    def _stored_max_age(self, file_path):
+        """Get the max age of an entry found on disk.
+
+        :param file_path: Path of the entry.
+        :type file_path: str
+
+        :returns: The max age stored next to the entry by record, or the
+            default one.
+        :rtype: int
+        """
+        try:
+            with open(file_path + MAX_AGE_SUFFIX) as max_age_file:
+                return int(max_age_file.read())
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError):
+            LOGGER.warning('Ignoring the max age of %s', file_path)
+        return self._default_max_age(file_path)
+
+    def _store_max_age(self, file_path, max_age):
+        """Store the max age of an entry next to it, unless it is the default.
+
+        :param file_path: Absolute path of the entry.
+        :type file_path: str
+
+        :param max_age: Age in seconds after which the entry expires.
+        :type max_age: int
+        """
+        max_age_path = file_path + MAX_AGE_SUFFIX
+        try:
+            if max_age == self._default_max_age(file_path):
+                os.remove(max_age_path)
+            else:
+                with atomic_file(max_age_path) as max_age_file:
+                    max_age_file.write(str(max_age).encode('ascii'))
+        except FileNotFoundError:
+            pass
+        except OSError:
+            # The default max age is used after a restart.
+            LOGGER.exception('Failed to store the max age of %s', file_path)
+
+    def _pop(self, file_path):
+        """Remove an entry from the index, the lock must be held.
+
+        :param file_path: Absolute path of the entry.
+        :type file_path: str
+
+        :returns: The (size, mtime, max_age) of the entry, None if it was not
+            indexed.
+        :rtype: tuple
+        """
+        entry = self._entries.pop(file_path, None)
+        if entry:
+            self._total_bytes -= entry[0]
+        return entry
+
+    def _over_limits(self, total=None, count=None):
+        """Check whether the cache is above one of its limits.
+
+        :param total: Total size to check, defaults to the current one.
+        :type total: int
+
+        :param count: Number of entries to check, defaults to the current one.
+        :type count: int
+
+        :rtype: bool
+        """
+        if total is None:
+            total = self._total_bytes
+        if count is None:
+            count = len(self._entries)
+        if self.max_bytes and total > self.max_bytes:
+            return True
+        if self.max_entries and count > self.max_entries:
+            return True
+        return False
+
+    def _remove_orphans(self):
+        """Remove the companion files whose entry is gone."""
+        if not self.companions:
+            return
+        try:
+            names = os.listdir(self.cache_dir)
+        except OSError:
+            return
+        for name in names:
+            full_path = os.path.join(self.cache_dir, name)
+            if self._is_orphan(full_path):
+                try:
+                    os.remove(full_path)
+                except OSError:
+                    pass
+
+    def _remove_stale_leftovers(self, now):
+        """Remove old partial downloads and working directories (Fix #146).
+
+        Only the .part files of the cache directory are removed from it,
+        other files and directories there are not ours.
+
+        :param now: The current time in unix epoch.
+        :type now: float
+        """
+        try:
+            names = os.listdir(self.cache_dir)
+        except OSError:
+            names = []
+        for name in names:
+            if not name.endswith('.part'):
+                continue
+            full_path = os.path.join(self.cache_dir, name)
+            try:
+                if now - os.path.getmtime(full_path) > self.max_age:
+                    os.remove(full_path)
+            except OSError:
+                continue
+        remove_old_work_files(work_dir_root(), self.max_age, now)
+
+    def _is_orphan(self, file_path):
+        """Check whether a file is a companion of a removed entry.
+
+        :param file_path: Absolute path of a file in the cache directory.
+        :type file_path: str
+
+        :rtype: bool
+        """
+        for suffix in self.companions:
+            if file_path.endswith(suffix):
+                return not os.path.exists(file_path[:-len(suffix)])
+        return False
+
+
+class ExtractIndex(object):
+    """Index of the bounding boxes covered by the cached extracts.
+
+    Extracts are grouped by a key describing the query they answer, e.g.
+    (feature, overpass verbosity), so that a request can be answered from
+    any fresh extract of the same kind covering its bounding box.
+    """
+
+    def __init__(self):
+        """Constructor."""
+        # key -> {path: coordinates}
+        self._extracts = {}
+        self._lock = threading.Lock()
+
+    def add(self, key, coordinates, file_path):
+        """Register the bounding box covered by a cached extract.
+
+        :param key: What the extract contains, e.g. (feature, verbosity).
+        :type key: tuple
+
+        :param coordinates: Coordinates as returned by split_bbox.
+        :type coordinates: dict
+
+        :param file_path: Path to the cached extract.
+        :type file_path: str
+        """
+        bbox = dict(
+            (name, coordinates[name])
+            for name in ['SW_lat', 'SW_lng', 'NE_lat', 'NE_lng'])
+        with self._lock:
+            self._extracts.setdefault(key, {})[file_path] = bbox
+
+    def find(self, key, coordinates, max_age):
+        """Find a fresh cached extract covering a bounding box.
+
+        The smallest such extract is returned as it is the cheapest to clip.
+        Extracts which are gone from the disk are dropped from the index.
+
+        :param key: What the extract must contain, e.g. (feature, verbosity).
+        :type key: tuple
+
+        :param coordinates: Coordinates as returned by split_bbox.
+        :type coordinates: dict
+
+        :param max_age: Maximum age in seconds of the extract.
+        :type max_age: int
+
+        :returns: Path of the extract or None.
+        :rtype: str
+        """
+        now = time.time()
+        best_path = None
+        best_area = None
+        with self._lock:
+            extracts = self._extracts.get(key, {})
+            for file_path, bbox in list(extracts.items()):
+                try:
+                    file_time = os.path.getmtime(file_path)
+                except OSError:
+                    del extracts[file_path]
+                    continue
+                if now - file_time > max_age:
+                    continue
+                if not bbox_contains(bbox, coordinates):
+                    continue
+                height = bbox['NE_lat'] - bbox['SW_lat']
+                width = bbox['NE_lng'] - bbox['SW_lng']
+                area = height * width
+                if best_area is None or area < best_area:
+                    best_path = file_path
+                    best_area = area
+        return best_path
+
+
+# The extracts known to this process, see ExtractIndex.
+OSM_EXTRACTS = ExtractIndex()
+
+
+def osm_cache():
+    """Get the cache manager for config.CACHE_DIR.
+
+    The manager and its sweeper thread are created on first use.
+
+    :returns: The shared cache manager.
+    :rtype: CacheManager
+    """
+    global _OSM_CACHE
+    with _OSM_CACHE_GUARD:
+        if _OSM_CACHE is None:
+            stale_age = 0
+            if config.CACHE_STALE_WHILE_REVALIDATE:
+                stale_age = config.CACHE_STALE_MAX_AGE
+            _OSM_CACHE = CacheManager(
+                config.CACHE_DIR,
+                max_age=config.CACHE_MAX_AGE,
+                stale_age=stale_age,
+                max_bytes=config.CACHE_MAX_BYTES,
+                max_entries=config.CACHE_MAX_ENTRIES,
+                extensions=(
+                    '.osm', '.osm.gz', CONTRIBUTIONS_SNAPSHOT_SUFFIX),
+                companions=(CONTRIBUTIONS_INDEX_SUFFIX,),
+                max_ages={
+                    CONTRIBUTIONS_SNAPSHOT_SUFFIX:
+                        config.CONTRIBUTIONS_SNAPSHOT_MAX_AGE},
+                sweep_leftovers=True)
+            _OSM_CACHE.start(config.CACHE_SWEEP_INTERVAL)
+    return _OSM_CACHE
+
+
+def export_cache():
+    """Get the cache manager for the zipped shapefiles in config.CACHE_DIR.
+
+    They are managed apart from the OSM documents, with their own age and
+    size limits. The leftovers of the directory are swept by osm_cache. The
+    manager and its sweeper thread are created on first use.
+
+    :returns: The shared cache manager.
+    :rtype: CacheManager
+    """
+    global _EXPORT_CACHE
+    with _OSM_CACHE_GUARD:
+        if _EXPORT_CACHE is None:
+            _EXPORT_CACHE = CacheManager(
+                config.CACHE_DIR,
+                max_age=config.EXPORT_CACHE_MAX_AGE,
+                max_bytes=config.EXPORT_CACHE_MAX_BYTES,
+                max_entries=config.EXPORT_CACHE_MAX_ENTRIES,
+                extensions=(EXPORT_SUFFIX,))
+            _EXPORT_CACHE.start(config.CACHE_SWEEP_INTERVAL)
+    return _EXPORT_CACHE
+
+
+def remove_old_work_files(root, max_age, now=None):
+    """Remove the working files older than max_age made with temp_dir.
+
+    They are laid out as root/<date>/<user>/<sub dir>/<file>. The
+    directories of the previous days are removed once empty.
+
+    :param root: The directory of the working directories, see
+        work_dir_root.
+    :type root: str
+
+    :param max_age: Seconds after which a working file is removed.
+    :type max_age: int
+
+    :param now: The current time in unix epoch.
+    :type now: float
+    """
+    if now is None:
+        now = time.time()
+    today = date.today().isoformat()
+    for depth, directory, names in _walk_work_dirs(root):
+        for name in names:
+            full_path = os.path.join(directory, name)
+            try:
+                if depth == 3:
+                    if now - os.path.getmtime(full_path) <= max_age:
+                        continue
+                    if os.path.isdir(full_path):
+                        rmtree(full_path)
+                    else:
+                        os.remove(full_path)
+                elif not full_path.startswith(os.path.join(root, today)):
+                    # Fails while not empty
+                    os.rmdir(full_path)
+            except OSError:
+                continue
+
+
+def _walk_work_dirs(root):
+    """Walk the working directories of temp_dir, deepest first.
+
+    :param root: The directory of the working directories.
+    :type root: str
+
+    :returns: Tuples (depth, directory, names in the directory), the
+        depth of root/<date>/<user>/<sub dir> being 3.
+    :rtype: generator
+    """
+    directories = [(0, root)]
+    walked = []
+    while directories:
+        depth, directory = directories.pop()
+        try:
+            names = os.listdir(directory)
+        except OSError:
+            continue
+        walked.append((depth, directory, names))
+        if depth < 3:
+            directories.extend(
+                (depth + 1, os.path.join(directory, name)) for name in names
+                if os.path.isdir(os.path.join(directory, name)))
+    return reversed(walked)
+
+
+@contextmanager
+def atomic_file(file_path):
+    """Open a temporary file which replaces file_path once closed.
+
+    The temporary file is created next to file_path, so readers see either
+    the previous file or the complete new one, never a partial one. It is
+    removed if the block raises.
+
+    :param file_path: The final path of the file.
+    :type file_path: str
+
+    :returns: A file object opened for binary writing.
+    :rtype: file
+    """
+    directory = os.path.dirname(os.path.abspath(file_path))
+    handle, temp_path = mkstemp(
+        prefix='.%s.' % os.path.basename(file_path),
+        suffix='.part',
+        dir=directory)
+    try:
+        with os.fdopen(handle, 'wb') as file_handle:
+            yield file_handle
+        # mkstemp creates the file readable by its owner only
+        os.chmod(temp_path, 0o644)
+        os.replace(temp_path, file_path)
+    except BaseException:
+        try:
+            os.remove(temp_path)
+        except OSError:
+            pass
+        raise
+
+
+@contextmanager
+def cache_lock(file_path):
+    """Hold the single-flight lock for a cache entry.
+
+    Only one caller at a time, across threads and across processes sharing
+    the cache directory, holds the lock for a given file_path. Callers which
+    find a cache entry missing or stale should take the lock, check the
+    entry again and only then download it, so concurrent requests for the
+    same query result in a single Overpass call.
+
+    :param file_path: Path of the cache entry to lock.
+    :type file_path: str
+    """
+    with _LOCKS_GUARD:
+        entry = _LOCKS.setdefault(file_path, [threading.Lock(), 0])
+        entry[1] += 1
+    try:
+        with entry[0]:
+            with _file_lock('%s.lock' % file_path):
+                yield
+    finally:
+        with _LOCKS_GUARD:
+            entry[1] -= 1
+            if not entry[1]:
+                del _LOCKS[file_path]
+
+
+@contextmanager
+def _file_lock(lock_path):
+    """Hold an exclusive lock on a lock file shared between processes.
+
+    The lock file is removed on release. A process that opened the file
+    before it was removed notices that its lock is on a stale inode and
+    tries again.
+
+    :param lock_path: Path of the lock file.
+    :type lock_path: str
+    """
+    if fcntl is None:
+        yield
+        return
+
+    while True:
+        lock_file = open(lock_path, 'a')
+        fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+        try:
+            current = os.stat(lock_path)
+        except OSError:
+            current = None
+        if current and current.st_ino == os.fstat(lock_file.fileno()).st_ino:
+            break
+        lock_file.close()
+
+    try:
+        yield
+    finally:
+        try:
+            os.remove(lock_path)
+        except OSError:
+            pass
+        lock_file.close()
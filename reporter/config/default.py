@@ -19,11 +19,183 @@ DISPLAY_UPDATE_CONTROL = os.environ.get('DISPLAY_UPDATE_CONTROL') \
 # Where to store OSM files
 CACHE_DIR = os.environ.get('CACHE_DIR') \
     if os.environ.get('CACHE_DIR', False) else '/tmp'
+# Compression of the cached OSM files: 'gzip' or '' for plain xml.
+# Gzip files are 10 to 20 times smaller and can be imported by osm2pgsql.
+CACHE_COMPRESSION = os.environ.get('CACHE_COMPRESSION') \
+    if os.environ.get('CACHE_COMPRESSION', False) else ''
+# How long (in seconds) a cached OSM file is used before downloading it again
+CACHE_MAX_AGE = int(os.environ.get('CACHE_MAX_AGE')) \
+    if os.environ.get('CACHE_MAX_AGE', False) else 3600
+# Per feature override of CACHE_MAX_AGE, boundaries rarely change
+CACHE_MAX_AGE_BY_FEATURE = dict(
+    ('boundary-%s' % level, 24 * 3600) for level in range(1, 12))
+# Serve an expired cached file at once and download a new copy in the
+# background, as long as it expired less than CACHE_STALE_MAX_AGE seconds
+# ago. Set to 0 or 1 if using an env var
+CACHE_STALE_WHILE_REVALIDATE = bool(int(
+    os.environ.get('CACHE_STALE_WHILE_REVALIDATE'))) \
+    if os.environ.get('CACHE_STALE_WHILE_REVALIDATE', False) else False
+CACHE_STALE_MAX_AGE = int(os.environ.get('CACHE_STALE_MAX_AGE')) \
+    if os.environ.get('CACHE_STALE_MAX_AGE', False) else 24 * 3600
+# Answer a bbox from a fresh cached extract of a bbox containing it, by
+# clipping the extract locally rather than querying Overpass. Ways crossing
+# the bbox without any node inside it are not kept, unlike with Overpass.
+# Set to 0 or 1 if using an env var
+CACHE_REUSE_CONTAINING_BBOX = bool(int(
+    os.environ.get('CACHE_REUSE_CONTAINING_BBOX'))) \
+    if os.environ.get('CACHE_REUSE_CONTAINING_BBOX', False) else False
+# Fetch bboxes as the slippy map tiles of this zoom level (e.g. 14) and
+# cache each tile on its own, so that overlapping requests share most of
+# their downloads and big areas are fetched in small queries. 0 disables it.
+OVERPASS_TILE_ZOOM = int(os.environ.get('OVERPASS_TILE_ZOOM')) \
+    if os.environ.get('OVERPASS_TILE_ZOOM', False) else 0
+# A coarser zoom level is used when a bbox needs more tiles than this
+OVERPASS_TILE_MAX_COUNT = int(os.environ.get('OVERPASS_TILE_MAX_COUNT')) \
+    if os.environ.get('OVERPASS_TILE_MAX_COUNT', False) else 64
+# The Overpass API interpreter to query, e.g. a local Overpass instance
+OVERPASS_SERVER_URL = os.environ.get('OVERPASS_SERVER_URL') \
+    if os.environ.get('OVERPASS_SERVER_URL', False) else \
+    'http://overpass-api.de/api/interpreter'
+# Overpass servers queried in turn when one is busy or down, the
+# healthiest first. Comma separated if using an env var.
+OVERPASS_SERVER_URLS = os.environ.get('OVERPASS_SERVER_URLS').split(',') \
+    if os.environ.get('OVERPASS_SERVER_URLS', False) else \
+    [OVERPASS_SERVER_URL]
+# How many queries may run at once on each server, Overpass gives each
+# client a small number of slots
+OVERPASS_SERVER_SLOTS = int(os.environ.get('OVERPASS_SERVER_SLOTS')) \
+    if os.environ.get('OVERPASS_SERVER_SLOTS', False) else 2
+# Seconds a server is avoided after a failure, doubled after each
+# consecutive failure
+OVERPASS_SERVER_COOLDOWN = float(os.environ.get('OVERPASS_SERVER_COOLDOWN')) \
+    if os.environ.get('OVERPASS_SERVER_COOLDOWN', False) else 30
+# Idle keep-alive connections kept open to the Overpass server
+OVERPASS_POOL_SIZE = int(os.environ.get('OVERPASS_POOL_SIZE')) \
+    if os.environ.get('OVERPASS_POOL_SIZE', False) else 4
+# Seconds to wait for Overpass to accept a connection or send data
+OVERPASS_TIMEOUT = float(os.environ.get('OVERPASS_TIMEOUT')) \
+    if os.environ.get('OVERPASS_TIMEOUT', False) else 60
+# Retries of a query when Overpass can't be reached or answers 502, 503
+# or 504, after a random delay of up to OVERPASS_RETRY_DELAY seconds,
+# doubled after each attempt.
+OVERPASS_HTTP_RETRIES = int(os.environ.get('OVERPASS_HTTP_RETRIES')) \
+    if os.environ.get('OVERPASS_HTTP_RETRIES', False) else 2
+# How many parts of a split or tiled bbox this process fetches at once
+OVERPASS_CONCURRENCY = int(os.environ.get('OVERPASS_CONCURRENCY')) \
+    if os.environ.get('OVERPASS_CONCURRENCY', False) else 2
+# Fetch a bbox in quarters when Overpass times out on it, splitting each
+# quarter again at most OVERPASS_SPLIT_MAX_DEPTH times.
+# Set to 0 or 1 if using an env var
+OVERPASS_SPLIT_ON_TIMEOUT = bool(int(
+    os.environ.get('OVERPASS_SPLIT_ON_TIMEOUT'))) \
+    if os.environ.get('OVERPASS_SPLIT_ON_TIMEOUT', False) else True
+OVERPASS_SPLIT_MAX_DEPTH = int(os.environ.get('OVERPASS_SPLIT_MAX_DEPTH')) \
+    if os.environ.get('OVERPASS_SPLIT_MAX_DEPTH', False) else 2
+# Fetch bboxes bigger than this (in square degrees, e.g. 0.25) in quarters
+# straight away rather than waiting for a timeout. 0 disables it.
+OVERPASS_SPLIT_AREA = float(os.environ.get('OVERPASS_SPLIT_AREA')) \
+    if os.environ.get('OVERPASS_SPLIT_AREA', False) else 0
+# Retries of a part when Overpass has too many queries running, waiting
+# OVERPASS_RETRY_DELAY seconds, then twice as long after each attempt.
+OVERPASS_RETRIES = int(os.environ.get('OVERPASS_RETRIES')) \
+    if os.environ.get('OVERPASS_RETRIES', False) else 3
+OVERPASS_RETRY_DELAY = float(os.environ.get('OVERPASS_RETRY_DELAY')) \
+    if os.environ.get('OVERPASS_RETRY_DELAY', False) else 2
+# Upper bounds for the cache, least recently used files are evicted first.
+# Use 0 for no limit.
+CACHE_MAX_BYTES = int(os.environ.get('CACHE_MAX_BYTES')) \
+    if os.environ.get('CACHE_MAX_BYTES', False) else 0
+CACHE_MAX_ENTRIES = int(os.environ.get('CACHE_MAX_ENTRIES')) \
+    if os.environ.get('CACHE_MAX_ENTRIES', False) else 0
+# How often (in seconds) the background thread sweeps the cache
+CACHE_SWEEP_INTERVAL = int(os.environ.get('CACHE_SWEEP_INTERVAL')) \
+    if os.environ.get('CACHE_SWEEP_INTERVAL', False) else 300
+# Parser counting the contributions: 'scan' (fastest, only for plain
+# cached files, falls back to expat), 'expat' or 'sax'
+OSM_PARSER_BACKEND = os.environ.get('OSM_PARSER_BACKEND') \
+    if os.environ.get('OSM_PARSER_BACKEND', False) else 'scan'
+# Documents of at least this many bytes are parsed by a pool of processes,
+# 0 to always parse in the request thread (64 MB)
+OSM_PARSER_PARALLEL_SIZE = int(os.environ.get('OSM_PARSER_PARALLEL_SIZE')) \
+    if os.environ.get('OSM_PARSER_PARALLEL_SIZE', False) else 67108864
+# Processes parsing a big document, 0 for one per core
+OSM_PARSER_PROCESSES = int(os.environ.get('OSM_PARSER_PROCESSES')) \
+    if os.environ.get('OSM_PARSER_PROCESSES', False) else 0
+# Count the contributions for every tag of the home page from a single
+# download and parse, instead of one per tag. Only the tagged ways are
+# downloaded, so the numbers differ from the per tag documents: nodes are
+# not counted. Set to 0 or 1 if using an env var
+CONTRIBUTIONS_ALL_TAGS = bool(int(
+    os.environ.get('CONTRIBUTIONS_ALL_TAGS'))) \
+    if os.environ.get('CONTRIBUTIONS_ALL_TAGS', False) else False
+# Number of documents whose contribution summaries are kept in memory
+CONTRIBUTIONS_CACHE_SIZE = int(os.environ.get('CONTRIBUTIONS_CACHE_SIZE')) \
+    if os.environ.get('CONTRIBUTIONS_CACHE_SIZE', False) else 32
+# Store the contribution counts of cached documents next to them, so they
+# are only parsed once. Set to 0 or 1 if using an env var
+CONTRIBUTIONS_INDEX = bool(int(
+    os.environ.get('CONTRIBUTIONS_INDEX'))) \
+    if os.environ.get('CONTRIBUTIONS_INDEX', False) else True
+# Keep the ways of each area in a snapshot updated with Overpass diffs,
+# instead of downloading the whole area again once it is stale. Only used
+# with CONTRIBUTIONS_ALL_TAGS. Set to 0 or 1 if using an env var
+CONTRIBUTIONS_INCREMENTAL = bool(int(
+    os.environ.get('CONTRIBUTIONS_INCREMENTAL'))) \
+    if os.environ.get('CONTRIBUTIONS_INCREMENTAL', False) else False
+# Seconds after which a snapshot is downloaded again in full (1 week)
+CONTRIBUTIONS_SNAPSHOT_MAX_AGE = int(
+    os.environ.get('CONTRIBUTIONS_SNAPSHOT_MAX_AGE')) \
+    if os.environ.get('CONTRIBUTIONS_SNAPSHOT_MAX_AGE', False) else 604800
+# Number of top contributors shown in detail, the others are only
+# totalled. 0 to show all of them
+CONTRIBUTORS_LIMIT = int(os.environ.get('CONTRIBUTORS_LIMIT')) \
+    if os.environ.get('CONTRIBUTORS_LIMIT', False) else 100
+# Processes decoding the blocks of a local PBF file, 0 for one per core
+PBF_PROCESSES = int(os.environ.get('PBF_PROCESSES')) \
+    if os.environ.get('PBF_PROCESSES', False) else 0
 # Where to store bbox json logs - one for each data request
 # On docker/rancher we will pass this var in
 # for other systems we default to /tmp
 LOG_DIR = os.environ.get('LOG_DIR') \
     if os.environ.get('LOG_DIR', False) else '/tmp'
+# Keep the zipped shapefiles in CACHE_DIR, so a download with the same
+# options from the same OSM data is served from the disk. Set to 0 or 1 if
+# using an env var
+EXPORT_CACHE = bool(int(os.environ.get('EXPORT_CACHE'))) \
+    if os.environ.get('EXPORT_CACHE', False) else True
+# Seconds after which a zipped shapefile is removed (one week)
+EXPORT_CACHE_MAX_AGE = int(os.environ.get('EXPORT_CACHE_MAX_AGE')) \
+    if os.environ.get('EXPORT_CACHE_MAX_AGE', False) else 604800
+# Bounds of the zipped shapefiles kept, least recently used first out, 0 for
+# no limit (1 GB)
+EXPORT_CACHE_MAX_BYTES = int(os.environ.get('EXPORT_CACHE_MAX_BYTES')) \
+    if os.environ.get('EXPORT_CACHE_MAX_BYTES', False) else 1073741824
+EXPORT_CACHE_MAX_ENTRIES = int(os.environ.get('EXPORT_CACHE_MAX_ENTRIES')) \
+    if os.environ.get('EXPORT_CACHE_MAX_ENTRIES', False) else 0
+# Threads exporting the shapefiles of the download jobs, see reporter.jobs
+SHAPEFILE_JOB_WORKERS = int(os.environ.get('SHAPEFILE_JOB_WORKERS')) \
+    if os.environ.get('SHAPEFILE_JOB_WORKERS', False) else 2
+# Download jobs waiting for a thread, beyond which new jobs are refused
+SHAPEFILE_JOB_MAX_QUEUED = int(os.environ.get('SHAPEFILE_JOB_MAX_QUEUED')) \
+    if os.environ.get('SHAPEFILE_JOB_MAX_QUEUED', False) else 20
+# Seconds during which a finished download job and its zip are kept
+SHAPEFILE_JOB_MAX_AGE = int(os.environ.get('SHAPEFILE_JOB_MAX_AGE')) \
+    if os.environ.get('SHAPEFILE_JOB_MAX_AGE', False) else 3600
+# Engine writing the shapefile downloads: 'postgis' to import the OSM
+# files with osm2pgsql and export them with pgsql2shp, or 'python' to write
+# them in the process, falling back to 'postgis' for the features needing
+# relations. Compare both on your data with
+# benchmarks/benchmark_shapefile_export.py before using 'python'.
+SHAPEFILE_ENGINE = os.environ.get('SHAPEFILE_ENGINE') \
+    if os.environ.get('SHAPEFILE_ENGINE', False) else 'postgis'
+# Number of scratch databases kept for the shapefile exports, which caps
+# the number of concurrent imports. 0 to create and drop a database for
+# each export
+POSTGIS_POOL_SIZE = int(os.environ.get('POSTGIS_POOL_SIZE')) \
+    if os.environ.get('POSTGIS_POOL_SIZE', False) else 4
+# Prefix of the names of the scratch databases
+POSTGIS_POOL_PREFIX = os.environ.get('POSTGIS_POOL_PREFIX') \
+    if os.environ.get('POSTGIS_POOL_PREFIX', False) else 'osm_reporter_pool'
 # Options for the osm2pgsql command line
 OSM2PGSQL_OPTIONS = os.environ.get('OSM2PGSQL_OPTIONS') \
     if os.environ.get('OSM2PGSQL_OPTIONS', False) else ''
@@ -15,3 +15,15 @@ class OverpassBadRequestException(Exception):
 
 class OverpassConcurrentRequestException(Exception):
     pass
+
+
+class UnsupportedOsmDocumentException(Exception):
+    pass
+
+
+class UnsupportedShapefileExportException(Exception):
+    pass
+
+
+class JobQueueFullException(Exception):
+    pass
@@ -0,0 +1,394 @@
+# coding=utf-8
+"""Module for the shapefile downloads run in the background.
+
+A download fetches the OSM data of a bbox, imports and extracts a feature
+and zips the shapefile, which may take minutes for big areas. Rather than
+holding a web server thread meanwhile, a client can submit a job, poll its
+status, which tells the stage of the pipeline it is at, and download the
+zip once the job is done.
+
+The jobs run in a pool of config.SHAPEFILE_JOB_WORKERS threads of the web
+server process, and are only known to this process. At most
+config.SHAPEFILE_JOB_MAX_QUEUED jobs wait for a thread, more are refused.
+Finished jobs are forgotten config.SHAPEFILE_JOB_MAX_AGE seconds later.
+
+:copyright: (c) 2013 by Tim Sutton
+:license: GPLv3, see LICENSE for more details.
+"""
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from reporter import config
+from reporter import LOGGER
+from reporter.exceptions import JobQueueFullException
+from reporter.osm import get_osm_file, import_and_extract_shapefile
+
+# Stages of a shapefile job, in the order they run. The postgis engine
+# imports the OSM file before extracting the shapefile, the python engine
+# extracts it straight from the file, see import_and_extract_shapefile.
+SHAPEFILE_JOB_STAGES = ('download', 'import', 'extract', 'package')
+
+# States of a job
+QUEUED = 'queued'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+
+# States of a stage, besides running, done and failed
+PENDING = 'pending'
+SKIPPED = 'skipped'
+
+# The queue of the shapefile jobs, created on first use.
+_SHAPEFILE_JOBS = None
+_SHAPEFILE_JOBS_GUARD = threading.Lock()
+
+
+class Job(object):
+    """State of a job, updated by the thread running it."""
+
+    def __init__(self, name, stages, result_name=None):
+        """Constructor.
+
+        :param name: What the job does, for the logs and the status.
+        :type name: str
+
+        :param stages: Names of the stages of the job, in order.
+        :type stages: tuple
+
+        :param result_name: File name under which the result is downloaded,
+            if it is a file.
+        :type result_name: str
+        """
+        self.id = uuid.uuid4().hex
+        self.name = name
+        self.result_name = result_name
+        self.state = QUEUED
+        self.submitted = time.time()
+        self.finished = None
+        self.error = None
+        self.result = None
+        # stage -> [state, started, finished]
+        self.stages = OrderedDict(
+            (stage, [PENDING, None, None]) for stage in stages)
+        self._lock = threading.Lock()
+
+    def enter(self, stage):
+        """Note that the job moved on to one of its stages.
+
+        The stage running so far is done.
+
+        :param stage: Name of the stage.
+        :type stage: str
+        """
+        now = time.time()
+        with self._lock:
+            self.state = RUNNING
+            self._end_running(DONE, now)
+            self.stages[stage][:] = [RUNNING, now, None]
+        LOGGER.info('Job %s (%s): %s' % (self.id, self.name, stage))
+
+    def finish(self, result):
+        """Note that the job succeeded.
+
+        The stages which did not run are skipped.
+
+        :param result: What the job returned.
+        :type result: object
+        """
+        with self._lock:
+            self.result = result
+            self._end(DONE, SKIPPED)
+
+    def fail(self, error):
+        """Note that the job failed.
+
+        :param error: Why it failed, reported in the status.
+        :type error: str
+        """
+        with self._lock:
+            self._end(FAILED, PENDING)
+            self.error = error
+
+    @property
+    def is_finished(self):
+        """Whether the job is done or failed.
+
+        :rtype: bool
+        """
+        return self.state in (DONE, FAILED)
+
+    def outcome(self):
+        """Get the state and the result of the job at once.
+
+        :returns: The state, and the result once the job is done.
+        :rtype: (str, object)
+        """
+        with self._lock:
+            return self.state, self.result
+
+    def status(self):
+        """Get the status of the job.
+
+        :returns: The id, name, state and error of the job, and the state
+            and times of each stage, in order.
+        :rtype: dict
+        """
+        with self._lock:
+            return {
+                'id': self.id,
+                'name': self.name,
+                'state': self.state,
+                'error': self.error,
+                'submitted': self.submitted,
+                'finished': self.finished,
+                'stages': [
+                    {
+                        'name': stage,
+                        'state': state,
+                        'started': started,
+                        'finished': finished}
+                    for stage, (state, started, finished)
+                    in self.stages.items()]}
+
+    def _end(self, state, remaining_state):
+        """End the job, the lock must be held.
+
+        :param state: Final state of the job, and of its running stage.
+        :type state: str
+
+        :param remaining_state: State of the stages which did not run.
+        :type remaining_state: str
+        """
+        self.finished = time.time()
+        self.state = state
+        self._end_running(state, self.finished)
+        for stage in self.stages.values():
+            if stage[0] == PENDING:
+                stage[0] = remaining_state
+
+    def _end_running(self, state, now):
+        """End the running stage, if any, the lock must be held."""
+        for stage in self.stages.values():
+            if stage[0] == RUNNING:
+                stage[0] = state
+                stage[2] = now
+
+
+class JobQueue(object):
+    """Pool of threads running jobs, with a bounded queue."""
+
+    def __init__(self, max_workers, max_queued, max_age):
+        """Constructor.
+
+        :param max_workers: Number of jobs running at once.
+        :type max_workers: int
+
+        :param max_queued: Number of jobs waiting for a thread, beyond which
+            jobs are refused.
+        :type max_queued: int
+
+        :param max_age: Seconds during which a finished job is kept.
+        :type max_age: int
+        """
+        self.max_workers = max_workers
+        self.max_queued = max_queued
+        self.max_age = max_age
+        self._executor = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix='job')
+        # id -> job, oldest first
+        self._jobs = OrderedDict()
+        self._lock = threading.Lock()
+
+    def submit(self, job, function, *args):
+        """Run a job in the pool.
+
+        :param job: The job, given as first argument to function.
+        :type job: Job
+
+        :param function: Runs the job and returns its result. Exceptions
+            fail the job.
+        :type function: callable
+
+        :returns: The job.
+        :rtype: Job
+
+        :raises: JobQueueFullException when too many jobs are waiting.
+        """
+        self.prune()
+        with self._lock:
+            unfinished = sum(
+                1 for other in self._jobs.values() if not other.is_finished)
+            if unfinished >= self.max_workers + self.max_queued:
+                raise JobQueueFullException(
+                    '%s jobs are queued or running' % unfinished)
+            self._jobs[job.id] = job
+        self._executor.submit(self._run, job, function, args)
+        return job
+
+    def get(self, job_id):
+        """Get a job which is not forgotten yet.
+
+        :param job_id: Id of the job.
+        :type job_id: str
+
+        :returns: The job, None if it is unknown.
+        :rtype: Job
+        """
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def prune(self):
+        """Forget the jobs which finished more than max_age seconds ago.
+
+        :returns: The jobs forgotten.
+        :rtype: list
+        """
+        now = time.time()
+        with self._lock:
+            pruned = [
+                job for job in self._jobs.values()
+                if job.is_finished and now - job.finished > self.max_age]
+            for job in pruned:
+                del self._jobs[job.id]
+        for job in pruned:
+            self.forget(job)
+        return pruned
+
+    def forget(self, job):
+        """Release what a forgotten job holds, nothing by default.
+
+        :param job: The forgotten job.
+        :type job: Job
+        """
+        pass
+
+    @staticmethod
+    def _run(job, function, args):
+        """Run a job in a thread of the pool."""
+        try:
+            result = function(job, *args)
+        except Exception as e:
+            LOGGER.exception('Job %s (%s) failed' % (job.id, job.name))
+            job.fail(str(e) or e.__class__.__name__)
+        else:
+            job.finish(result)
+
+
+class ShapefileJobQueue(JobQueue):
+    """Queue of the shapefile jobs, removing their zips once forgotten."""
+
+    def forget(self, job):
+        """Remove the zip of a forgotten job, unless it is cached.
+
+        :param job: The forgotten job.
+        :type job: Job
+        """
+        zip_path = job.result
+        if not zip_path:
+            return
+        cache_dir = os.path.abspath(config.CACHE_DIR)
+        if os.path.dirname(os.path.abspath(zip_path)) == cache_dir:
+            # Evicted by the export cache
+            return
+        try:
+            os.remove(zip_path)
+        except OSError:
+            pass
+
+
+def shapefile_jobs():
+    """Get the queue of the shapefile jobs.
+
+    The queue and its threads are created on first use.
+
+    :returns: The shared queue.
+    :rtype: ShapefileJobQueue
+    """
+    global _SHAPEFILE_JOBS
+    with _SHAPEFILE_JOBS_GUARD:
+        if _SHAPEFILE_JOBS is None:
+            _SHAPEFILE_JOBS = ShapefileJobQueue(
+                config.SHAPEFILE_JOB_WORKERS,
+                config.SHAPEFILE_JOB_MAX_QUEUED,
+                config.SHAPEFILE_JOB_MAX_AGE)
+    return _SHAPEFILE_JOBS
+
+
+def submit_shapefile_job(
+        feature_type,
+        coordinates,
+        qgis_version=2,
+        output_prefix='',
+        inasafe_version=None,
+        lang='en',
+        source_path=None):
+    """Submit the download of a zipped shapefile.
+
+    See import_and_extract_shapefile for the parameters of the shapefile.
+
+    :param feature_type: The feature to extract.
+    :type feature_type: str
+
+    :param coordinates: Coordinates of the bbox, as returned by split_bbox.
+    :type coordinates: dict
+
+    :param source_path: OSM file to use instead of downloading the bbox
+        from Overpass.
+    :type source_path: str
+
+    :returns: The job, whose result is the path of the zip.
+    :rtype: Job
+
+    :raises: JobQueueFullException when too many jobs are waiting.
+    """
+    job = Job(
+        '%s-shp' % feature_type,
+        SHAPEFILE_JOB_STAGES,
+        '%s%s.zip' % (output_prefix, feature_type))
+    return shapefile_jobs().submit(
+        job,
+        run_shapefile_job,
+        feature_type,
+        coordinates,
+        qgis_version,
+        output_prefix,
+        inasafe_version,
+        lang,
+        source_path)
+
+
+def run_shapefile_job(
+        job,
+        feature_type,
+        coordinates,
+        qgis_version,
+        output_prefix,
+        inasafe_version,
+        lang,
+        source_path):
+    """Download the OSM data of a job and export its shapefile.
+
+    See submit_shapefile_job for the parameters.
+
+    :returns: Path to the zip file.
+    :rtype: str
+    """
+    job.enter('download')
+    if source_path:
+        file_path = source_path
+    else:
+        file_handle = get_osm_file(coordinates, feature_type, 'body')
+        file_handle.close()
+        file_path = file_handle.name
+    return import_and_extract_shapefile(
+        feature_type,
+        file_path,
+        qgis_version,
+        output_prefix,
+        inasafe_version,
+        lang,
+        progress=job.enter)
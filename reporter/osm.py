@@ -11,28 +11,75 @@ import hashlib
 import time
 import os
 import re
+import socket
 import datetime
+import threading
+import zlib
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from tempfile import mkstemp
 from subprocess import call
-from shutil import copyfile, rmtree
+from xml.etree.ElementTree import ParseError
+from shutil import copyfile, copyfileobj
 from reporter.utilities import temp_dir, unique_filename, zip_shp, which
 from reporter import config
 from reporter import LOGGER
-from reporter.queries import SQL_QUERY_MAP, OVERPASS_QUERY_MAP
+from reporter.cache import (
+    EXPORT_SUFFIX,
+    OSM_EXTRACTS,
+    atomic_file,
+    cache_lock,
+    export_cache,
+    osm_cache)
+from reporter.osm_document import (
+    COMPRESSED_SUFFIX,
+    clip_osm_document,
+    create_osm_document,
+    merge_osm_documents,
+    open_osm_document)
+from reporter.queries import (
+    SQL_QUERY_MAP,
+    OVERPASS_QUERY_MAP,
+    WAYS_ONLY_FEATURES)
 from reporter.utilities import (
+    bbox_area,
+    bbox_quarters,
+    bbox_tiles,
+    tile_bbox,
     shapefile_resource_base_path,
     overpass_resource_base_path,
     generic_shapefile_base_path)
 from reporter.exceptions import (
     OverpassTimeoutException,
     OverpassBadRequestException,
-    OverpassConcurrentRequestException)
+    OverpassConcurrentRequestException,
+    UnsupportedShapefileExportException)
 from reporter.metadata import metadata_files
-from urllib.request import urlopen
-# noinspection PyPep8Naming
-from urllib.request import Request
+from reporter.overpass import overpass_client, overpass_endpoints
+from reporter.postgis_pool import leased_database
+from reporter.shapefile_export import export_shapefile
 from urllib.parse import quote
 # noinspection PyPep8Naming
-from urllib.error import HTTPError
+from urllib.error import HTTPError, URLError
+
+# Size of the blocks read from Overpass and written to the cache file.
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+
+# Cache files being refreshed by a background thread of this process.
+_REFRESHING = set()
+_REFRESHING_GUARD = threading.Lock()
+
+# Pool used to fetch the parts of big bboxes, see overpass_executor.
+_OVERPASS_EXECUTOR = None
+
+# Overpass reports query timeouts inside an otherwise valid document.
+OVERPASS_RUNTIME_ERROR = b'<remark> runtime error:'
+
+# Digests of the OSM and resource files exported, by (path, size, mtime), so
+# unchanged files are only read once, see source_digest.
+_SOURCE_DIGESTS = OrderedDict()
+_SOURCE_DIGESTS_GUARD = threading.Lock()
+SOURCE_DIGESTS_MAX_COUNT = 256
 
 
 def get_osm_file(
@@ -89,10 +136,11 @@ def get_osm_file(
 
     Equivalent url (http encoded)::
     """
-    server_url = 'http://overpass-api.de/api/interpreter?data='
     parameters = coordinates
     parameters['print_mode'] = overpass_verbosity
     query = OVERPASS_QUERY_MAP[feature].format(**parameters)
+    # Extracts of a diff query can't answer another query
+    is_diff_query = False
 
     if date_from and date_to:
         try:
@@ -106,22 +154,115 @@ def get_osm_file(
                 date_to=datetime_to.strftime(date_format)
             )
             query = diff_query + query
+            is_diff_query = True
         except ValueError as e:
             LOGGER.debug(e)
 
+    file_path, url_path = osm_query_paths(query)
+    max_age = config.CACHE_MAX_AGE_BY_FEATURE.get(
+        feature, config.CACHE_MAX_AGE)
+    if is_diff_query:
+        return load_osm_document(file_path, url_path, max_age)
+
+    extract_key = (feature, overpass_verbosity)
+    # Documents without nodes can't be clipped to a smaller bbox
+    clippable = feature not in WAYS_ONLY_FEATURES
+    if not is_cache_fresh(file_path, max_age):
+        source_path = None
+        if config.CACHE_REUSE_CONTAINING_BBOX and clippable:
+            source_path = OSM_EXTRACTS.find(extract_key, coordinates, max_age)
+        split_area = config.OVERPASS_SPLIT_AREA
+        if source_path:
+            built = load_clipped_osm_document(
+                file_path, source_path, coordinates, max_age)
+        elif config.OVERPASS_TILE_ZOOM and clippable:
+            built = load_tiled_osm_document(
+                file_path, feature, overpass_verbosity, coordinates, max_age)
+        elif split_area and bbox_area(coordinates) > split_area:
+            built = load_split_osm_document(
+                file_path, feature, overpass_verbosity, coordinates, max_age)
+        else:
+            built = False
+        if built:
+            return open_built_osm_document(
+                file_path, max_age, extract_key, coordinates)
+
+    try:
+        file_handle = load_osm_document(file_path, url_path, max_age)
+    except OverpassTimeoutException:
+        if not config.OVERPASS_SPLIT_ON_TIMEOUT:
+            raise
+        LOGGER.info('Overpass timed out, fetching %s in parts', file_path)
+        load_split_osm_document(
+            file_path, feature, overpass_verbosity, coordinates, max_age)
+        return open_built_osm_document(
+            file_path, max_age, extract_key, coordinates)
+    if config.CACHE_REUSE_CONTAINING_BBOX:
+        OSM_EXTRACTS.add(extract_key, coordinates, file_path)
+    return file_handle
+
+
+def open_built_osm_document(file_path, max_age, extract_key, coordinates):
+    """Open a cached document which was built from other cached documents.
+
+    The document is opened as is, even if the parts it was built from were
+    stale, rather than letting load_osm_document download the whole bbox.
+
+    :param file_path: Path of the document.
+    :type file_path: str
+
+    :param max_age: Seconds during which the cached file is used.
+    :type max_age: int
+
+    :param extract_key: The (feature, verbosity) of the document.
+    :type extract_key: tuple
+
+    :param coordinates: Coordinates as returned by split_bbox.
+    :type coordinates: dict
+
+    :returns: A file object for the document.
+    :rtype: file
+    """
+    file_handle = open_osm_document(file_path)
+    osm_cache().record(file_path, max_age)
+    if config.CACHE_REUSE_CONTAINING_BBOX:
+        OSM_EXTRACTS.add(extract_key, coordinates, file_path)
+    return file_handle
+
+
+def osm_query_paths(query):
+    """Get the cache file and the Overpass URL for an Overpass query.
+
+    :param query: The Overpass QL query.
+    :type query: str
+
+    :returns: A tuple (file path, url path).
+    :rtype: (str, str)
+    """
     encoded_query = quote(query)
-    url_path = '%s%s' % (server_url, encoded_query)
+    server_url = config.OVERPASS_SERVER_URLS[0]
+    url_path = '%s?data=%s' % (server_url, encoded_query)
     safe_name = hashlib.md5(query.encode('utf-8')).hexdigest() + '.osm'
+    if config.CACHE_COMPRESSION == 'gzip':
+        safe_name += COMPRESSED_SUFFIX
     file_path = os.path.join(config.CACHE_DIR, safe_name)
-    # Tidy away any old cached files to prevent the file system filling up
-    clear_osm_cache()
-    return load_osm_document(file_path, url_path)
+    return file_path, url_path
 
 
-def load_osm_document(file_path, url_path):
+def load_osm_document(
+        file_path,
+        url_path,
+        max_age=None,
+        stale_while_revalidate=None):
     """Load an osm document, refreshing it if the cached copy is stale.
 
-    To save bandwidth the file is not downloaded if it is less than 1 hour old.
+    To save bandwidth the file is not downloaded if it is less than max_age
+    seconds old. Concurrent requests for the same file wait for a single
+    download rather than each querying Overpass.
+
+    With stale_while_revalidate, a file which expired less than
+    config.CACHE_STALE_MAX_AGE seconds ago is returned straight away and
+    downloaded again in a background thread.
 
     :type file_path: basestring
     :param file_path: The path on the filesystem to which the file should
@@ -131,29 +272,373 @@ def load_osm_document(file_path, url_path):
         should be retrieved.
     :type url_path: str
 
+    :param max_age: Seconds during which the cached file is used. Defaults
+        to config.CACHE_MAX_AGE (1 hour).
+    :type max_age: int
+
+    :param stale_while_revalidate: Whether to serve expired files while
+        they are refreshed. Defaults to config.CACHE_STALE_WHILE_REVALIDATE.
+    :type stale_while_revalidate: bool
+
     :returns: A file object for the the downloaded file.
     :rtype: file
 
      Raises:
          None
     """
-    elapsed_seconds = 0
-    if os.path.exists(file_path):
-        current_time = time.time()  # in unix epoch
-        file_time = os.path.getmtime(file_path)  # in unix epoch
-        elapsed_seconds = current_time - file_time
-        if elapsed_seconds > 3600:
-            os.remove(file_path)
-    if elapsed_seconds > 3600 or not os.path.exists(file_path):
-        fetch_osm(file_path, url_path)
-        message = ('fetched %s' % file_path)
-        LOGGER.info(message)
-    file_handle = open(file_path, 'rb')
+    if max_age is None:
+        max_age = config.CACHE_MAX_AGE
+    if stale_while_revalidate is None:
+        stale_while_revalidate = config.CACHE_STALE_WHILE_REVALIDATE
+
+    if not is_cache_fresh(file_path, max_age):
+        stale_max_age = max_age + config.CACHE_STALE_MAX_AGE
+        if stale_while_revalidate and is_cache_fresh(file_path, stale_max_age):
+            refresh_in_background(file_path, url_path, max_age)
+        else:
+            refresh_osm_document(file_path, url_path, max_age)
+    file_handle = open_osm_document(file_path)
+    # Old files are tidied away by the cache sweeper thread
+    osm_cache().record(file_path, max_age)
     return file_handle
 
 
+def load_clipped_osm_document(file_path, source_path, coordinates, max_age):
+    """Cut an osm document out of a cached extract of a bigger area.
+
+    The clipped file gets the modification time of its source, so it
+    expires together with the data it was made from.
+
+    :param file_path: The path on the filesystem to which the file should
+        be saved.
+    :type file_path: str
+
+    :param source_path: Path of a cached extract containing coordinates.
+    :type source_path: str
+
+    :param coordinates: Coordinates as returned by split_bbox.
+    :type coordinates: dict
+
+    :param max_age: Seconds during which the cached file is used.
+    :type max_age: int
+
+    :returns: False if the extract could not be used.
+    :rtype: bool
+    """
+    with cache_lock(file_path):
+        if is_cache_fresh(file_path, max_age):
+            return True
+        try:
+            source_time = os.path.getmtime(source_path)
+            clip_osm_document(source_path, file_path, coordinates)
+        except (OSError, ParseError):
+            # The extract was evicted or replaced meanwhile, just download.
+            LOGGER.exception('Failed to clip %s', source_path)
+            return False
+        os.utime(file_path, (source_time, source_time))
+        LOGGER.info('clipped %s from %s', file_path, source_path)
+    return True
+
+
+def load_tiled_osm_document(
+        file_path, feature, overpass_verbosity, coordinates, max_age):
+    """Build an osm document from the grid tiles covering a bbox.
+
+    Each tile of zoom config.OVERPASS_TILE_ZOOM is fetched and cached on
+    its own, so requests for overlapping bboxes share their tiles and only
+    download the missing ones. The tiles are merged and the result clipped
+    to the bbox (see clip_osm_document for the limits of clipping). The
+    document expires together with its oldest tile.
+
+    :param file_path: The path on the filesystem to which the file should
+        be saved.
+    :type file_path: str
+
+    :param feature: The type of feature to extract.
+    :type feature: str
+
+    :param overpass_verbosity: Output verbosity in Overpass.
+    :type overpass_verbosity: str
+
+    :param coordinates: Coordinates as returned by split_bbox.
+    :type coordinates: dict
+
+    :param max_age: Seconds during which the cached files are used.
+    :type max_age: int
+
+    :returns: True once the document is written.
+    :rtype: bool
+    """
+    zoom = config.OVERPASS_TILE_ZOOM
+    tiles = bbox_tiles(coordinates, zoom)
+    while len(tiles) > config.OVERPASS_TILE_MAX_COUNT and zoom > 0:
+        zoom -= 1
+        tiles = bbox_tiles(coordinates, zoom)
+
+    with cache_lock(file_path):
+        if is_cache_fresh(file_path, max_age):
+            return True
+        parts = [tile_bbox(x, y, zoom) for x, y in tiles]
+        tile_paths = load_osm_parts(
+            feature, overpass_verbosity, parts, max_age)
+        if config.CACHE_REUSE_CONTAINING_BBOX:
+            for tile_coordinates in parts:
+                tile_path = osm_part_paths(
+                    feature, overpass_verbosity, tile_coordinates)[0]
+                OSM_EXTRACTS.add(
+                    (feature, overpass_verbosity), tile_coordinates,
+                    tile_path)
+        tile_time = min(os.path.getmtime(path) for path in tile_paths)
+
+        handle, merged_path = mkstemp(
+            suffix='.part', dir=os.path.dirname(file_path))
+        os.close(handle)
+        try:
+            merge_osm_documents(tile_paths, merged_path)
+            clip_osm_document(merged_path, file_path, coordinates)
+        finally:
+            os.remove(merged_path)
+        os.utime(file_path, (tile_time, tile_time))
+        LOGGER.info(
+            'merged %s from %s tiles at zoom %s', file_path, len(tiles), zoom)
+    return True
+
+
+def load_split_osm_document(
+        file_path, feature, overpass_verbosity, coordinates, max_age):
+    """Build an osm document from the quarters of its bbox.
+
+    This is used for bboxes which are too big for a single Overpass query.
+    The quarters are fetched in parallel, see load_osm_parts, and merged.
+    The document expires together with its oldest part.
+
+    :param file_path: The path on the filesystem to which the file should
+        be saved.
+    :type file_path: str
+
+    :param feature: The type of feature to extract.
+    :type feature: str
+
+    :param overpass_verbosity: Output verbosity in Overpass.
+    :type overpass_verbosity: str
+
+    :param coordinates: Coordinates as returned by split_bbox.
+    :type coordinates: dict
+
+    :param max_age: Seconds during which the cached files are used.
+    :type max_age: int
+
+    :returns: True once the document is written.
+    :rtype: bool
+    """
+    with cache_lock(file_path):
+        if is_cache_fresh(file_path, max_age):
+            return True
+        part_paths = load_osm_parts(
+            feature, overpass_verbosity, bbox_quarters(coordinates), max_age)
+        part_time = min(os.path.getmtime(path) for path in part_paths)
+        merge_osm_documents(part_paths, file_path)
+        os.utime(file_path, (part_time, part_time))
+        LOGGER.info('merged %s from %s parts', file_path, len(part_paths))
+    return True
+
+
+def load_osm_parts(feature, overpass_verbosity, parts, max_age):
+    """Fetch the documents of several bboxes with bounded concurrency.
+
+    The parts are fetched by a pool of config.OVERPASS_CONCURRENCY threads.
+    A part for which Overpass times out is split in quarters, at most
+    config.OVERPASS_SPLIT_MAX_DEPTH times.
+
+    :param feature: The type of feature to extract.
+    :type feature: str
+
+    :param overpass_verbosity: Output verbosity in Overpass.
+    :type overpass_verbosity: str
+
+    :param parts: Coordinates of the bboxes, as returned by split_bbox.
+    :type parts: list
+
+    :param max_age: Seconds during which the cached files are used.
+    :type max_age: int
+
+    :returns: The paths of the cached documents.
+    :rtype: list
+
+    :raises: OverpassTimeoutException if a part can't be split any further.
+    """
+    executor = overpass_executor()
+    pending = [(part, 0) for part in parts]
+    part_paths = []
+    while pending:
+        futures = dict(
+            (executor.submit(
+                load_osm_part, feature, overpass_verbosity, part, max_age),
+             (part, depth))
+            for part, depth in pending)
+        pending = []
+        for future in as_completed(futures):
+            part, depth = futures[future]
+            try:
+                part_paths.append(future.result())
+            except OverpassTimeoutException:
+                if depth >= config.OVERPASS_SPLIT_MAX_DEPTH:
+                    raise
+                pending.extend(
+                    (quarter, depth + 1) for quarter in bbox_quarters(part))
+    return part_paths
+
+
+def load_osm_part(feature, overpass_verbosity, coordinates, max_age):
+    """Load the cached document of a bbox, backing off when Overpass is busy.
+
+    :param feature: The type of feature to extract.
+    :type feature: str
+
+    :param overpass_verbosity: Output verbosity in Overpass.
+    :type overpass_verbosity: str
+
+    :param coordinates: Coordinates as returned by split_bbox.
+    :type coordinates: dict
+
+    :param max_age: Seconds during which the cached file is used.
+    :type max_age: int
+
+    :returns: The path of the cached document.
+    :rtype: str
+    """
+    file_path, url_path = osm_part_paths(
+        feature, overpass_verbosity, coordinates)
+    for attempt in range(config.OVERPASS_RETRIES + 1):
+        try:
+            load_osm_document(file_path, url_path, max_age).close()
+            return file_path
+        except OverpassConcurrentRequestException:
+            if attempt == config.OVERPASS_RETRIES:
+                raise
+            delay = config.OVERPASS_RETRY_DELAY * 2 ** attempt
+            LOGGER.info('Overpass is busy, retrying in %ss', delay)
+            time.sleep(delay)
+
+
+def osm_part_paths(feature, overpass_verbosity, coordinates):
+    """Get the cache file and the Overpass URL for a feature in a bbox.
+
+    :param feature: The type of feature to extract.
+    :type feature: str
+
+    :param overpass_verbosity: Output verbosity in Overpass.
+    :type overpass_verbosity: str
+
+    :param coordinates: Coordinates as returned by split_bbox.
+    :type coordinates: dict
+
+    :returns: A tuple (file path, url path).
+    :rtype: (str, str)
+    """
+    parameters = dict(coordinates)
+    parameters['print_mode'] = overpass_verbosity
+    query = OVERPASS_QUERY_MAP[feature].format(**parameters)
+    return osm_query_paths(query)
+
+
+def overpass_executor():
+    """Get the thread pool used to query Overpass in parallel.
+
+    :returns: The shared pool, created on first use.
+    :rtype: ThreadPoolExecutor
+    """
+    global _OVERPASS_EXECUTOR
+    with _REFRESHING_GUARD:
+        if _OVERPASS_EXECUTOR is None:
+            _OVERPASS_EXECUTOR = ThreadPoolExecutor(
+                max_workers=config.OVERPASS_CONCURRENCY)
+    return _OVERPASS_EXECUTOR
+
+
+def refresh_osm_document(file_path, url_path, max_age):
+    """Download an osm document unless someone else just did.
+
+    :param file_path: The path on the filesystem to which the file should
+        be saved.
+    :type file_path: str
+
+    :param url_path: The URL from which the file should be retrieved.
+    :type url_path: str
+
+    :param max_age: Seconds during which the cached file is used.
+    :type max_age: int
+    """
+    with cache_lock(file_path):
+        # Someone else may have fetched it while we were waiting.
+        if not is_cache_fresh(file_path, max_age):
+            fetch_osm(file_path, url_path)
+            message = ('fetched %s' % file_path)
+            LOGGER.info(message)
+
+
+def refresh_in_background(file_path, url_path, max_age):
+    """Download an osm document again in a background thread.
+
+    Nothing happens if this process is already refreshing the file.
+
+    :param file_path: The path on the filesystem to which the file should
+        be saved.
+    :type file_path: str
+
+    :param url_path: The URL from which the file should be retrieved.
+    :type url_path: str
+
+    :param max_age: Seconds during which the cached file is used.
+    :type max_age: int
+    """
+    with _REFRESHING_GUARD:
+        if file_path in _REFRESHING:
+            return
+        _REFRESHING.add(file_path)
+
+    def refresh():
+        try:
+            refresh_osm_document(file_path, url_path, max_age)
+        except Exception:  # pylint: disable=W0703
+            LOGGER.exception('Failed to refresh %s', file_path)
+        finally:
+            with _REFRESHING_GUARD:
+                _REFRESHING.discard(file_path)
+
+    LOGGER.info('Serving stale %s while it is refreshed', file_path)
+    thread = threading.Thread(target=refresh, name='osm-refresh')
+    thread.daemon = True
+    thread.start()
+
+
+def is_cache_fresh(file_path, max_age=None):
+    """Check whether a cached file exists and is recent enough to be used.
+
+    :param file_path: The path of the cached file.
+    :type file_path: str
+
+    :param max_age: Maximum age in seconds, defaults to config.CACHE_MAX_AGE.
+    :type max_age: int
+
+    :returns: True if the file can be used without downloading it again.
+    :rtype: bool
+    """
+    if max_age is None:
+        max_age = config.CACHE_MAX_AGE
+    try:
+        file_time = os.path.getmtime(file_path)  # in unix epoch
+    except OSError:
+        return False
+    current_time = time.time()  # in unix epoch
+    elapsed_seconds = current_time - file_time
+    return elapsed_seconds <= max_age
+
+
 def clear_osm_cache():
-    """Search for and remove any cached osm files greater than 1 hour old.
+    """Remove any cached osm files that are too old or over the cache limits.
+
+    This normally happens in the background, see reporter.cache.CacheManager.
 
     :returns: None
     :rtype: None
@@ -161,29 +646,19 @@ def clear_osm_cache():
     Raises:
          None
     """
-    elapsed_seconds = 0
-    cache_files = os.listdir(config.CACHE_DIR)
-
-    for file_path in cache_files:
-        full_path = os.path.join(config.CACHE_DIR, file_path)
-        filename, extension = os.path.splitext(file_path)
-        if extension == '.osm':
-            current_time = time.time()  # in unix epoch
-            try:
-                file_time = os.path.getmtime(full_path)  # in unix epoch
-            except:  # in case file was removed in the mean time
-                continue
-            elapsed_seconds = current_time - file_time
-            if elapsed_seconds > 3600:
-                os.remove(full_path)
-        # Fix #146
-        elif os.path.isdir(full_path):
-            rmtree(full_path)
+    osm_cache().sweep()
 
 
 def fetch_osm(file_path, url_path):
     """Fetch an osm map and store locally.
 
+    The response is streamed to a temporary file next to file_path and
+    renamed into place once complete, so memory use does not depend on the
+    size of the document and readers never see a partial file. Connections
+    to Overpass are kept alive and shared, see overpass_client.
+
+    The query is sent to the healthiest of the configured Overpass servers,
+    and to the next one if it is busy, times out or can't be reached.
 
     :param url_path: The path (relative to the ftp root) from which the
         file should be retrieved.
@@ -197,27 +672,85 @@ def fetch_osm(file_path, url_path):
 
     """
     LOGGER.debug('Getting URL: %s', url_path)
-    headers = {'User-Agent': 'InaSAFE'}
-    web_request = Request(url_path, None, headers)
-    try:
-        url_handle = urlopen(web_request, timeout=60)
-        data = url_handle.read().decode('utf-8')
-        regex = '<remark> runtime error:'
-        if re.search(regex, data):
-            raise OverpassTimeoutException
-
-        file_handle = open(file_path, 'wb')
-        file_handle.write(data.encode('utf-8'))
-        file_handle.close()
-    except HTTPError as e:
-        if e.code == 400:
-            LOGGER.exception('Bad request to Overpass')
-            raise OverpassBadRequestException
-        elif e.code == 419:
-            raise OverpassConcurrentRequestException
-
-        LOGGER.exception('Error with Overpass')
-        raise e
+    headers = {'User-Agent': 'InaSAFE', 'Accept-Encoding': 'gzip'}
+    error = None
+    for endpoint, endpoint_url in overpass_endpoints().candidates(url_path):
+        started = time.time()
+        try:
+            with endpoint.slot():
+                with overpass_client().get(endpoint_url, headers) as response:
+                    stream_to_file(
+                        response,
+                        file_path,
+                        response.headers.get('Content-Encoding'))
+        except HTTPError as e:
+            if e.code == 400:
+                LOGGER.exception('Bad request to Overpass')
+                raise OverpassBadRequestException
+            elif e.code in (419, 429):
+                error = OverpassConcurrentRequestException()
+            else:
+                LOGGER.exception('Error with Overpass')
+                error = e
+        except (OverpassTimeoutException, URLError, socket.timeout) as e:
+            error = e
+        else:
+            endpoint.succeeded(time.time() - started)
+            return file_path
+        endpoint.failed()
+        LOGGER.info('%s failed on %s', type(error).__name__, endpoint.url)
+    raise error
+
+
+def stream_to_file(url_handle, file_path, content_encoding=None):
+    """Copy an Overpass response to disk chunk by chunk.
+
+    Only a window of len(OVERPASS_RUNTIME_ERROR) - 1 bytes is carried
+    between chunks to detect the runtime error marker when it straddles a
+    chunk boundary.
+
+    A gzip encoded response is decompressed on the fly to look for the
+    marker, and stored as it was received if file_path is compressed too.
+
+    :param url_handle: An open response (anything with a read method).
+    :type url_handle: HTTPResponse
+
+    :param file_path: The final path of the document.
+    :type file_path: str
+
+    :param content_encoding: The Content-Encoding of the response.
+    :type content_encoding: str
+
+    :raises: OverpassTimeoutException if Overpass reported a runtime error.
+    """
+    overlap = len(OVERPASS_RUNTIME_ERROR) - 1
+    gzipped = content_encoding == 'gzip'
+    decompressor = None
+    if gzipped:
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    keep_body = gzipped and file_path.endswith(COMPRESSED_SUFFIX)
+    if keep_body:
+        output = atomic_file(file_path)
+    else:
+        output = create_osm_document(file_path)
+    with output as file_handle:
+        tail = b''
+        while True:
+            chunk = url_handle.read(DOWNLOAD_CHUNK_SIZE)
+            if not chunk:
+                break
+            data = chunk
+            if gzipped:
+                data = decompressor.decompress(chunk)
+            window = tail + data[:overlap]
+            if OVERPASS_RUNTIME_ERROR in window:
+                raise OverpassTimeoutException
+            if OVERPASS_RUNTIME_ERROR in data:
+                raise OverpassTimeoutException
+            file_handle.write(chunk if keep_body else data)
+            tail = (tail + data[-overlap:])[-overlap:]
+        if gzipped and not keep_body:
+            file_handle.write(decompressor.flush())
 
 
 def add_metadata_timestamp(metadata_file_path):
@@ -250,22 +783,118 @@ def add_metadata_timestamp(metadata_file_path):
         f.close()
 
 
-def import_and_extract_shapefile(
+def source_digest(file_path):
+    """Get a digest of the content of an OSM file.
+
+    The digest is kept for as long as the size and the modification time of
+    the file are unchanged, so big files are not read on every export.
+
+    :param file_path: Path to the OSM file.
+    :type file_path: str
+
+    :returns: The sha1 of the file, in hexadecimal.
+    :rtype: str
+    """
+    file_path = os.path.abspath(file_path)
+    status = os.stat(file_path)
+    key = (file_path, status.st_size, status.st_mtime_ns)
+    with _SOURCE_DIGESTS_GUARD:
+        digest = _SOURCE_DIGESTS.get(key)
+        if digest:
+            _SOURCE_DIGESTS.move_to_end(key)
+            return digest
+    hasher = hashlib.sha1()
+    with open(file_path, 'rb') as source:
+        for chunk in iter(lambda: source.read(DOWNLOAD_CHUNK_SIZE), b''):
+            hasher.update(chunk)
+    digest = hasher.hexdigest()
+    with _SOURCE_DIGESTS_GUARD:
+        _SOURCE_DIGESTS[key] = digest
+        while len(_SOURCE_DIGESTS) > SOURCE_DIGESTS_MAX_COUNT:
+            _SOURCE_DIGESTS.popitem(last=False)
+    return digest
+
+
+def resource_digest(feature_type):
+    """Get a digest of the resource files used to export a feature.
+
+    These are the style and sql files of the feature, its qml, keywords and
+    metadata files, and the generic license and prj files, so that editing
+    any of them changes the cached zips, see export_cache_path.
+
+    :param feature_type: The feature to extract.
+    :type feature_type: str
+
+    :returns: The sha1 of the names and digests of the files, in
+        hexadecimal.
+    :rtype: str
+    """
+    hasher = hashlib.sha1()
+    for base_path in (
+            overpass_resource_base_path(feature_type),
+            shapefile_resource_base_path(feature_type),
+            generic_shapefile_base_path()):
+        directory = os.path.dirname(base_path)
+        for name in sorted(os.listdir(directory)):
+            path = os.path.join(directory, name)
+            if os.path.isfile(path):
+                hasher.update(
+                    ('%s %s\n' % (name, source_digest(path))).encode('utf-8'))
+    return hasher.hexdigest()
+
+
+def export_cache_path(
         feature_type,
         file_path,
         qgis_version=2,
         output_prefix='',
         inasafe_version=None,
         lang='en'):
+    """Get the path of the cached zip of a shapefile export.
+
+    The zip is named after the content of the OSM file and of the resource
+    files of the feature, and the options of the export, see
+    import_and_extract_shapefile for the parameters.
+
+    :returns: Path of the zip in config.CACHE_DIR.
+    :rtype: str
+    """
+    key = '\n'.join([
+        source_digest(file_path),
+        resource_digest(feature_type),
+        feature_type,
+        str(qgis_version),
+        str(inasafe_version),
+        lang,
+        output_prefix,
+        config.SHAPEFILE_ENGINE])
+    safe_name = hashlib.sha1(key.encode('utf-8')).hexdigest() + EXPORT_SUFFIX
+    return os.path.join(config.CACHE_DIR, safe_name)
+
+
+def import_and_extract_shapefile(
+        feature_type,
+        file_path,
+        qgis_version=2,
+        output_prefix='',
+        inasafe_version=None,
+        lang='en',
+        progress=None):
     """Convert the OSM xml file to a shapefile.
 
-    This is a multi-step process:
-        * Create a temporary postgis database
+    With config.SHAPEFILE_ENGINE 'python', the shapefile is written in the
+    process, see export_shapefile. Otherwise, or if the feature or the file
+    needs Postgres, this is a multi-step process:
+        * Lease a scratch postgis database, see leased_database
         * Load the osm dataset into POSTGIS with osm2pgsql and our custom
              style file.
         * Save the data out again to a shapefile
         * Zip the shapefile ready for user to download
 
+    With config.EXPORT_CACHE, the zip is kept in config.CACHE_DIR and
+    returned again for the same OSM data and options, see export_cache_path.
+    Concurrent requests for the same zip wait for a single export.
+
     :param feature_type: The feature to extract.
     :type feature_type: str
 
@@ -290,6 +919,10 @@ def import_and_extract_shapefile(
         Example : 'en', 'fr', etc. Default is 'en'.
     :type lang: str
 
+    :param progress: Called with 'import', 'extract' and 'package' as the
+        export goes through these stages, those which are needed.
+    :type progress: callable
+
     :returns: Path to zipfile that was created.
     :rtype: str
 
@@ -300,28 +933,104 @@ def import_and_extract_shapefile(
         raise Exception(error)
 
     output_prefix += feature_type
-
-    work_dir = temp_dir(sub_dir=feature_type)
-    directory_name = unique_filename(dir=work_dir)
-    db_name = os.path.basename(directory_name)
-
-    import_osm_file(db_name, feature_type, file_path)
-    zip_file = extract_shapefile(
+    if not config.EXPORT_CACHE:
+        return build_shapefile_zip(
+            feature_type,
+            file_path,
+            qgis_version,
+            output_prefix,
+            inasafe_version,
+            lang,
+            progress)
+
+    zip_path = export_cache_path(
         feature_type,
-        db_name,
-        directory_name,
+        file_path,
         qgis_version,
         output_prefix,
         inasafe_version,
         lang)
-    drop_database(db_name)
+    if not os.path.exists(config.CACHE_DIR):
+        os.makedirs(config.CACHE_DIR)
+    with cache_lock(zip_path):
+        if is_cache_fresh(zip_path, config.EXPORT_CACHE_MAX_AGE):
+            LOGGER.info('Serving %s from the cache' % zip_path)
+        else:
+            zip_file = build_shapefile_zip(
+                feature_type,
+                file_path,
+                qgis_version,
+                output_prefix,
+                inasafe_version,
+                lang,
+                progress)
+            with atomic_file(zip_path) as cached_file:
+                with open(zip_file, 'rb') as built_file:
+                    copyfileobj(built_file, cached_file)
+            os.remove(zip_file)
+        export_cache().record(zip_path)
+    return zip_path
+
+
+def build_shapefile_zip(
+        feature_type,
+        file_path,
+        qgis_version=2,
+        output_prefix='',
+        inasafe_version=None,
+        lang='en',
+        progress=None):
+    """Export the features of an OSM file to a new zipped shapefile.
+
+    See import_and_extract_shapefile for the parameters, output_prefix
+    already ends with the feature type here.
+
+    :returns: Path to zipfile that was created.
+    :rtype: str
+    """
+    progress = progress or _no_progress
+    work_dir = temp_dir(sub_dir=feature_type)
+    directory_name = unique_filename(dir=work_dir)
+
+    if config.SHAPEFILE_ENGINE == 'python':
+        shape_path = os.path.join(directory_name, '%s.shp' % output_prefix)
+        progress('extract')
+        try:
+            export_shapefile(feature_type, file_path, shape_path)
+        except UnsupportedShapefileExportException as e:
+            LOGGER.info('Exporting %s through postgis: %s' % (
+                feature_type, e))
+        else:
+            progress('package')
+            return package_shapefile(
+                feature_type,
+                shape_path,
+                qgis_version,
+                output_prefix,
+                inasafe_version,
+                lang)
+
+    with leased_database(os.path.basename(directory_name)) as db_name:
+        progress('import')
+        import_osm_file(db_name, feature_type, file_path)
+        zip_file = extract_shapefile(
+            feature_type,
+            db_name,
+            directory_name,
+            qgis_version,
+            output_prefix,
+            inasafe_version,
+            lang,
+            progress)
     return zip_file
 
 
 def import_osm_file(db_name, feature_type, file_path):
     """Import the OSM xml file into a postgis database.
 
-    :param db_name: The database to use.
+    The tables of a previous import are replaced.
+
+    :param db_name: The database to use, see leased_database.
     :type db_name: str
 
     :param feature_type: The feature to import.
@@ -335,9 +1044,6 @@ def import_osm_file(db_name, feature_type, file_path):
 
     # Used to standarise types while data is in pg still
     transform_path = '%s.sql' % overpass_resource_path
-    createdb_executable = which('createdb')[0]
-    createdb_command = '%s -T template_postgis %s' % (
-        createdb_executable, db_name)
     osm2pgsql_executable = which('osm2pgsql')[0]
     osm2pgsql_options = config.OSM2PGSQL_OPTIONS
     osm2pgsql_command = '%s -S %s -d %s %s %s' % (
@@ -350,26 +1056,12 @@ def import_osm_file(db_name, feature_type, file_path):
     transform_command = '%s %s -f %s' % (
         psql_executable, db_name, transform_path)
 
-    LOGGER.info(createdb_command)
-    call(createdb_command, shell=True)
     LOGGER.info(osm2pgsql_command)
     call(osm2pgsql_command, shell=True)
     LOGGER.info(transform_command)
     call(transform_command, shell=True)
 
 
-def drop_database(db_name):
-    """Remove a database.
-
-    :param db_name: The database
-    :type db_name: str
-    """
-    dropdb_executable = which('dropdb')[0]
-    dropdb_command = '%s %s' % (dropdb_executable, db_name)
-    LOGGER.info(dropdb_command)
-    call(dropdb_command, shell=True)
-
-
 def extract_shapefile(
         feature_type,
         db_name,
@@ -377,15 +1069,9 @@ def extract_shapefile(
         qgis_version=2,
         output_prefix='',
         inasafe_version=None,
-        lang='en'):
-    """Extract a database to a shapefile.
-
-    This is a multi-step process:
-        * Create a temporary postgis database
-        * Load the osm dataset into POSTGIS with osm2pgsql and our custom
-             style file.
-        * Save the data out again to a shapefile
-        * Zip the shapefile ready for user to download
+        lang='en',
+        progress=None):
+    """Extract a database to a shapefile, with pgsql2shp.
 
     :param feature_type: The feature to extract.
     :type feature_type: str
@@ -414,15 +1100,72 @@ def extract_shapefile(
         Example : 'en', 'fr', etc. Default is 'en'.
     :type lang: str
 
+    :param progress: Called with 'extract' and 'package' as the extract
+        goes through these stages.
+    :type progress: callable
+
     :returns: Path to zipfile that was created.
     :rtype: str
     """
+    progress = progress or _no_progress
     # Extract
     os.makedirs(directory_name)
-    shapefile_resource_path = shapefile_resource_base_path(feature_type)
-
     shape_path = os.path.join(directory_name, '%s.shp' % output_prefix)
 
+    pgsql2shp_executable = which('pgsql2shp')[0]
+    pgsql2shp_command = '%s -f %s %s %s' % (
+        pgsql2shp_executable, shape_path, db_name, SQL_QUERY_MAP[feature_type])
+
+    LOGGER.info(pgsql2shp_command)
+    progress('extract')
+    call(pgsql2shp_command, shell=True)
+    progress('package')
+    return package_shapefile(
+        feature_type,
+        shape_path,
+        qgis_version,
+        output_prefix,
+        inasafe_version,
+        lang)
+
+
+def package_shapefile(
+        feature_type,
+        shape_path,
+        qgis_version=2,
+        output_prefix='',
+        inasafe_version=None,
+        lang='en'):
+    """Add the style, metadata and license to a shapefile and zip it.
+
+    :param feature_type: The feature of the shapefile.
+    :type feature_type: str
+
+    :param shape_path: Path to the .shp file written.
+    :type shape_path: str
+
+    :param qgis_version: Get the QGIS version. Currently 1,
+        2 are accepted, default to 2. A different qml style file will be
+        returned depending on the version
+    :type qgis_version: int
+
+    :param output_prefix: Base name of the shape file, see
+        import_and_extract_shapefile.
+    :type output_prefix: str
+
+    :param inasafe_version: The InaSAFE version, to get correct metadata.
+    :type inasafe_version: str
+
+    :param lang: The language desired for the labels in the legend.
+        Example : 'en', 'fr', etc. Default is 'en'.
+    :type lang: str
+
+    :returns: Path to zipfile that was created.
+    :rtype: str
+    """
+    directory_name = os.path.dirname(shape_path)
+    shapefile_resource_path = shapefile_resource_base_path(feature_type)
+
     if qgis_version > 1:
         qml_source_path = '%s-%s.qml' % (shapefile_resource_path, lang)
         if not os.path.isfile(qml_source_path):
@@ -439,13 +1182,6 @@ def extract_shapefile(
     prj_dest_path = os.path.join(
         directory_name, '%s.prj' % output_prefix)
 
-    pgsql2shp_executable = which('pgsql2shp')[0]
-    pgsql2shp_command = '%s -f %s %s %s' % (
-        pgsql2shp_executable, shape_path, db_name, SQL_QUERY_MAP[feature_type])
-
-    # Now run the commands in sequence:
-    LOGGER.info(pgsql2shp_command)
-    call(pgsql2shp_command, shell=True)
     copyfile(qml_source_path, qml_dest_path)
 
     metadata = metadata_files(
@@ -471,6 +1207,11 @@ def extract_shapefile(
     return zipfile
 
 
+def _no_progress(stage):
+    """Ignore the progress of an export."""
+    pass
+
+
 def check_string(text, search=re.compile(r'[^A-Za-z0-9-_]').search):
     """Test that a string doesnt contain unwanted characters.
 
@@ -0,0 +1,302 @@
+# coding=utf-8
+"""Module for counting contributions in big OSM xml documents in parallel.
+
+Ways are the only elements counted, and each way is counted on its own,
+so the ways of a document can be cut in chunks at <way boundaries and the
+chunks parsed by a pool of processes shared by the requests (see
+reporter.process_pool), each with a parser of osm_way_parser. The counts
+of the chunks are then added up. The nodes at the start of the document
+and the relations at its end are not parsed at all.
+
+:copyright: (c) 2013 by Tim Sutton
+:license: GPLv3, see LICENSE for more details.
+"""
+import mmap
+import os
+import xml.sax
+from concurrent.futures.process import BrokenProcessPool
+
+from reporter import config
+from reporter.process_pool import discard_process_pool, shared_process_pool
+from reporter.osm_way_parser import (
+    OsmExpatParser,
+    OsmMultiTagParser)
+
+# Start of a way element, never found in attribute values where < is
+# escaped.
+WAY_START = b'<way '
+
+# Bytes of ways parsed by a process at a time. Chunks smaller than the
+# document share the work evenly when some chunks have bigger ways.
+CHUNK_SIZE = 16 * 1024 * 1024
+
+# Name of the pool parsing the chunks, see shared_process_pool
+POOL_NAME = 'osm-chunks'
+
+
+def is_chunkable(osm_file):
+    """Check whether a document is worth parsing in parallel.
+
+    :param osm_file: A file object reading from a .osm file.
+    :type osm_file: file
+
+    :returns: True for plain (not compressed) documents of at least
+        config.OSM_PARSER_PARALLEL_SIZE bytes when more than one process is
+        available.
+    :rtype: bool
+    """
+    file_path = getattr(osm_file, 'name', None)
+    if not isinstance(file_path, str) or not file_path.endswith('.osm'):
+        return False
+    if not config.OSM_PARSER_PARALLEL_SIZE or parser_processes() < 2:
+        return False
+    try:
+        return os.path.getsize(file_path) >= config.OSM_PARSER_PARALLEL_SIZE
+    except OSError:
+        return False
+
+
+def parser_processes():
+    """Get the number of processes parsing a document.
+
+    :returns: config.OSM_PARSER_PROCESSES, or the number of cores if it is
+        0.
+    :rtype: int
+    """
+    return config.OSM_PARSER_PROCESSES or os.cpu_count() or 1
+
+
+def way_chunks(file_path, chunk_size=None):
+    """Cut the ways of a document in chunks starting at a way.
+
+    :param file_path: Path of the OSM xml document.
+    :type file_path: str
+
+    :param chunk_size: Approximate number of bytes of a chunk, defaults to
+        CHUNK_SIZE.
+    :type chunk_size: int
+
+    :returns: (start, end) byte offsets of the chunks, in order. The last
+        chunk ends before the closing root element, so it includes the
+        relations.
+    :rtype: list
+    """
+    if chunk_size is None:
+        chunk_size = CHUNK_SIZE
+    with open(file_path, 'rb') as osm_file:
+        if not os.fstat(osm_file.fileno()).st_size:
+            return []
+        with mmap.mmap(
+                osm_file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            start = data.find(WAY_START)
+            if start < 0:
+                return []
+            end = data.rfind(b'</osm>')
+            if end < start:
+                end = len(data)
+            boundaries = [start]
+            while True:
+                boundary = data.find(
+                    WAY_START, boundaries[-1] + chunk_size, end)
+                if boundary < 0:
+                    break
+                boundaries.append(boundary)
+    boundaries.append(end)
+    return list(zip(boundaries, boundaries[1:]))
+
+
+def chunked_osm_object_counts(file_path, tag_name):
+    """Count the contributions for a tag, parsing chunks in parallel.
+
+    :param file_path: Path of the OSM xml document.
+    :type file_path: str
+
+    :param tag_name: The tag name we want to filter on.
+    :type tag_name: str
+
+    :returns: The way counts, node counts and day counts by user of
+        OsmExpatParser (or OsmParser) for the whole document.
+    :rtype: (dict, dict, dict)
+
+    :raises: xml.sax.SAXParseException if the document is not valid xml.
+    """
+    return _parse_chunks(
+        file_path,
+        OsmExpatParser,
+        (tag_name,),
+        ('wayCountDict', 'nodeCountDict', 'userDayCountDict'))
+
+
+def chunked_osm_contribution_counts(file_path, tag_names):
+    """Count the contributions for several tags, parsing chunks in parallel.
+
+    :param file_path: Path of the OSM xml document.
+    :type file_path: str
+
+    :param tag_names: The tag names we want counts for.
+    :type tag_names: list
+
+    :returns: The way counts, node counts and day counts by tag name of
+        OsmMultiTagParser for the whole document.
+    :rtype: (dict, dict, dict)
+
+    :raises: xml.sax.SAXParseException if the document is not valid xml.
+    """
+    counts = _parse_chunks(
+        file_path,
+        OsmMultiTagParser,
+        (tag_names,),
+        ('wayCountDicts', 'nodeCountDicts', 'userDayCountDicts'))
+    for tag_counts in counts:
+        for tag_name in tag_names:
+            tag_counts.setdefault(tag_name, {})
+    return counts
+
+
+class ChunkReader(object):
+    """File object reading a chunk of a document as a document of its own.
+
+    The chunk is wrapped in an osm root element, so the parsers of
+    osm_way_parser can read it like a whole document.
+    """
+
+    def __init__(self, file_path, start, end):
+        """Constructor.
+
+        :param file_path: Path of the OSM xml document.
+        :type file_path: str
+
+        :param start: Offset of the first byte of the chunk.
+        :type start: int
+
+        :param end: Offset after the last byte of the chunk.
+        :type end: int
+        """
+        self.name = file_path
+        self._file = open(file_path, 'rb')
+        self._file.seek(start)
+        self._remaining = end - start
+        self._prefix = b'<osm>'
+        self._suffix = b'</osm>'
+
+    def read(self, size=-1):
+        """Read the next bytes of the chunk.
+
+        :param size: Maximum number of bytes to read, -1 for no limit.
+        :type size: int
+
+        :returns: The bytes read, empty at the end of the chunk.
+        :rtype: bytes
+        """
+        if self._prefix:
+            data, self._prefix = self._prefix, b''
+            return data
+        if self._remaining:
+            if size is None or size < 0:
+                size = self._remaining
+            data = self._file.read(min(size, self._remaining))
+            if data:
+                self._remaining -= len(data)
+                return data
+            # The document was truncated.
+            self._remaining = 0
+        data, self._suffix = self._suffix, b''
+        return data
+
+    def close(self):
+        """Close the document."""
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def _parse_chunks(file_path, parser_class, arguments, attributes):
+    """Parse the ways of a document in chunks and add up the counts.
+
+    :param file_path: Path of the OSM xml document.
+    :type file_path: str
+
+    :param parser_class: The parser of each chunk.
+    :type parser_class: type
+
+    :param arguments: Arguments of the parser constructor.
+    :type arguments: tuple
+
+    :param attributes: Names of the count dicts of the parser.
+    :type attributes: tuple
+
+    :returns: The totals of the count dicts, in the order of attributes.
+    :rtype: tuple
+    """
+    totals = tuple({} for _ in attributes)
+    chunks = way_chunks(file_path)
+    processes = parser_processes()
+    jobs = [
+        (file_path, start, end, parser_class, arguments, attributes)
+        for start, end in chunks]
+    if processes <= 1 or len(chunks) <= 1:
+        results = [_parse_chunk(*job) for job in jobs]
+    else:
+        pool = shared_process_pool(POOL_NAME, processes)
+        futures = [pool.submit(_parse_chunk, *job) for job in jobs]
+        try:
+            results = [future.result() for future in futures]
+        except BrokenProcessPool:
+            discard_process_pool(POOL_NAME, pool)
+            raise
+        finally:
+            for future in futures:
+                future.cancel()
+    for error, counts in results:
+        if error:
+            raise xml.sax.SAXParseException(error, None, _ChunkLocator())
+        for total, chunk_counts in zip(totals, counts):
+            _add_nested_counts(total, chunk_counts)
+    return totals
+
+
+def _parse_chunk(file_path, start, end, parser_class, arguments, attributes):
+    """Parse a chunk, in a worker process.
+
+    :returns: A tuple (error message or None, count dicts).
+    :rtype: tuple
+    """
+    parser = parser_class(*arguments)
+    try:
+        with ChunkReader(file_path, start, end) as chunk:
+            parser.parse(chunk)
+    except xml.sax.SAXParseException as e:
+        # Parse errors hold the expat parser, which can't be pickled.
+        return 'Byte %s: %s' % (start, e.getMessage()), None
+    return None, tuple(getattr(parser, name) for name in attributes)
+
+
+def _add_nested_counts(totals, counts):
+    """Add counts to totals, dicts of numbers, Timelines or such dicts."""
+    for key, count in counts.items():
+        if isinstance(count, dict):
+            _add_nested_counts(totals.setdefault(key, {}), count)
+        elif key in totals:
+            totals[key] = totals[key] + count
+        else:
+            totals[key] = count
+
+
+class _ChunkLocator(object):
+    """Position of a parse error reported by a worker, which is unknown."""
+
+    def getColumnNumber(self):
+        return None
+
+    def getLineNumber(self):
+        return None
+
+    def getPublicId(self):
+        return None
+
+    def getSystemId(self):
+        return None
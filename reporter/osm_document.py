@@ -0,0 +1,272 @@
+# coding=utf-8
+"""Module for local operations on OSM xml documents.
+:copyright: (c) 2013 by Tim Sutton
+:license: GPLv3, see LICENSE for more details.
+"""
+import gzip
+import heapq
+from contextlib import contextmanager
+from operator import itemgetter
+from xml.etree.ElementTree import iterparse, tostring
+from xml.sax.saxutils import quoteattr
+
+from reporter.cache import atomic_file
+
+# Cached documents with this suffix are stored gzip compressed.
+COMPRESSED_SUFFIX = '.gz'
+
+# Favour speed over size, OSM xml compresses well either way.
+COMPRESSION_LEVEL = 6
+
+
+def open_osm_document(file_path):
+    """Open an OSM document for reading, decompressing it on the fly.
+
+    :param file_path: Path to the OSM xml document, compressed or not.
+    :type file_path: str
+
+    :returns: A binary file object reading the xml. Its name attribute is
+        file_path.
+    :rtype: file
+    """
+    if file_path.endswith(COMPRESSED_SUFFIX):
+        return gzip.open(file_path, 'rb')
+    return open(file_path, 'rb')
+
+
+@contextmanager
+def create_osm_document(file_path):
+    """Open a new OSM document for writing, compressing it if needed.
+
+    The document is written atomically, see atomic_file.
+
+    :param file_path: The final path of the document.
+    :type file_path: str
+
+    :returns: A binary file object to write the xml to.
+    :rtype: file
+    """
+    with atomic_file(file_path) as file_handle:
+        if not file_path.endswith(COMPRESSED_SUFFIX):
+            yield file_handle
+            return
+        with gzip.GzipFile(
+                fileobj=file_handle,
+                mode='wb',
+                compresslevel=COMPRESSION_LEVEL) as output:
+            yield output
+
+
+def iter_osm_elements(source_path):
+    """Iterate over the top level elements of an OSM xml document.
+
+    Elements are cleared once the caller is done with them so memory use
+    does not depend on the size of the document.
+
+    :param source_path: Path to the OSM xml document, compressed or not.
+    :type source_path: str
+
+    :returns: (root, element) pairs for each child of the root element.
+    :rtype: iterator
+    """
+    depth = 0
+    root = None
+    with open_osm_document(source_path) as source:
+        for event, element in iterparse(source, events=('start', 'end')):
+            if event == 'start':
+                if root is None:
+                    root = element
+                depth += 1
+                continue
+            depth -= 1
+            if depth == 1:
+                yield root, element
+                del root[:]
+
+
+def clip_osm_document(source_path, file_path, coordinates):
+    """Write the part of an OSM document which falls inside a bounding box.
+
+    This reproduces what Overpass returns for our feature queries on a
+    smaller area, so an extract cached for a bigger bbox can answer the
+    request without downloading anything:
+
+        * ways with at least one node inside the bbox,
+        * relations with at least one of these ways or nodes as member,
+        * the ways and nodes needed by these ways and relations,
+        * tagged nodes inside the bbox.
+
+    Unlike Overpass, a way crossing the bbox without having a node inside
+    it is not kept.
+
+    The source document is read three times but never loaded in memory,
+    only sets of element ids are kept.
+
+    :param source_path: Path to the OSM document to clip.
+    :type source_path: str
+
+    :param file_path: Path of the clipped document to write.
+    :type file_path: str
+
+    :param coordinates: Coordinates as returned by split_bbox.
+    :type coordinates: dict
+
+    :returns: The path to the clipped document.
+    :rtype: str
+    """
+    min_lat = coordinates['SW_lat']
+    max_lat = coordinates['NE_lat']
+    min_lng = coordinates['SW_lng']
+    max_lng = coordinates['NE_lng']
+
+    # First pass: what falls inside the bbox.
+    inside_nodes = set()
+    tagged_nodes = set()
+    kept_ways = set()
+    kept_relations = set()
+    member_ways = set()
+    member_nodes = set()
+    for _, element in iter_osm_elements(source_path):
+        if element.tag == 'node':
+            lat = float(element.get('lat'))
+            lng = float(element.get('lon'))
+            if min_lat <= lat <= max_lat and min_lng <= lng <= max_lng:
+                inside_nodes.add(element.get('id'))
+                if element.find('tag') is not None:
+                    tagged_nodes.add(element.get('id'))
+        elif element.tag == 'way':
+            for nd in element.iter('nd'):
+                if nd.get('ref') in inside_nodes:
+                    kept_ways.add(element.get('id'))
+                    break
+        elif element.tag == 'relation':
+            members = element.findall('member')
+            inside = {'way': kept_ways, 'node': inside_nodes}
+            for member in members:
+                if member.get('ref') in inside.get(member.get('type'), ()):
+                    kept_relations.add(element.get('id'))
+                    break
+            else:
+                continue
+            for member in members:
+                if member.get('type') == 'way':
+                    member_ways.add(member.get('ref'))
+                elif member.get('type') == 'node':
+                    member_nodes.add(member.get('ref'))
+    kept_ways.update(member_ways)
+
+    # Second pass: the nodes needed to build the kept ways.
+    kept_nodes = tagged_nodes | member_nodes
+    for _, element in iter_osm_elements(source_path):
+        if element.tag == 'way' and element.get('id') in kept_ways:
+            for nd in element.iter('nd'):
+                kept_nodes.add(nd.get('ref'))
+
+    # Last pass: write the document.
+    kept = {
+        'node': kept_nodes,
+        'way': kept_ways,
+        'relation': kept_relations,
+    }
+
+    def wanted(item):
+        element = item[1]
+        if element.tag not in kept:
+            # e.g. the note and meta elements
+            return True
+        return element.get('id') in kept[element.tag]
+
+    return write_osm_document(
+        file_path, filter(wanted, iter_osm_elements(source_path)))
+
+
+def merge_osm_documents(source_paths, file_path):
+    """Merge OSM documents into one, without duplicate elements.
+
+    Elements are written by type (nodes, ways then relations) and by id, as
+    expected by osm2pgsql. Each source must be sorted the same way, which is
+    the default output order of Overpass. When an element is in several
+    sources the highest version is kept. Only one element per source is in
+    memory at a time.
+
+    :param source_paths: Paths of the OSM documents to merge.
+    :type source_paths: list
+
+    :param file_path: Path of the merged document to write.
+    :type file_path: str
+
+    :returns: The path to the merged document.
+    :rtype: str
+    """
+    element_types = ('node', 'way', 'relation')
+
+    def header():
+        # The note and meta elements of the first document
+        if not source_paths:
+            return
+        for root, element in iter_osm_elements(source_paths[0]):
+            if element.tag in element_types:
+                break
+            yield root, element
+
+    def typed_elements(source_path, element_type):
+        for root, element in iter_osm_elements(source_path):
+            if element.tag == element_type:
+                yield int(element.get('id')), root, element
+
+    def merged():
+        for item in header():
+            yield item
+        for element_type in element_types:
+            elements = heapq.merge(
+                *[typed_elements(source_path, element_type)
+                  for source_path in source_paths],
+                key=itemgetter(0))
+            last_id = None
+            best = None
+            for element_id, root, element in elements:
+                if element_id == last_id:
+                    version = int(element.get('version', 0))
+                    if version > int(best[1].get('version', 0)):
+                        best = (root, element)
+                    continue
+                if best is not None:
+                    yield best
+                last_id = element_id
+                best = (root, element)
+            if best is not None:
+                yield best
+
+    return write_osm_document(file_path, merged())
+
+
+def write_osm_document(file_path, elements):
+    """Write OSM elements to a new document, atomically.
+
+    :param file_path: Path of the document to write, compressed if it ends
+        with COMPRESSED_SUFFIX.
+    :type file_path: str
+
+    :param elements: (root, element) pairs as yielded by iter_osm_elements.
+        The attributes of the first root are used for the new root element.
+    :type elements: iterable
+
+    :returns: The path to the document.
+    :rtype: str
+    """
+    with create_osm_document(file_path) as output:
+        output.write(b'<?xml version="1.0" encoding="UTF-8"?>\n')
+        root_attributes = None
+        for root, element in elements:
+            if root_attributes is None:
+                root_attributes = ''.join(
+                    ' %s=%s' % (key, quoteattr(value))
+                    for key, value in root.attrib.items())
+                output.write(('<osm%s>\n' % root_attributes).encode('utf-8'))
+            element.tail = '\n'
+            output.write(b'  ')
+            output.write(tostring(element, encoding='utf-8'))
+        if root_attributes is None:
+            output.write(b'<osm version="0.6">\n')
+        output.write(b'</osm>\n')
+    return file_path
@@ -0,0 +1,281 @@
+# coding=utf-8
+"""Module for scanning cached OSM xml documents without an xml parser.
+
+The documents cached from Overpass are regular: utf-8, one start tag per
+element, double quoted attributes in a known order for tags. Counting the
+contributions only needs a few attributes, so the scanner reads them with
+compiled regular expressions running over a memory map of the file, with
+no copy of the document and no attribute objects. Users and days are kept
+as bytes and only decoded once per distinct value, the distinct days of a
+user are then handed to a TimelineAccumulator.
+
+Anything the scanner does not expect raises
+UnsupportedOsmDocumentException, callers then fall back to an xml parser.
+
+:copyright: (c) 2013 by Tim Sutton
+:license: GPLv3, see LICENSE for more details.
+"""
+import mmap
+import re
+from contextlib import contextmanager
+from xml.sax.saxutils import escape, unescape
+
+from reporter.exceptions import UnsupportedOsmDocumentException
+from reporter.timeline import TimelineAccumulator
+
+# Start tag of a way and its attributes
+WAY_PATTERN = re.compile(rb'<way\s([^>]*)>')
+
+# Attributes of a way or node start tag
+USER_PATTERN = re.compile(rb'\suser="([^"]*)"')
+DAY_PATTERN = re.compile(rb'\stimestamp="(\d{4}-\d\d-\d\d)')
+LAT_PATTERN = re.compile(rb'\slat="([^"]*)"')
+LON_PATTERN = re.compile(rb'\slon="([^"]*)"')
+
+# Key of a tag of a way
+TAG_KEY_PATTERN = re.compile(rb'<tag\s+k="([^"]*)"')
+
+# Bytes of the start of a document checked for its declaration
+HEADER_SIZE = 256
+
+# Entities Overpass writes in attribute values, besides &amp; &lt; &gt;
+ATTRIBUTE_ENTITIES = {'&quot;': '"', '&apos;': "'"}
+
+
+def is_scannable(osm_file):
+    """Check whether a document can be memory mapped by the scanner.
+
+    :param osm_file: A file object reading from an OSM document.
+    :type osm_file: file
+
+    :returns: True for plain (not compressed) .osm files.
+    :rtype: bool
+    """
+    file_path = getattr(osm_file, 'name', None)
+    return isinstance(file_path, str) and file_path.endswith('.osm')
+
+
+def scan_osm_object_counts(file_path, tag_name):
+    """Count the contributions for a tag, as OsmExpatParser does.
+
+    :param file_path: Path of the OSM xml document.
+    :type file_path: str
+
+    :param tag_name: The tag name we want to filter on.
+    :type tag_name: str
+
+    :returns: The way counts, node counts and day counts by user.
+    :rtype: (dict, dict, dict)
+
+    :raises: UnsupportedOsmDocumentException if the document is not as
+        expected.
+    """
+    tag = tag_name.encode('utf-8')
+    way_counts = {}
+    node_counts = {}
+    day_counts = {}
+    for user, day, node_count, keys in _scan_ways(file_path):
+        key = (user, day)
+        day_counts[key] = day_counts.get(key, 0) + 1
+        if tag in keys:
+            way_counts[user] = way_counts.get(user, 0) + 1
+            node_counts[user] = node_counts.get(user, 0) + node_count
+
+    days = TimelineAccumulator()
+    days.update(day_counts)
+    users = {}
+    return (
+        dict((_decode(user, users), count)
+             for user, count in way_counts.items()),
+        dict((_decode(user, users), count)
+             for user, count in node_counts.items()),
+        dict((_decode(user, users), timeline)
+             for user, timeline in days.timelines().items()))
+
+
+def scan_osm_contribution_counts(file_path, tag_names):
+    """Count the contributions for several tags, as OsmMultiTagParser does.
+
+    :param file_path: Path of the OSM xml document.
+    :type file_path: str
+
+    :param tag_names: The tag names we want counts for.
+    :type tag_names: list
+
+    :returns: The way counts, node counts and day counts by tag name.
+    :rtype: (dict, dict, dict)
+
+    :raises: UnsupportedOsmDocumentException if the document is not as
+        expected.
+    """
+    tags = dict((name.encode('utf-8'), name) for name in tag_names)
+    # (tag, user) -> [ways, nodes]
+    counts = {}
+    # tag -> (user, day) -> ways
+    day_counts = dict((tag, {}) for tag in tags)
+    for user, day, node_count, keys in _scan_ways(file_path):
+        for tag in tags.keys() & set(keys):
+            key = (tag, user)
+            count = counts.get(key)
+            if count is None:
+                counts[key] = [1, node_count]
+            else:
+                count[0] += 1
+                count[1] += node_count
+            tag_day_counts = day_counts[tag]
+            key = (user, day)
+            tag_day_counts[key] = tag_day_counts.get(key, 0) + 1
+
+    users = {}
+    way_count_dicts = dict((name, {}) for name in tag_names)
+    node_count_dicts = dict((name, {}) for name in tag_names)
+    timelines = {}
+    for (tag, user), (ways, nodes) in counts.items():
+        name = _decode(user, users)
+        way_count_dicts[tags[tag]][name] = ways
+        node_count_dicts[tags[tag]][name] = nodes
+    for tag, tag_day_counts in day_counts.items():
+        days = TimelineAccumulator()
+        days.update(tag_day_counts)
+        timelines[tags[tag]] = dict(
+            (_decode(user, users), timeline)
+            for user, timeline in days.timelines().items())
+    return way_count_dicts, node_count_dicts, timelines
+
+
+def scan_nodes_by_user(file_path, username):
+    """Get the nodes of a user, as OsmNodeParser does.
+
+    The document is searched for the user attribute of this user only, so
+    the other nodes are skipped without being looked at.
+
+    :param file_path: Path of the OSM xml document.
+    :type file_path: str
+
+    :param username: Name of the user for whom nodes should be collected.
+    :type username: str
+
+    :returns: The (lat, lon) of the nodes of the user, in document order.
+    :rtype: list
+
+    :raises: UnsupportedOsmDocumentException if the document is not as
+        expected.
+    """
+    if set(username) & set('&<>"\''):
+        # Writers do not agree on how to escape these.
+        raise UnsupportedOsmDocumentException(username)
+    needle = (' user="%s"' % escape(username)).encode('utf-8')
+    nodes = []
+    with _mapped_document(file_path) as data:
+        position = data.find(needle)
+        while position >= 0:
+            start = data.rfind(b'<', 0, position)
+            end = data.find(b'>', position)
+            attributes = data[start:end]
+            if attributes.startswith(b'<node'):
+                lat = LAT_PATTERN.search(attributes)
+                lon = LON_PATTERN.search(attributes)
+                if lat is None or lon is None:
+                    raise UnsupportedOsmDocumentException(attributes)
+                nodes.append((float(lat.group(1)), float(lon.group(1))))
+            position = data.find(needle, end)
+    return nodes
+
+
+def _scan_ways(file_path):
+    """Read the ways of a document.
+
+    :param file_path: Path of the OSM xml document.
+    :type file_path: str
+
+    :returns: (user, day, node count, tag keys) for each way. The user, day
+        and keys are bytes, the user is None if the way has none.
+    :rtype: iterator
+
+    :raises: UnsupportedOsmDocumentException if the document is not as
+        expected.
+    """
+    with _mapped_document(file_path) as data:
+        find = data.find
+        for match in WAY_PATTERN.finditer(data):
+            attributes = match.group(1)
+            user = USER_PATTERN.search(attributes)
+            if user is not None:
+                user = user.group(1)
+            elif b'user=' in attributes:
+                raise UnsupportedOsmDocumentException(attributes)
+            day = DAY_PATTERN.search(attributes)
+            if day is None:
+                raise UnsupportedOsmDocumentException(attributes)
+            if attributes.endswith(b'/'):
+                yield user, day.group(1), 0, ()
+                continue
+            end = find(b'</way>', match.end())
+            if end < 0:
+                raise UnsupportedOsmDocumentException(attributes)
+            body = data[match.end():end]
+            keys = TAG_KEY_PATTERN.findall(body)
+            if len(keys) != body.count(b'<tag'):
+                raise UnsupportedOsmDocumentException(body)
+            yield user, day.group(1), body.count(b'<nd '), keys
+
+
+@contextmanager
+def _mapped_document(file_path):
+    """Map a document in memory, checking it is as the scanner expects.
+
+    Documents with another encoding than utf-8, with comments, CDATA
+    sections or a DOCTYPE, with single quoted attributes, or not ending with
+    the closing root element (e.g. truncated downloads) are not supported.
+
+    :param file_path: Path of the OSM xml document.
+    :type file_path: str
+
+    :returns: The read only memory map of the whole document.
+    :rtype: mmap.mmap
+
+    :raises: UnsupportedOsmDocumentException if the document is not as
+        expected.
+    """
+    with open(file_path, 'rb') as osm_file:
+        try:
+            data = mmap.mmap(osm_file.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            # Empty file
+            raise UnsupportedOsmDocumentException(file_path)
+        with data:
+            header = data[:HEADER_SIZE]
+            if header.startswith(b'<?xml'):
+                declaration = header[:header.find(b'?>')].lower()
+                if b'encoding' in declaration and b'utf-8' not in declaration:
+                    raise UnsupportedOsmDocumentException(declaration)
+            if data.find(b'<!') >= 0 or data.find(b"='") >= 0:
+                raise UnsupportedOsmDocumentException(file_path)
+            tail = data[max(0, len(data) - HEADER_SIZE):].rstrip()
+            if not tail.endswith(b'</osm>'):
+                raise UnsupportedOsmDocumentException(file_path)
+            yield data
+
+
+def _decode(value, decoded):
+    """Decode an attribute value, once per distinct value.
+
+    :param value: The raw value, or None.
+    :type value: bytes
+
+    :param decoded: Values already decoded, updated.
+    :type decoded: dict
+
+    :rtype: str
+    """
+    if value is None:
+        return None
+    text = decoded.get(value)
+    if text is None:
+        text = value.decode('utf-8')
+        if '&' in text:
+            if '&#' in text:
+                raise UnsupportedOsmDocumentException(value)
+            text = unescape(text, ATTRIBUTE_ENTITIES)
+        decoded[value] = text
+    return text
@@ -4,6 +4,12 @@
 :license: GPLv3, see LICENSE for more details.
 """
 import xml.sax
+from xml.parsers import expat
+
+from reporter.timeline import TimelineAccumulator
+
+# Bytes fed to expat at a time by OsmExpatParser
+PARSE_CHUNK_SIZE = 1024 * 1024
 
 
 class OsmParser(xml.sax.ContentHandler):
@@ -32,6 +38,7 @@ class OsmParser(xml.sax.ContentHandler):
         self.wayCountDict = {}
         self.nodeCountDict = {}
         self.userDayCountDict = {}
+        self._days = TimelineAccumulator()
 
     def startElement(self, name, attributes):
         """Callback for when an element start is encountered.
@@ -49,16 +56,7 @@ class OsmParser(xml.sax.ContentHandler):
             self.user = attributes.get('user')
             timestamp = attributes.get('timestamp')
             # 2012-12-10T12:26:21Z
-            date_part = timestamp.split('T')[0]
-            if self.user not in self.userDayCountDict:
-                self.userDayCountDict[self.user] = dict()
-
-            if date_part not in self.userDayCountDict[self.user]:
-                self.userDayCountDict[self.user][date_part] = 0
-
-            value = self.userDayCountDict[self.user][date_part]
-            value += 1
-            self.userDayCountDict[self.user][date_part] = value
+            self._days.add(self.user, timestamp[:10])
 
         elif name == 'nd' and self.inWay:
             self.nodeCount += 1
@@ -95,6 +93,10 @@ class OsmParser(xml.sax.ContentHandler):
             self.nodeCount = 0
             self.wayCount = 0
 
+    def endDocument(self):
+        """Callback for the end of the document, building the timelines."""
+        self.userDayCountDict = self._days.timelines()
+
     def characters(self, content):
         """Return chars from content - unimplmented.
 
@@ -103,3 +105,345 @@ class OsmParser(xml.sax.ContentHandler):
 
         """
         pass
+
+
+class OsmExpatParser(object):
+    """Faster alternative to OsmParser, calling expat directly.
+
+    The counts are the same as OsmParser's but the sax layers are skipped:
+    expat hands element names and plain attribute dicts straight to
+    closures keeping the parser state in local variables. Outside ways only
+    a cheap handler waiting for the next way is installed, the handlers
+    counting nodes and tags are swapped in for the elements of a way. Day
+    counts are kept in a TimelineAccumulator, userDayCountDict holds
+    Timelines.
+    """
+
+    def __init__(self, tag_name):
+        """Constructor for parser.
+
+        :param tag_name: Name of the osm tag to use for parsing e.g.
+            'buildings' or 'roads'.
+        :type tag_name: str
+        """
+        self.tagName = tag_name
+        self.wayCountDict = {}
+        self.nodeCountDict = {}
+        self.userDayCountDict = {}
+        self._days = TimelineAccumulator()
+
+    def parse(self, osm_file):
+        """Parse an OSM xml document, updating the counts.
+
+        :param osm_file: A file object reading from a .osm file.
+        :type osm_file: file
+
+        :raises: xml.sax.SAXParseException if the document is not valid
+            xml, as xml.sax.parse does with OsmParser.
+        """
+        tag_name = self.tagName
+        way_count_dict = self.wayCountDict
+        node_count_dict = self.nodeCountDict
+        add_day = self._days.add
+        parser = expat.ParserCreate()
+        # The user, node count and whether the tag was found, of the way
+        # being parsed
+        user = None
+        node_count = 0
+        found = False
+
+        def outside_way(name, attributes):
+            nonlocal user, node_count, found
+            if name == 'way':
+                user = attributes.get('user')
+                # 2012-12-10T12:26:21Z
+                add_day(user, attributes.get('timestamp')[:10])
+                node_count = 0
+                found = False
+                parser.StartElementHandler = inside_way
+                parser.EndElementHandler = end_element
+
+        def inside_way(name, attributes):
+            nonlocal node_count, found
+            if name == 'nd':
+                node_count += 1
+            elif name == 'tag':
+                if attributes.get('k') == tag_name:
+                    found = True
+
+        def end_element(name):
+            if name == 'way':
+                if found:
+                    way_count_dict[user] = way_count_dict.get(user, 0) + 1
+                    node_count_dict[user] = (
+                        node_count_dict.get(user, 0) + node_count)
+                parser.StartElementHandler = outside_way
+                parser.EndElementHandler = None
+
+        parser.StartElementHandler = outside_way
+        try:
+            while True:
+                data = osm_file.read(PARSE_CHUNK_SIZE)
+                if not data:
+                    break
+                parser.Parse(data, False)
+            parser.Parse(b'', True)
+        except expat.ExpatError as e:
+            raise xml.sax.SAXParseException(
+                expat.ErrorString(e.code), e, _ExpatLocator(parser))
+
+        self.userDayCountDict = self._days.timelines()
+
+
+class OsmMultiTagParser(object):
+    """Count the contributions for several tags in a single pass.
+
+    For each tag the counts are those of OsmParser, except that the day
+    counts only include the ways having the tag (OsmParser counts every way
+    of the document, as each document used to hold a single feature).
+    """
+
+    def __init__(self, tag_names):
+        """Constructor for parser.
+
+        :param tag_names: Names of the osm tags to count e.g.
+            ['building', 'highway'].
+        :type tag_names: list
+
+        :returns: An OsmMultiTagParser, with wayCountDicts, nodeCountDicts
+            and userDayCountDicts holding the dicts of each tag, Timelines
+            for the days.
+        :rtype: OsmMultiTagParser
+        """
+        self.tagNames = frozenset(tag_names)
+        self.wayCountDicts = dict((name, {}) for name in self.tagNames)
+        self.nodeCountDicts = dict((name, {}) for name in self.tagNames)
+        self.userDayCountDicts = dict((name, {}) for name in self.tagNames)
+        self._days = dict(
+            (name, TimelineAccumulator()) for name in self.tagNames)
+
+    def parse(self, osm_file):
+        """Parse an OSM xml document, updating the counts.
+
+        :param osm_file: A file object reading from a .osm file.
+        :type osm_file: file
+
+        :raises: xml.sax.SAXParseException if the document is not valid
+            xml.
+        """
+        tag_names = self.tagNames
+        way_count_dicts = self.wayCountDicts
+        node_count_dicts = self.nodeCountDicts
+        days = self._days
+        parser = expat.ParserCreate()
+        # The user, day, node count and tags found, of the way being parsed
+        user = None
+        day = None
+        node_count = 0
+        found = set()
+
+        def outside_way(name, attributes):
+            nonlocal user, day, node_count
+            if name == 'way':
+                user = attributes.get('user')
+                # 2012-12-10T12:26:21Z
+                day = attributes.get('timestamp')[:10]
+                node_count = 0
+                found.clear()
+                parser.StartElementHandler = inside_way
+                parser.EndElementHandler = end_element
+
+        def inside_way(name, attributes):
+            nonlocal node_count
+            if name == 'nd':
+                node_count += 1
+            elif name == 'tag':
+                key = attributes.get('k')
+                if key in tag_names:
+                    found.add(key)
+
+        def end_element(name):
+            if name == 'way':
+                for tag_name in found:
+                    way_count_dict = way_count_dicts[tag_name]
+                    node_count_dict = node_count_dicts[tag_name]
+                    way_count_dict[user] = way_count_dict.get(user, 0) + 1
+                    node_count_dict[user] = (
+                        node_count_dict.get(user, 0) + node_count)
+                    days[tag_name].add(user, day)
+                parser.StartElementHandler = outside_way
+                parser.EndElementHandler = None
+
+        parser.StartElementHandler = outside_way
+        try:
+            while True:
+                data = osm_file.read(PARSE_CHUNK_SIZE)
+                if not data:
+                    break
+                parser.Parse(data, False)
+            parser.Parse(b'', True)
+        except expat.ExpatError as e:
+            raise xml.sax.SAXParseException(
+                expat.ErrorString(e.code), e, _ExpatLocator(parser))
+
+        for tag_name, accumulator in days.items():
+            self.userDayCountDicts[tag_name] = accumulator.timelines()
+
+
+class OsmWayStateParser(object):
+    """Collect the state of the tagged ways of a document or of a diff.
+
+    The state of a way is what the contribution counts need from it: its
+    last editor, the day of its last edit, its number of nodes and which
+    of the tags it has. Summing the states of the ways gives the counts of
+    OsmMultiTagParser, see way_state_counts.
+
+    Besides plain OSM documents, the diffs returned by Overpass for queries
+    with a [diff:...] setting are understood: the ways of delete actions
+    and the old versions of modify actions are recorded as removed.
+    """
+
+    def __init__(self, tag_names):
+        """Constructor for parser.
+
+        :param tag_names: Names of the osm tags to count e.g.
+            ['building', 'highway'].
+        :type tag_names: list
+
+        :returns: An OsmWayStateParser, with ways holding the
+            [user, day, node count, tag names] of the tagged ways by id,
+            removed holding the ids of the ways which were deleted or are
+            no longer tagged, and timestamp holding the date of the data
+            (the osm_base of Overpass).
+        :rtype: OsmWayStateParser
+        """
+        self.tagNames = frozenset(tag_names)
+        self.ways = {}
+        self.removed = set()
+        self.timestamp = None
+
+    def parse(self, osm_file):
+        """Parse an OSM xml document or diff, updating the states.
+
+        :param osm_file: A file object reading from a .osm file.
+        :type osm_file: file
+
+        :raises: xml.sax.SAXParseException if the document is not valid
+            xml.
+        """
+        tag_names = self.tagNames
+        ways = self.ways
+        removed = self.removed
+        parser = expat.ParserCreate()
+        # Whether the ways met are being deleted, and the way being parsed
+        deleting = False
+        skipped = 0
+        way_id = None
+        state = None
+
+        def start_element(name, attributes):
+            nonlocal deleting, skipped, way_id, state
+            if skipped:
+                skipped += 1
+            elif name == 'way':
+                way_id = attributes.get('id')
+                state = [
+                    attributes.get('user'),
+                    # 2012-12-10T12:26:21Z
+                    attributes.get('timestamp', '').split('T')[0],
+                    0,
+                    []]
+            elif state is not None:
+                if name == 'nd':
+                    state[2] += 1
+                elif name == 'tag':
+                    key = attributes.get('k')
+                    if key in tag_names and key not in state[3]:
+                        state[3].append(key)
+            elif name == 'action':
+                deleting = attributes.get('type') == 'delete'
+            elif name == 'old':
+                # The previous versions, replaced by the new ones
+                skipped = 1
+            elif name == 'meta':
+                self.timestamp = attributes.get('osm_base')
+
+        def end_element(name):
+            nonlocal deleting, skipped, way_id, state
+            if skipped:
+                skipped -= 1
+            elif name == 'action':
+                deleting = False
+            elif name == 'way':
+                if deleting or not state[3]:
+                    ways.pop(way_id, None)
+                    removed.add(way_id)
+                else:
+                    state[3].sort()
+                    ways[way_id] = state
+                    removed.discard(way_id)
+                way_id = None
+                state = None
+
+        parser.StartElementHandler = start_element
+        parser.EndElementHandler = end_element
+        try:
+            while True:
+                data = osm_file.read(PARSE_CHUNK_SIZE)
+                if not data:
+                    break
+                parser.Parse(data, False)
+            parser.Parse(b'', True)
+        except expat.ExpatError as e:
+            raise xml.sax.SAXParseException(
+                expat.ErrorString(e.code), e, _ExpatLocator(parser))
+
+
+def way_state_counts(ways, tag_names):
+    """Sum the states of ways into contribution counts.
+
+    :param ways: [user, day, node count, tag names] of the ways by id, as
+        collected by OsmWayStateParser.
+    :type ways: dict
+
+    :param tag_names: The tag names we want counts for.
+    :type tag_names: list
+
+    :returns: The way count dicts, node count dicts and timelines by tag
+        name, as in OsmMultiTagParser.
+    :rtype: (dict, dict, dict)
+    """
+    way_count_dicts = dict((name, {}) for name in tag_names)
+    node_count_dicts = dict((name, {}) for name in tag_names)
+    days = dict((name, TimelineAccumulator()) for name in tag_names)
+    for user, day, node_count, way_tags in ways.values():
+        for tag_name in way_tags:
+            if tag_name not in way_count_dicts:
+                continue
+            way_count_dict = way_count_dicts[tag_name]
+            node_count_dict = node_count_dicts[tag_name]
+            way_count_dict[user] = way_count_dict.get(user, 0) + 1
+            node_count_dict[user] = node_count_dict.get(user, 0) + node_count
+            days[tag_name].add(user, day)
+    timelines = dict(
+        (name, accumulator.timelines()) for name, accumulator in days.items())
+    return way_count_dicts, node_count_dicts, timelines
+
+
+class _ExpatLocator(object):
+    """Position of an expat parser, as needed by SAXParseException."""
+
+    def __init__(self, parser):
+        self.parser = parser
+
+    def getColumnNumber(self):
+        return self.parser.ErrorColumnNumber
+
+    def getLineNumber(self):
+        return self.parser.ErrorLineNumber
+
+    def getPublicId(self):
+        return None
+
+    def getSystemId(self):
+        return None
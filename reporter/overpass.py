@@ -0,0 +1,328 @@
+# coding=utf-8
+"""HTTP client for the Overpass API.
+:copyright: (c) 2013 by Tim Sutton
+:license: GPLv3, see LICENSE for more details.
+"""
+import random
+import threading
+import time
+from contextlib import contextmanager
+from http.client import HTTPConnection, HTTPSConnection, HTTPException
+from urllib.error import HTTPError, URLError
+from urllib.parse import urlsplit
+
+from reporter import config
+from reporter import LOGGER
+
+# Statuses worth trying again, the server or a proxy in front of it is
+# temporarily unavailable.
+RETRY_STATUSES = (502, 503, 504)
+
+# Weight of the latest request in the latency average of an endpoint
+LATENCY_WEIGHT = 0.3
+
+# Longest time an endpoint is avoided after consecutive failures
+MAX_COOLDOWN = 600
+
+# The client and endpoints built from the config, created on first use.
+_OVERPASS_CLIENT = None
+_OVERPASS_ENDPOINTS = None
+_OVERPASS_CLIENT_GUARD = threading.Lock()
+
+
+class OverpassClient(object):
+    """Thread safe pool of keep-alive HTTP connections to Overpass servers.
+
+    Connections are kept open between requests, up to pool_size idle
+    connections per server, so most requests skip the TCP (and TLS)
+    handshake. Requests failing because of the network or a 502, 503 or
+    504 response are retried with a jittered exponential backoff.
+    """
+
+    def __init__(self, pool_size=4, timeout=60, retries=2, retry_delay=1):
+        """Constructor.
+
+        :param pool_size: Maximum number of idle connections kept open to
+            each server.
+        :type pool_size: int
+
+        :param timeout: Seconds to wait for a connection or for data.
+        :type timeout: float
+
+        :param retries: How many times a failed request is tried again.
+        :type retries: int
+
+        :param retry_delay: Base delay in seconds before trying again, it
+            doubles after each attempt.
+        :type retry_delay: float
+        """
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self.retries = retries
+        self.retry_delay = retry_delay
+        # (scheme, netloc) -> idle connections, most recently used last
+        self._idle = {}
+        self._guard = threading.Lock()
+
+    @contextmanager
+    def get(self, url, headers=None):
+        """Send a GET request and give the response to read its body.
+
+        The connection goes back to the pool once the block has read the
+        whole body, otherwise it is closed.
+
+        :param url: The http or https URL to get.
+        :type url: str
+
+        :param headers: Extra request headers.
+        :type headers: dict
+
+        :returns: The response, with its body not read yet.
+        :rtype: HTTPResponse
+
+        :raises: HTTPError for 4xx and 5xx responses, URLError if the
+            server can't be reached, as urlopen does.
+        """
+        parts = urlsplit(url)
+        if parts.scheme not in ('http', 'https'):
+            raise ValueError('Unsupported URL scheme: %s' % url)
+        origin = (parts.scheme, parts.netloc)
+        target = parts.path or '/'
+        if parts.query:
+            target = '%s?%s' % (target, parts.query)
+
+        attempt = 0
+        while True:
+            connection, reused = self._acquire(origin)
+            try:
+                connection.request('GET', target, headers=headers or {})
+                response = connection.getresponse()
+            except (OSError, HTTPException) as e:
+                connection.close()
+                if reused:
+                    # The server closed the idle connection, not a failure.
+                    continue
+                if attempt >= self.retries:
+                    raise URLError(e)
+                LOGGER.info('Could not reach %s, retrying', parts.netloc)
+            else:
+                if response.status not in RETRY_STATUSES:
+                    break
+                if attempt >= self.retries:
+                    break
+                response.read()
+                self._release(origin, connection, response)
+                LOGGER.info('%s from %s, retrying', response.status, url)
+            self._backoff(attempt)
+            attempt += 1
+
+        if response.status >= 400:
+            connection.close()
+            raise HTTPError(
+                url, response.status, response.reason, response.headers,
+                response)
+        try:
+            yield response
+        except BaseException:
+            connection.close()
+            raise
+        self._release(origin, connection, response)
+
+    def close(self):
+        """Close the idle connections."""
+        with self._guard:
+            idle, self._idle = self._idle, {}
+        for connections in idle.values():
+            for connection in connections:
+                connection.close()
+
+    def _acquire(self, origin):
+        """Take an idle connection to a server, or open a new one.
+
+        :returns: A tuple (connection, whether it was used before).
+        :rtype: (HTTPConnection, bool)
+        """
+        with self._guard:
+            connections = self._idle.get(origin)
+            if connections:
+                return connections.pop(), True
+        scheme, netloc = origin
+        if scheme == 'https':
+            return HTTPSConnection(netloc, timeout=self.timeout), False
+        return HTTPConnection(netloc, timeout=self.timeout), False
+
+    def _release(self, origin, connection, response):
+        """Give a connection back to the pool if it can be used again."""
+        reusable = response.isclosed() and not response.will_close
+        if reusable:
+            with self._guard:
+                connections = self._idle.setdefault(origin, [])
+                if len(connections) < self.pool_size:
+                    connections.append(connection)
+                    return
+        connection.close()
+
+    def _backoff(self, attempt):
+        """Wait before trying a request again, with full jitter."""
+        time.sleep(random.uniform(0, self.retry_delay * 2 ** attempt))
+
+
+class OverpassEndpoint(object):
+    """Health of an Overpass server, as seen by this process.
+
+    The health is the average latency of the recent requests and the
+    number of consecutive failures. After a failure the endpoint is cooling
+    down for cooldown seconds, doubled after each consecutive failure.
+    At most slots queries run on the endpoint at once, to stay within the
+    quota Overpass servers give to each client.
+    """
+
+    def __init__(self, url, slots=2, cooldown=30):
+        """Constructor.
+
+        :param url: The URL of the interpreter, without query string.
+        :type url: str
+
+        :param slots: How many queries may run at once on this endpoint.
+        :type slots: int
+
+        :param cooldown: Seconds the endpoint is avoided after a failure.
+        :type cooldown: float
+        """
+        self.url = url
+        self.slots = slots
+        self.cooldown = cooldown
+        self.latency = 0.0
+        self.failures = 0
+        self.active = 0
+        self.cooling_until = 0
+        self._slots = threading.BoundedSemaphore(slots)
+        self._guard = threading.Lock()
+
+    def sort_key(self, now):
+        """Order endpoints from the healthiest to the least healthy.
+
+        Endpoints cooling down come last, then the ones with all their slots
+        in use, the others are sorted by latency.
+
+        :param now: The current time in unix epoch.
+        :type now: float
+
+        :rtype: tuple
+        """
+        with self._guard:
+            return (
+                now < self.cooling_until,
+                self.active >= self.slots,
+                self.latency * (1 + self.failures))
+
+    @contextmanager
+    def slot(self):
+        """Hold a slot of the endpoint, waiting for one if needed."""
+        with self._guard:
+            self.active += 1
+        try:
+            with self._slots:
+                yield
+        finally:
+            with self._guard:
+                self.active -= 1
+
+    def succeeded(self, seconds):
+        """Record a successful request.
+
+        :param seconds: How long the request took.
+        :type seconds: float
+        """
+        with self._guard:
+            if self.latency:
+                self.latency += LATENCY_WEIGHT * (seconds - self.latency)
+            else:
+                self.latency = seconds
+            self.failures = 0
+            self.cooling_until = 0
+
+    def failed(self):
+        """Record a failed request and start cooling down."""
+        with self._guard:
+            self.failures += 1
+            cooldown = min(
+                self.cooldown * 2 ** (self.failures - 1), MAX_COOLDOWN)
+            self.cooling_until = time.time() + cooldown
+
+
+class OverpassEndpoints(object):
+    """Overpass servers able to answer the same queries."""
+
+    def __init__(self, urls, slots=2, cooldown=30):
+        """Constructor.
+
+        :param urls: The URLs of the interpreters, the preferred one first.
+        :type urls: list
+
+        :param slots: How many queries may run at once on each endpoint.
+        :type slots: int
+
+        :param cooldown: Seconds an endpoint is avoided after a failure.
+        :type cooldown: float
+        """
+        self.slots = slots
+        self.cooldown = cooldown
+        self.endpoints = [
+            OverpassEndpoint(url, slots, cooldown) for url in urls]
+
+    def candidates(self, url):
+        """Get the endpoints to try for a query, the healthiest first.
+
+        :param url: The URL of the query on any of the endpoints.
+        :type url: str
+
+        :returns: (endpoint, url of the query on it) pairs. If url is not
+            on a known endpoint it is the only candidate.
+        :rtype: list
+        """
+        base, separator, query = url.partition('?')
+        known = [endpoint.url for endpoint in self.endpoints]
+        if base not in known:
+            endpoint = OverpassEndpoint(base, self.slots, self.cooldown)
+            return [(endpoint, url)]
+        now = time.time()
+        # sorted is stable, ties keep the configured order
+        endpoints = sorted(
+            self.endpoints, key=lambda endpoint: endpoint.sort_key(now))
+        return [
+            (endpoint, endpoint.url + separator + query)
+            for endpoint in endpoints]
+
+
+def overpass_client():
+    """Get the HTTP client configured for Overpass.
+
+    :returns: The shared client.
+    :rtype: OverpassClient
+    """
+    global _OVERPASS_CLIENT
+    with _OVERPASS_CLIENT_GUARD:
+        if _OVERPASS_CLIENT is None:
+            _OVERPASS_CLIENT = OverpassClient(
+                pool_size=config.OVERPASS_POOL_SIZE,
+                timeout=config.OVERPASS_TIMEOUT,
+                retries=config.OVERPASS_HTTP_RETRIES,
+                retry_delay=config.OVERPASS_RETRY_DELAY)
+    return _OVERPASS_CLIENT
+
+
+def overpass_endpoints():
+    """Get the Overpass servers from the config.
+
+    :returns: The shared endpoints, with their health.
+    :rtype: OverpassEndpoints
+    """
+    global _OVERPASS_ENDPOINTS
+    with _OVERPASS_CLIENT_GUARD:
+        if _OVERPASS_ENDPOINTS is None:
+            _OVERPASS_ENDPOINTS = OverpassEndpoints(
+                config.OVERPASS_SERVER_URLS,
+                slots=config.OVERPASS_SERVER_SLOTS,
+                cooldown=config.OVERPASS_SERVER_COOLDOWN)
+    return _OVERPASS_ENDPOINTS
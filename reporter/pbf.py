@@ -0,0 +1,528 @@
+# coding=utf-8
+"""Module for reading OSM PBF files without external dependencies.
+
+A PBF file is a sequence of blobs, each holding a zlib compressed block of
+up to 8000 nodes, ways or relations encoded with protocol buffers (see
+https://wiki.openstreetmap.org/wiki/PBF_Format). The blocks are decoded
+independently, so the contribution statistics are computed in a pool of
+processes shared by the requests, each decompressing and decoding whole
+blocks, see reporter.process_pool.
+
+:copyright: (c) 2013 by Tim Sutton
+:license: GPLv3, see LICENSE for more details.
+"""
+import lzma
+import os
+import struct
+import zlib
+from collections import deque
+from concurrent.futures.process import BrokenProcessPool
+
+from reporter import config
+from reporter.process_pool import discard_process_pool, shared_process_pool
+from reporter.timeline import EPOCH_ORDINAL, Timeline
+
+# Features a file may require which this reader understands
+SUPPORTED_FEATURES = frozenset(['OsmSchema-V0.6', 'DenseNodes'])
+
+# Blocks queued per process by a request, bounding the memory it uses
+BLOCKS_PER_PROCESS = 4
+
+# Name of the pool decoding the blocks, see shared_process_pool
+POOL_NAME = 'pbf'
+
+
+def is_pbf(file_path):
+    """Check whether a file is an OSM PBF file, from its name.
+
+    :param file_path: Path of the OSM file, None if unknown.
+    :type file_path: str
+
+    :rtype: bool
+    """
+    return isinstance(file_path, str) and file_path.endswith('.pbf')
+
+
+def read_blobs(file_path):
+    """Iterate over the data blobs of a PBF file.
+
+    The header blob is checked but not returned.
+
+    :param file_path: Path of the PBF file.
+    :type file_path: str
+
+    :returns: The encoded blobs, still compressed.
+    :rtype: iterator
+
+    :raises: ValueError if the file requires unsupported features.
+    """
+    with open(file_path, 'rb') as pbf_file:
+        while True:
+            size = pbf_file.read(4)
+            if not size:
+                return
+            header = pbf_file.read(struct.unpack('!i', size)[0])
+            blob_type = None
+            data_size = 0
+            for field, _, value in _fields(header):
+                if field == 1:
+                    blob_type = value.decode('utf-8')
+                elif field == 3:
+                    data_size = value
+            blob = pbf_file.read(data_size)
+            if blob_type == 'OSMHeader':
+                _check_header(decompress_blob(blob))
+            elif blob_type == 'OSMData':
+                yield blob
+
+
+def decompress_blob(blob):
+    """Get the block held by a blob.
+
+    :param blob: An encoded Blob message.
+    :type blob: bytes
+
+    :returns: The encoded block.
+    :rtype: bytes
+    """
+    for field, _, value in _fields(blob):
+        if field == 1:
+            return value
+        elif field == 3:
+            return zlib.decompress(value)
+        elif field == 4:
+            return lzma.decompress(value)
+    raise ValueError('Unsupported PBF blob compression')
+
+
+class PrimitiveBlock(object):
+    """A decoded PrimitiveBlock: its string table and groups."""
+
+    def __init__(self, data):
+        """Constructor.
+
+        :param data: An encoded PrimitiveBlock message.
+        :type data: bytes
+        """
+        self.strings = []
+        self.groups = []
+        self.granularity = 100
+        self.lat_offset = 0
+        self.lon_offset = 0
+        self.date_granularity = 1000
+        for field, _, value in _fields(data):
+            if field == 1:
+                self.strings = [
+                    string.decode('utf-8')
+                    for string_field, _, string in _fields(value)
+                    if string_field == 1]
+            elif field == 2:
+                self.groups.append(value)
+            elif field == 17:
+                self.granularity = value
+            elif field == 19:
+                self.lat_offset = value
+            elif field == 20:
+                self.lon_offset = value
+            elif field == 18:
+                self.date_granularity = value
+
+    def nodes(self):
+        """Iterate over the nodes of the block.
+
+        :returns: (id, lat, lon, user, timestamp in seconds) tuples.
+        :rtype: iterator
+        """
+        granularity = self.granularity * 1e-9
+        lat_offset = self.lat_offset * 1e-9
+        lon_offset = self.lon_offset * 1e-9
+        for group in self.groups:
+            for field, _, value in _fields(group):
+                if field == 1:
+                    node_id, lat, lon, info = 0, 0, 0, None
+                    for node_field, _, node_value in _fields(value):
+                        if node_field == 1:
+                            node_id = _zigzag(node_value)
+                        elif node_field == 4:
+                            info = node_value
+                        elif node_field == 8:
+                            lat = _zigzag(node_value)
+                        elif node_field == 9:
+                            lon = _zigzag(node_value)
+                    user, timestamp = self._info(info)
+                    yield (
+                        node_id,
+                        lat_offset + granularity * lat,
+                        lon_offset + granularity * lon,
+                        user,
+                        timestamp)
+                elif field == 2:
+                    for node in self._dense_nodes(value):
+                        yield node
+
+    def ways(self):
+        """Iterate over the ways of the block.
+
+        :returns: (id, tags, node ids, user, timestamp in seconds) tuples.
+        :rtype: iterator
+        """
+        strings = self.strings
+        for group in self.groups:
+            for field, _, value in _fields(group):
+                if field != 3:
+                    continue
+                way_id, keys, values, refs, info = 0, [], [], [], None
+                for way_field, _, way_value in _fields(value):
+                    if way_field == 1:
+                        way_id = way_value
+                    elif way_field == 2:
+                        keys = _packed(way_value)
+                    elif way_field == 3:
+                        values = _packed(way_value)
+                    elif way_field == 4:
+                        info = way_value
+                    elif way_field == 8:
+                        refs = _deltas(_packed(way_value, signed=True))
+                tags = dict(
+                    (strings[key], strings[value])
+                    for key, value in zip(keys, values))
+                user, timestamp = self._info(info)
+                yield way_id, tags, refs, user, timestamp
+
+    def relations(self):
+        """Iterate over the relations of the block, without their members.
+
+        :returns: (id, tags) tuples.
+        :rtype: iterator
+        """
+        strings = self.strings
+        for group in self.groups:
+            for field, _, value in _fields(group):
+                if field != 4:
+                    continue
+                relation_id, keys, values = 0, [], []
+                for relation_field, _, relation_value in _fields(value):
+                    if relation_field == 1:
+                        relation_id = relation_value
+                    elif relation_field == 2:
+                        keys = _packed(relation_value)
+                    elif relation_field == 3:
+                        values = _packed(relation_value)
+                yield relation_id, dict(
+                    (strings[key], strings[value])
+                    for key, value in zip(keys, values))
+
+    def _info(self, info):
+        """Decode an Info message into (user, timestamp in seconds)."""
+        if info is None:
+            return None, 0
+        timestamp = 0
+        user_sid = 0
+        for field, _, value in _fields(info):
+            if field == 2:
+                timestamp = value
+            elif field == 5:
+                user_sid = value
+        seconds = timestamp * self.date_granularity / 1000.
+        return self.strings[user_sid], seconds
+
+    def _dense_nodes(self, dense):
+        """Decode a DenseNodes message, see nodes."""
+        ids, lats, lons = [], [], []
+        timestamps, user_sids = [], []
+        for field, _, value in _fields(dense):
+            if field == 1:
+                ids = _deltas(_packed(value, signed=True))
+            elif field == 8:
+                lats = _deltas(_packed(value, signed=True))
+            elif field == 9:
+                lons = _deltas(_packed(value, signed=True))
+            elif field == 5:
+                for info_field, _, info_value in _fields(value):
+                    if info_field == 2:
+                        timestamps = _deltas(
+                            _packed(info_value, signed=True))
+                    elif info_field == 5:
+                        user_sids = _deltas(
+                            _packed(info_value, signed=True))
+        strings = self.strings
+        granularity = self.granularity * 1e-9
+        lat_offset = self.lat_offset * 1e-9
+        lon_offset = self.lon_offset * 1e-9
+        seconds = self.date_granularity / 1000.
+        if not timestamps:
+            timestamps = [0] * len(ids)
+            user_sids = [0] * len(ids)
+        for node_id, lat, lon, timestamp, user_sid in zip(
+                ids, lats, lons, timestamps, user_sids):
+            yield (
+                node_id,
+                lat_offset + granularity * lat,
+                lon_offset + granularity * lon,
+                strings[user_sid],
+                timestamp * seconds)
+
+
+def pbf_contributions(file_path, tag_names, coordinates=None):
+    """Count the contributions for several tags in a PBF file.
+
+    The counts are those of OsmMultiTagParser. With coordinates, only the
+    ways with at least one node inside the bbox are counted, which takes a
+    first pass over the nodes.
+
+    :param file_path: Path of the PBF file.
+    :type file_path: str
+
+    :param tag_names: Names of the osm tags to count.
+    :type tag_names: list
+
+    :param coordinates: Coordinates as returned by split_bbox, or None for
+        the whole file.
+    :type coordinates: dict
+
+    :returns: A tuple of dicts by tag name: (way counts by user, node
+        counts by user, Timelines by user).
+    :rtype: tuple
+    """
+    inside = None
+    if coordinates is not None:
+        inside = set()
+        for node_ids in _map_blocks(
+                _block_nodes_inside, file_path, (coordinates,)):
+            inside.update(node_ids)
+
+    way_count_dicts = dict((name, {}) for name in tag_names)
+    node_count_dicts = dict((name, {}) for name in tag_names)
+    day_counts = {}
+    # The nodes inside the bbox may be millions, they are not sent to the
+    # processes, which return the nodes of the ways to check them here.
+    for ways in _map_blocks(
+            _block_tagged_ways,
+            file_path,
+            (frozenset(tag_names), inside is not None)):
+        for found, refs, user, day in ways:
+            if inside is None:
+                node_count = refs
+            elif inside.isdisjoint(refs):
+                continue
+            else:
+                node_count = len(refs)
+            for tag_name in found:
+                counts = way_count_dicts[tag_name]
+                counts[user] = counts.get(user, 0) + 1
+                counts = node_count_dicts[tag_name]
+                counts[user] = counts.get(user, 0) + node_count
+                key = (tag_name, user, day)
+                day_counts[key] = day_counts.get(key, 0) + 1
+
+    timelines = dict((name, {}) for name in tag_names)
+    for (tag_name, user, day), count in day_counts.items():
+        timelines[tag_name].setdefault(user, {})[day] = count
+    user_day_count_dicts = dict(
+        (name, dict((user, Timeline(counts))
+                    for user, counts in tag_timelines.items()))
+        for name, tag_timelines in timelines.items())
+    return way_count_dicts, node_count_dicts, user_day_count_dicts
+
+
+def pbf_nodes_by_user(file_path, username, coordinates=None):
+    """Get the nodes of a user in a PBF file, like OsmNodeParser.
+
+    :param file_path: Path of the PBF file.
+    :type file_path: str
+
+    :param username: The name of the user.
+    :type username: str
+
+    :param coordinates: Coordinates as returned by split_bbox, or None for
+        the whole file.
+    :type coordinates: dict
+
+    :returns: The (lat, lon) of the nodes, in the order of the file.
+    :rtype: list
+    """
+    nodes = []
+    for block_nodes in _map_blocks(
+            _block_nodes_by_user, file_path, (username, coordinates)):
+        nodes.extend(block_nodes)
+    return nodes
+
+
+def _map_blocks(function, file_path, arguments):
+    """Apply a function to each block of a file, in a pool of processes.
+
+    The results are returned in the order of the blocks. Only a few blocks
+    per process are read ahead.
+
+    :param function: Called with the decoded block, then arguments.
+    :type function: callable
+
+    :param file_path: Path of the PBF file.
+    :type file_path: str
+
+    :param arguments: Extra arguments, shared by all the calls and sent
+        with each block, so they should be small.
+    :type arguments: tuple
+
+    :returns: The results of the calls.
+    :rtype: iterator
+    """
+    processes = config.PBF_PROCESSES or os.cpu_count() or 1
+    blobs = read_blobs(file_path)
+    if processes == 1:
+        for blob in blobs:
+            yield _decode_block(blob, function, arguments)
+        return
+
+    pool = shared_process_pool(POOL_NAME, processes)
+    pending = deque()
+    try:
+        for blob in blobs:
+            pending.append(
+                pool.submit(_decode_block, blob, function, arguments))
+            if len(pending) >= processes * BLOCKS_PER_PROCESS:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+    except BrokenProcessPool:
+        discard_process_pool(POOL_NAME, pool)
+        raise
+    finally:
+        # The pool is shared, don't leave it work nobody waits for.
+        for future in pending:
+            future.cancel()
+
+
+def _decode_block(blob, function, arguments):
+    """Decode a blob and apply a function to it, see _map_blocks."""
+    block = PrimitiveBlock(decompress_blob(blob))
+    return function(block, *arguments)
+
+
+def _block_nodes_inside(block, coordinates):
+    """Get the ids of the nodes of a block inside a bbox."""
+    min_lat = coordinates['SW_lat']
+    max_lat = coordinates['NE_lat']
+    min_lng = coordinates['SW_lng']
+    max_lng = coordinates['NE_lng']
+    return [
+        node_id
+        for node_id, lat, lng, _, _ in block.nodes()
+        if min_lat <= lat <= max_lat and min_lng <= lng <= max_lng]
+
+
+def _block_tagged_ways(block, tag_names, with_refs):
+    """Get the ways of a block with some tags, see pbf_contributions.
+
+    :returns: The (tags found, node ids or their number if not with_refs,
+        user, day) of the ways.
+    :rtype: list
+    """
+    ways = []
+    for _, tags, refs, user, timestamp in block.ways():
+        found = tag_names.intersection(tags)
+        if not found:
+            continue
+        day = int(timestamp // 86400) + EPOCH_ORDINAL
+        ways.append((
+            tuple(found), refs if with_refs else len(refs), user, day))
+    return ways
+
+
+def _block_nodes_by_user(block, username, coordinates):
+    """Get the nodes of a user in a block, see pbf_nodes_by_user."""
+    nodes = [
+        (lat, lng)
+        for _, lat, lng, user, _ in block.nodes()
+        if user == username]
+    if coordinates is None:
+        return nodes
+    min_lat = coordinates['SW_lat']
+    max_lat = coordinates['NE_lat']
+    min_lng = coordinates['SW_lng']
+    max_lng = coordinates['NE_lng']
+    return [
+        (lat, lng) for lat, lng in nodes
+        if min_lat <= lat <= max_lat and min_lng <= lng <= max_lng]
+
+
+def _check_header(data):
+    """Check the features required by a HeaderBlock are supported."""
+    for field, _, value in _fields(data):
+        if field == 4:
+            feature = value.decode('utf-8')
+            if feature not in SUPPORTED_FEATURES:
+                raise ValueError('Unsupported PBF feature: %s' % feature)
+
+
+def _fields(data):
+    """Iterate over the fields of an encoded protocol buffers message.
+
+    :param data: The encoded message.
+    :type data: bytes
+
+    :returns: (field number, wire type, value) tuples. Values are ints
+        for varints and fixed numbers, bytes for length delimited fields.
+    :rtype: iterator
+    """
+    position = 0
+    end = len(data)
+    while position < end:
+        key, position = _varint(data, position)
+        wire_type = key & 7
+        if wire_type == 0:
+            value, position = _varint(data, position)
+        elif wire_type == 2:
+            size, position = _varint(data, position)
+            value = data[position:position + size]
+            position += size
+        elif wire_type == 1:
+            value = struct.unpack_from('<q', data, position)[0]
+            position += 8
+        elif wire_type == 5:
+            value = struct.unpack_from('<i', data, position)[0]
+            position += 4
+        else:
+            raise ValueError('Unsupported wire type %s' % wire_type)
+        yield key >> 3, wire_type, value
+
+
+def _varint(data, position):
+    """Decode the varint at position, returning it and the next position."""
+    result = 0
+    shift = 0
+    while True:
+        byte = data[position]
+        position += 1
+        result |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return result, position
+        shift += 7
+
+
+def _packed(data, signed=False):
+    """Decode packed varints, zigzag encoded if signed."""
+    values = []
+    position = 0
+    end = len(data)
+    while position < end:
+        value, position = _varint(data, position)
+        if signed:
+            value = (value >> 1) ^ -(value & 1)
+        values.append(value)
+    return values
+
+
+def _deltas(values):
+    """Undo the delta coding of a list of numbers."""
+    total = 0
+    result = []
+    for value in values:
+        total += value
+        result.append(total)
+    return result
+
+
+def _zigzag(value):
+    """Decode a zigzag encoded number."""
+    return (value >> 1) ^ -(value & 1)
@@ -0,0 +1,218 @@
+# coding=utf-8
+"""Module for the scratch PostGIS databases of the shapefile exports.
+
+Each export imports an OSM document in a database with osm2pgsql and
+extracts a shapefile from it. Creating a database from template_postgis
+takes seconds and a lock on the whole cluster, so the exports use a pool
+of config.POSTGIS_POOL_SIZE databases instead, created once and leased
+one export at a time. osm2pgsql replaces the tables it imports, so between
+two exports the tables are only truncated to give their space back.
+
+A database is leased by the threads of a process one at a time, and by
+holding an exclusive lock on a lock file in the cache directory, so the
+pool is shared by the processes of a host too, and its size caps the
+number of concurrent imports.
+
+:copyright: (c) 2013 by Tim Sutton
+:license: GPLv3, see LICENSE for more details.
+"""
+import os
+import threading
+import time
+from contextlib import contextmanager
+from subprocess import call, check_output, CalledProcessError
+
+try:
+    # pylint: disable=F0401
+    import fcntl
+    # pylint: enable=F0401
+except ImportError:
+    # Not available on Windows, the pool is not shared between processes
+    # there.
+    fcntl = None
+
+from reporter import config
+from reporter import LOGGER
+from reporter.utilities import which
+
+# Seconds between two attempts to lease a database when all are leased
+LEASE_POLL_INTERVAL = 0.5
+
+# Empty the tables left by an import, keeping the database.
+RESET_SQL = (
+    "DO $$ DECLARE name text; BEGIN "
+    "FOR name IN SELECT tablename FROM pg_tables "
+    "WHERE schemaname = 'public' AND tablename LIKE 'planet_osm%' LOOP "
+    "EXECUTE 'TRUNCATE ' || quote_ident(name); "
+    "END LOOP; END $$;")
+
+# Databases of the pool known to exist, in this process
+_PROVISIONED = set()
+_PROVISIONED_GUARD = threading.Lock()
+
+# Databases of the pool leased by the threads of this process
+_LEASED = set()
+_LEASED_GUARD = threading.Lock()
+
+
+def pool_database_names():
+    """Get the names of the databases of the pool.
+
+    :returns: config.POSTGIS_POOL_SIZE names built from
+        config.POSTGIS_POOL_PREFIX.
+    :rtype: list
+    """
+    return [
+        '%s_%s' % (config.POSTGIS_POOL_PREFIX, index)
+        for index in range(config.POSTGIS_POOL_SIZE)]
+
+
+@contextmanager
+def leased_database(db_name):
+    """Lease a scratch database for an import.
+
+    :param db_name: Name of the database created from template_postgis, and
+        dropped afterwards, when there is no pool (config.POSTGIS_POOL_SIZE
+        is 0).
+    :type db_name: str
+
+    :returns: The name of a database only used by the caller until the
+        context is left.
+    :rtype: str
+    """
+    if not config.POSTGIS_POOL_SIZE:
+        create_database(db_name)
+        try:
+            yield db_name
+        finally:
+            drop_database(db_name)
+        return
+
+    db_name, lock_file = _lease()
+    try:
+        _provision(db_name)
+        yield db_name
+    finally:
+        try:
+            reset_database(db_name)
+        finally:
+            _release(db_name, lock_file)
+
+
+def create_database(db_name):
+    """Create a database from template_postgis.
+
+    :param db_name: The database
+    :type db_name: str
+    """
+    createdb_executable = which('createdb')[0]
+    createdb_command = '%s -T template_postgis %s' % (
+        createdb_executable, db_name)
+    LOGGER.info(createdb_command)
+    call(createdb_command, shell=True)
+
+
+def drop_database(db_name):
+    """Remove a database.
+
+    :param db_name: The database
+    :type db_name: str
+    """
+    dropdb_executable = which('dropdb')[0]
+    dropdb_command = '%s %s' % (dropdb_executable, db_name)
+    LOGGER.info(dropdb_command)
+    call(dropdb_command, shell=True)
+
+
+def reset_database(db_name):
+    """Empty the tables imported in a database of the pool.
+
+    :param db_name: The database
+    :type db_name: str
+    """
+    # Not through a shell, which would expand the $$ of the sql
+    reset_command = [which('psql')[0], db_name, '-c', RESET_SQL]
+    LOGGER.info(' '.join(reset_command))
+    call(reset_command)
+
+
+def database_exists(db_name):
+    """Check whether a database exists.
+
+    :param db_name: The database
+    :type db_name: str
+
+    :rtype: bool
+    """
+    query_command = [
+        which('psql')[0], '-d', 'postgres', '-tAc',
+        "SELECT 1 FROM pg_database WHERE datname = '%s'" % db_name]
+    try:
+        output = check_output(query_command)
+    except CalledProcessError:
+        LOGGER.exception('Failed to list the databases')
+        return False
+    return output.strip() == b'1'
+
+
+def _provision(db_name):
+    """Create a leased database of the pool if it does not exist yet."""
+    with _PROVISIONED_GUARD:
+        if db_name in _PROVISIONED:
+            return
+    if not database_exists(db_name):
+        create_database(db_name)
+    with _PROVISIONED_GUARD:
+        _PROVISIONED.add(db_name)
+
+
+def _lease():
+    """Wait for a database of the pool which is not leased and lease it.
+
+    :returns: The name of the database, and the file holding the lease,
+        which is released when the file is closed.
+    :rtype: (str, file)
+    """
+    names = pool_database_names()
+    if not os.path.exists(config.CACHE_DIR):
+        os.makedirs(config.CACHE_DIR)
+    while True:
+        for db_name in names:
+            with _LEASED_GUARD:
+                if db_name in _LEASED:
+                    continue
+                _LEASED.add(db_name)
+            lock_file = None
+            try:
+                lock_path = os.path.join(
+                    config.CACHE_DIR, '%s.lock' % db_name)
+                lock_file = open(lock_path, 'a')
+                if fcntl is not None:
+                    fcntl.flock(
+                        lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                # Leased by another process
+                _release(db_name, lock_file)
+                continue
+            except BaseException:
+                _release(db_name, lock_file)
+                raise
+            return db_name, lock_file
+        time.sleep(LEASE_POLL_INTERVAL)
+
+
+def _release(db_name, lock_file):
+    """Release a database leased by _lease.
+
+    :param db_name: The database.
+    :type db_name: str
+
+    :param lock_file: The file holding the lease, closed.
+    :type lock_file: file
+    """
+    try:
+        if lock_file is not None:
+            lock_file.close()
+    finally:
+        with _LEASED_GUARD:
+            _LEASED.discard(db_name)
@@ -0,0 +1,71 @@
+# coding=utf-8
+"""Module for the process pools parsing big OSM files.
+
+The pools are created once per web server process and shared by its
+requests, rather than started by each request. Their processes are not
+forked from the server, whose other threads may hold locks (such as the
+one of the logging module) which would never be released in the child:
+they are started by a fork server, or spawned where there is none.
+
+:copyright: (c) 2013 by Tim Sutton
+:license: GPLv3, see LICENSE for more details.
+"""
+import multiprocessing
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+# Name -> (number of processes, pool), see shared_process_pool
+_POOLS = {}
+_POOLS_GUARD = threading.Lock()
+
+
+def pool_context():
+    """Get the multiprocessing context starting the processes of the pools.
+
+    :returns: The forkserver context, or the spawn one where there is no
+        fork server (Windows).
+    :rtype: multiprocessing.context.BaseContext
+    """
+    if 'forkserver' in multiprocessing.get_all_start_methods():
+        return multiprocessing.get_context('forkserver')
+    return multiprocessing.get_context('spawn')
+
+
+def shared_process_pool(name, processes):
+    """Get the process pool of a kind of work, created on first use.
+
+    :param name: What the pool is used for.
+    :type name: str
+
+    :param processes: Number of processes of the pool. A pool of another
+        size is replaced.
+    :type processes: int
+
+    :returns: The pool, shared by all the threads of this process.
+    :rtype: ProcessPoolExecutor
+    """
+    with _POOLS_GUARD:
+        size, pool = _POOLS.get(name, (None, None))
+        if size == processes:
+            return pool
+        if pool is not None:
+            pool.shutdown(wait=False)
+        pool = ProcessPoolExecutor(
+            max_workers=processes, mp_context=pool_context())
+        _POOLS[name] = (processes, pool)
+        return pool
+
+
+def discard_process_pool(name, pool):
+    """Forget a pool which broke, so that the next use creates another one.
+
+    :param name: What the pool is used for.
+    :type name: str
+
+    :param pool: The broken pool.
+    :type pool: ProcessPoolExecutor
+    """
+    with _POOLS_GUARD:
+        if _POOLS.get(name, (None, None))[1] is pool:
+            del _POOLS[name]
+    pool.shutdown(wait=False)
@@ -246,6 +246,28 @@ BOUNDARY_11_OVERPASS_QUERY = (
     '(._;>;);'
     'out {print_mode};')
 
+# The Overpass filter of the ways counted for each tag of the home page
+TAG_FILTERS = {
+    'highway': '["highway"]',
+    'building': '["building"]',
+    'evacuation_center': '["evacuation_center"="yes"]',
+    'flood_prone': '["flood_prone"="yes"]'
+}
+
+# The ways of all the tags of the home page, to count the contributions
+# for every tag from a single document. Nodes are left out as only the
+# ways are counted.
+CONTRIBUTIONS_OVERPASS_QUERY = '({features})->.features;{members}'.format(
+    features=''.join(
+        'way{tag_filter}({{SW_lat}},{{SW_lng}},{{NE_lat}},{{NE_lng}});'
+        'relation{tag_filter}({{SW_lat}},{{SW_lng}},{{NE_lat}},{{NE_lng}});'
+        .format(tag_filter=tag_filter)
+        for _, tag_filter in sorted(TAG_FILTERS.items())),
+    members='(way.features;way(r.features););out {print_mode};')
+
+# Features whose documents hold ways without their nodes
+WAYS_ONLY_FEATURES = ['contributions']
+
 OVERPASS_QUERY_MAP = {
     'potential-idp': POTENTIAL_IDP_OVERPASS_QUERY,
     'evacuation-centers': EVACUATION_CENTERS_OVERPASS_QUERY,
@@ -264,6 +286,7 @@ OVERPASS_QUERY_MAP = {
     'boundary-9': BOUNDARY_9_OVERPASS_QUERY,
     'boundary-10': BOUNDARY_10_OVERPASS_QUERY,
     'boundary-11': BOUNDARY_11_OVERPASS_QUERY,
+    'contributions': CONTRIBUTIONS_OVERPASS_QUERY,
 }
 
 # Used to extract the features as a shapefile from pg
@@ -24,50 +24,36 @@ FROM planet_osm_point;
 -- Add type column
 ALTER TABLE evacuation_center ADD COLUMN "type" VARCHAR(255) NULL;
 
-UPDATE evacuation_center SET "type" = 'School' WHERE amenity  ILIKE
-'%school%' OR amenity  ILIKE '%kindergarten%';
-
-UPDATE evacuation_center SET "type" = 'University/College' WHERE
-amenity  ILIKE '%university%' OR amenity  ILIKE '%college%';
-
-UPDATE evacuation_center SET "type" = 'Hospital' WHERE amenity  ILIKE
-'%hospital%';
-
-UPDATE evacuation_center SET "type" = 'Bank' WHERE amenity  ILIKE
-'%bank%';
-
-UPDATE evacuation_center SET "type" = 'Clinic' WHERE amenity  ILIKE
-'%clinic%';
-
-UPDATE evacuation_center SET "type" = 'Public Building' WHERE
-building  ILIKE '%public%' OR office ILIKE '%government%';
-
-UPDATE evacuation_center SET "type" = 'Place of Worship - Islam'
-where amenity  ILIKE '%worship%' and (religion  ILIKE '%islam'
-or religion  ILIKE '%muslim%');
-
-UPDATE evacuation_center SET "type" = 'Place of Worship - Unitarian'
-where amenity  ILIKE '%worship%' and religion  ILIKE '%unitarian%';
-
-UPDATE evacuation_center SET "type" = 'Place of Worship - Buddhist' WHERE
-amenity  ILIKE '%worship%' and religion  ILIKE '%budd%';
-
--- run near the end
-
-UPDATE evacuation_center SET "type" = 'School' WHERE
-  "building_use" = 'education' AND "type" IS NULL ;
-
-UPDATE evacuation_center SET "type" = 'Place of Worship' WHERE
-  "building_use" = 'place_of_worship' AND "type" IS NULL ;
-
-UPDATE evacuation_center SET "type" = 'Place of Worship' WHERE
-  amenity = 'place_of_worship' AND "type" IS NULL ;
-
-UPDATE evacuation_center SET "type" = 'School' WHERE
-  "building_use" = 'school' AND "type" IS NULL ;
-
-UPDATE evacuation_center SET "type" = 'Hospital' WHERE
-  "building_use" = 'hospital' AND "type" IS NULL ;
-
--- By default
-UPDATE evacuation_center SET "type" = 'Other' WHERE "type" IS NULL ;
\ No newline at end of file
+-- Classify in a single pass over the table. The first matching category
+-- wins: categories found from amenity, building, office and religion come
+-- first, the most specific last, then the ones only found from
+-- building_use.
+
+UPDATE evacuation_center SET "type" = CASE
+  WHEN amenity ILIKE '%worship%' AND religion ILIKE '%budd%'
+    THEN 'Place of Worship - Buddhist'
+  WHEN amenity ILIKE '%worship%' AND religion ILIKE '%unitarian%'
+    THEN 'Place of Worship - Unitarian'
+  WHEN amenity ILIKE '%worship%'
+    AND (religion ILIKE '%islam' OR religion ILIKE '%muslim%')
+    THEN 'Place of Worship - Islam'
+  WHEN building ILIKE '%public%' OR office ILIKE '%government%'
+    THEN 'Public Building'
+  WHEN amenity ILIKE '%clinic%'
+    THEN 'Clinic'
+  WHEN amenity ILIKE '%bank%'
+    THEN 'Bank'
+  WHEN amenity ILIKE '%hospital%'
+    THEN 'Hospital'
+  WHEN amenity ILIKE '%university%' OR amenity ILIKE '%college%'
+    THEN 'University/College'
+  WHEN amenity ILIKE '%school%' OR amenity ILIKE '%kindergarten%'
+    THEN 'School'
+  WHEN "building_use" = 'education' THEN 'School'
+  WHEN "building_use" = 'place_of_worship' THEN 'Place of Worship'
+  WHEN amenity = 'place_of_worship' THEN 'Place of Worship'
+  WHEN "building_use" = 'school' THEN 'School'
+  WHEN "building_use" = 'hospital' THEN 'Hospital'
+  -- By default
+  ELSE 'Other'
+END;
@@ -22,41 +22,29 @@ FROM planet_osm_point;
 -- Add type column
 ALTER TABLE idp ADD COLUMN "type" VARCHAR(255) NULL;
 
-UPDATE idp SET "type" = 'School' WHERE amenity  ILIKE
-'%school%' OR amenity  ILIKE '%kindergarten%';
-
-UPDATE idp SET "type" = 'University/College' WHERE
-amenity  ILIKE '%university%' OR amenity  ILIKE '%college%';
-
-UPDATE idp SET "type" = 'Hospital' WHERE amenity  ILIKE
-'%hospital%';
-
-UPDATE idp SET "type" = 'Public Building' WHERE
-building  ILIKE '%public%';
-
-UPDATE idp SET "type" = 'Place of Worship - Islam'
-where amenity  ILIKE '%worship%' and (religion  ILIKE '%islam'
-or religion  ILIKE '%muslim%');
-
-UPDATE idp SET "type" = 'Place of Worship - Unitarian'
-where amenity  ILIKE '%worship%' and religion  ILIKE '%unitarian%';
-
-UPDATE idp SET "type" = 'Place of Worship - Buddhist' WHERE
-amenity  ILIKE '%worship%' and religion  ILIKE '%budd%';
-
--- run near the end
-
-UPDATE idp SET "type" = 'School' WHERE
-  "building:use" = 'education' AND "type" IS NULL ;
-
-UPDATE idp SET "type" = 'Place of Worship' WHERE
-  "building:use" = 'place_of_worship' AND "type" IS NULL ;
-
-UPDATE idp SET "type" = 'Place of Worship' WHERE
-  amenity = 'place_of_worship' AND "type" IS NULL ;
-
-UPDATE idp SET "type" = 'School' WHERE
-  "building:use" = 'school' AND "type" IS NULL ;
-
-UPDATE idp SET "type" = 'Hospital' WHERE
-  "building:use" = 'hospital' AND "type" IS NULL ;
\ No newline at end of file
+-- Classify in a single pass over the table. The first matching category
+-- wins: categories found from amenity, building and religion come first,
+-- the most specific last, then the ones only found from building:use.
+
+UPDATE idp SET "type" = CASE
+  WHEN amenity ILIKE '%worship%' AND religion ILIKE '%budd%'
+    THEN 'Place of Worship - Buddhist'
+  WHEN amenity ILIKE '%worship%' AND religion ILIKE '%unitarian%'
+    THEN 'Place of Worship - Unitarian'
+  WHEN amenity ILIKE '%worship%'
+    AND (religion ILIKE '%islam' OR religion ILIKE '%muslim%')
+    THEN 'Place of Worship - Islam'
+  WHEN building ILIKE '%public%'
+    THEN 'Public Building'
+  WHEN amenity ILIKE '%hospital%'
+    THEN 'Hospital'
+  WHEN amenity ILIKE '%university%' OR amenity ILIKE '%college%'
+    THEN 'University/College'
+  WHEN amenity ILIKE '%school%' OR amenity ILIKE '%kindergarten%'
+    THEN 'School'
+  WHEN "building:use" = 'education' THEN 'School'
+  WHEN "building:use" = 'place_of_worship' THEN 'Place of Worship'
+  WHEN amenity = 'place_of_worship' THEN 'Place of Worship'
+  WHEN "building:use" = 'school' THEN 'School'
+  WHEN "building:use" = 'hospital' THEN 'Hospital'
+END;
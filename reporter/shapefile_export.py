@@ -0,0 +1,941 @@
+# coding=utf-8
+"""Module writing the shapefile of a feature without Postgres.
+
+The shapefile downloads are written by importing the OSM document in a
+scratch database with osm2pgsql and the .style file of the feature,
+normalising the types with its .sql file, and exporting the query of
+SQL_QUERY_MAP with pgsql2shp. For the features built from nodes and ways,
+this module does the same in the process:
+
+    * the way columns and polygon tags are read from the .style file, and
+      each way becomes a row of planet_osm_polygon (closed ways with a
+      polygon tag) or planet_osm_line (the others), as osm2pgsql imports
+      it,
+    * the ALTER TABLE ... ADD COLUMN and UPDATE ... SET ... WHERE
+      statements of the .sql file are applied to these rows,
+    * the columns, geometry and filter of the SQL_QUERY_MAP query are
+      evaluated on the rows, and written to .shp, .shx and .dbf files with
+      the fields pgsql2shp writes.
+
+Other statements, tables and expressions, and documents with multipolygon
+or boundary relations, raise UnsupportedShapefileExportException so the
+caller can fall back to Postgres.
+
+:copyright: (c) 2013 by Tim Sutton
+:license: GPLv3, see LICENSE for more details.
+"""
+import math
+import operator
+import os
+import re
+import struct
+from datetime import date
+from functools import lru_cache
+
+from reporter.exceptions import UnsupportedShapefileExportException
+from reporter.osm_document import iter_osm_elements, open_osm_document
+from reporter.pbf import PrimitiveBlock, decompress_blob, is_pbf, read_blobs
+from reporter.queries import SQL_QUERY_MAP
+from reporter.utilities import overpass_resource_base_path
+
+# Tables of osm2pgsql the queries can read
+LINE_TABLE = 'planet_osm_line'
+POLYGON_TABLE = 'planet_osm_polygon'
+
+# Columns of the style files computed by osm2pgsql rather than tags
+COMPUTED_COLUMNS = ('way_area', 'z_order')
+
+# Relations osm2pgsql builds polygons from
+POLYGON_RELATION_TYPES = ('multipolygon', 'boundary')
+
+# Start of the relations of an xml document, which follow its nodes and
+# ways, and the type tags looked for after it, see _check_xml_relations
+RELATION_START = b'<relation'
+RELATION_TYPE_PATTERN = re.compile(
+    rb'<tag\s+k=(["\'])type\1\s+v=(["\'])([^"\']*)\2')
+
+# Bytes of a document read at a time by _check_xml_relations, and the
+# bytes kept between two reads so tags over two reads are found
+SCAN_CHUNK_SIZE = 1024 * 1024
+SCAN_OVERLAP = 256
+
+# Radius of the sphere of the web mercator projection (EPSG:3857), and the
+# latitude osm2pgsql clamps the coordinates to
+MERCATOR_RADIUS = 6378137.0
+MERCATOR_MAX_LATITUDE = 85.0511287798
+
+# Shape types of the shapefile format
+POINT_SHAPE = 1
+POLYLINE_SHAPE = 3
+POLYGON_SHAPE = 5
+
+# Width of the dbf fields pgsql2shp writes for integers, and the maximum
+# width of a text field
+INTEGER_WIDTH = 11
+TEXT_MAX_WIDTH = 254
+
+TOKEN_PATTERN = re.compile(
+    r'\s+|--[^\n]*'
+    r'|(?P<identifier>"(?:[^"]|"")*")'
+    r"|(?P<string>'(?:[^']|'')*')"
+    r'|(?P<number>\d+(?:\.\d+)?)'
+    r'|(?P<word>[A-Za-z_][A-Za-z0-9_]*)'
+    r'|(?P<symbol><>|!=|[=(),;*])')
+
+COMPARISONS = {
+    '=': operator.eq,
+    '!=': operator.ne,
+    '<>': operator.ne}
+
+
+def export_shapefile(feature_type, file_path, shape_path):
+    """Write the shapefile of a feature from an OSM document.
+
+    The directory of the shapefile is created once the document is read.
+
+    :param feature_type: The feature to export, a key of SQL_QUERY_MAP.
+    :type feature_type: str
+
+    :param file_path: Path to the OSM document, xml (compressed or not) or
+        PBF.
+    :type file_path: str
+
+    :param shape_path: Path of the .shp file to write, the .shx and .dbf
+        files are written next to it.
+    :type shape_path: str
+
+    :returns: The number of records written.
+    :rtype: int
+
+    :raises: UnsupportedShapefileExportException if the feature or the
+        document needs Postgres.
+    """
+    resource_path = overpass_resource_base_path(feature_type)
+    columns, polygon_tags = parse_style('%s.style' % resource_path)
+    with open('%s.sql' % resource_path) as sql_file:
+        transform = parse_transform(sql_file.read())
+    geometry, fields, table, condition = parse_query(
+        SQL_QUERY_MAP[feature_type])
+
+    available = set(columns)
+    available.update(
+        column for step_table, column, _, _ in transform
+        if step_table == table)
+    for _, kind, column in fields:
+        if kind == 'column' and column not in available:
+            raise UnsupportedShapefileExportException(
+                'Column %s does not exist in %s' % (column, table))
+
+    rows = osm_rows(file_path, columns, polygon_tags, table)
+    apply_transform(rows, table, transform)
+    if condition is not None:
+        rows = [row for row in rows if condition(row)]
+
+    if geometry == 'point':
+        shape_type = POINT_SHAPE
+        shapes = [[[point_on_surface(row['way'])]] for row in rows]
+    elif table == POLYGON_TABLE:
+        shape_type = POLYGON_SHAPE
+        shapes = [[clockwise(row['way'])] for row in rows]
+    else:
+        shape_type = POLYLINE_SHAPE
+        shapes = [[row['way']] for row in rows]
+    values = [
+        [mercator_area(row['way']) if kind == 'area' else row[column]
+         for _, kind, column in fields]
+        for row in rows]
+    dbf_fields = [
+        (name, 'N' if kind == 'area' else 'C')
+        for name, (_, kind, _) in zip(
+            dbf_field_names([name for name, _, _ in fields]), fields)]
+
+    directory = os.path.dirname(shape_path)
+    if directory and not os.path.exists(directory):
+        os.makedirs(directory)
+    write_shapefile(shape_path, shape_type, shapes, dbf_fields, values)
+    return len(rows)
+
+
+def parse_style(style_path):
+    """Read the way columns of an osm2pgsql style file.
+
+    Lines are 'osm types, tag, data type, flags'. Like osm2pgsql, the osm
+    types only need to contain 'way', which copes with the quotes left in
+    some of our style files.
+
+    :param style_path: Path to the style file.
+    :type style_path: str
+
+    :returns: The tags imported as columns of the ways, in the order of the
+        file, and the tags making a closed way a polygon.
+    :rtype: (list, set)
+    """
+    columns = []
+    polygon_tags = set()
+    with open(style_path) as style_file:
+        for line in style_file:
+            words = line.split('#', 1)[0].split()
+            if len(words) < 3 or 'way' not in words[0]:
+                continue
+            tag = words[1]
+            flags = words[3].split(',') if len(words) > 3 else []
+            if tag in COMPUTED_COLUMNS or 'delete' in flags:
+                continue
+            if 'polygon' in flags:
+                polygon_tags.add(tag)
+            if 'nocolumn' not in flags:
+                columns.append(tag)
+    return columns, polygon_tags
+
+
+def tokenize(sql):
+    """Split sql in tokens, without the blanks and comments.
+
+    :param sql: The sql.
+    :type sql: str
+
+    :returns: (kind, value) tuples. Kinds are 'word' for keywords and
+        unquoted names (lower cased, as Postgres does), 'identifier' for
+        quoted names, 'string', 'number' and 'symbol'.
+    :rtype: list
+
+    :raises: UnsupportedShapefileExportException for unexpected characters.
+    """
+    tokens = []
+    position = 0
+    while position < len(sql):
+        match = TOKEN_PATTERN.match(sql, position)
+        if match is None:
+            raise UnsupportedShapefileExportException(
+                'Unexpected sql: %s' % sql[position:position + 20])
+        position = match.end()
+        kind = match.lastgroup
+        if kind is None:
+            continue
+        value = match.group(kind)
+        if kind == 'identifier':
+            value = value[1:-1].replace('""', '"')
+        elif kind == 'string':
+            value = value[1:-1].replace("''", "'")
+        elif kind == 'word':
+            value = value.lower()
+        tokens.append((kind, value))
+    return tokens
+
+
+class _Tokens(object):
+    """Cursor over the tokens of a statement."""
+
+    def __init__(self, tokens):
+        """Constructor.
+
+        :param tokens: Tokens, see tokenize.
+        :type tokens: list
+        """
+        self.tokens = tokens
+        self.index = 0
+
+    def peek(self):
+        """Get the next token without consuming it, (None, None) at the
+        end."""
+        if self.index < len(self.tokens):
+            return self.tokens[self.index]
+        return None, None
+
+    def take(self):
+        """Consume the next token."""
+        token = self.peek()
+        self.index += 1
+        return token
+
+    def accept(self, kind, *values):
+        """Consume the next token if it is one of the values of a kind.
+
+        :returns: The value consumed, None if the token is another one.
+        :rtype: str
+        """
+        token_kind, value = self.peek()
+        if token_kind == kind and value in values:
+            self.index += 1
+            return value
+        return None
+
+    def expect(self, kind, *values):
+        """Consume the next token, which must be one of the values."""
+        value = self.accept(kind, *values)
+        if value is None:
+            self.fail()
+        return value
+
+    def name(self):
+        """Consume a table or column name."""
+        kind, value = self.take()
+        if kind not in ('word', 'identifier'):
+            self.fail()
+        return value
+
+    def at_end(self):
+        """Check whether all the tokens are consumed."""
+        return self.index >= len(self.tokens)
+
+    def fail(self):
+        """Reject the statement."""
+        raise UnsupportedShapefileExportException(
+            'Unsupported sql near: %s' % ' '.join(
+                value for _, value in self.tokens[self.index:][:5]))
+
+
+def parse_transform(sql):
+    """Parse the sql normalising the types of a feature.
+
+    Only the statements adding a column and setting it to a string, or to
+    a CASE of strings, are supported.
+
+    :param sql: The content of the .sql file of the feature.
+    :type sql: str
+
+    :returns: The steps of the transform, in order, as (table, column,
+        value, condition) tuples. The value and condition are functions of
+        a row, the condition None for all the rows. Adding a column is a
+        step setting it for no row.
+    :rtype: list
+
+    :raises: UnsupportedShapefileExportException for other statements.
+    """
+    statements = [[]]
+    for token in tokenize(sql):
+        if token == ('symbol', ';'):
+            statements.append([])
+        else:
+            statements[-1].append(token)
+
+    steps = []
+    for statement in statements:
+        if not statement:
+            continue
+        tokens = _Tokens(statement)
+        if tokens.accept('word', 'alter'):
+            tokens.expect('word', 'table')
+            table = tokens.name()
+            tokens.expect('word', 'add')
+            tokens.accept('word', 'column')
+            steps.append((table, tokens.name(), None, _never))
+            # The type of the column is not needed, values are strings.
+            continue
+        tokens.expect('word', 'update')
+        table = tokens.name()
+        tokens.expect('word', 'set')
+        column = tokens.name()
+        tokens.expect('symbol', '=')
+        value = _parse_value(tokens)
+        condition = None
+        if tokens.accept('word', 'where'):
+            condition = _parse_condition(tokens)
+        if not tokens.at_end():
+            tokens.fail()
+        steps.append((table, column, value, condition))
+    return steps
+
+
+def apply_transform(rows, table, steps):
+    """Apply the steps of a transform to the rows of a table.
+
+    :param rows: The rows, dicts of values by column, updated in place.
+    :type rows: list
+
+    :param table: The table of the rows, steps of other tables are skipped.
+    :type table: str
+
+    :param steps: The steps, see parse_transform.
+    :type steps: list
+    """
+    for step_table, column, value, condition in steps:
+        if step_table != table:
+            continue
+        for row in rows:
+            row.setdefault(column, None)
+            if condition is None or condition(row):
+                row[column] = value(row)
+
+
+def parse_query(query):
+    """Parse a query of SQL_QUERY_MAP.
+
+    :param query: The query, quoted for the pgsql2shp command line.
+    :type query: str
+
+    :returns: The geometry ('geometry', or 'point' for a point on the
+        surface), the fields as (name, kind, column) tuples with the kinds
+        'column' and 'area' (of the geometry, in square meters), the table,
+        and the condition of the rows (a function of a row, None for all
+        the rows).
+    :rtype: (str, list, str, function)
+
+    :raises: UnsupportedShapefileExportException for other expressions or
+        tables.
+    """
+    query = query.strip().strip('"').replace('\\"', '"')
+    tokens = _Tokens([
+        token for token in tokenize(query) if token != ('symbol', ';')])
+    tokens.expect('word', 'select')
+    geometry = None
+    fields = []
+    while True:
+        item = []
+        depth = 0
+        while not tokens.at_end():
+            token = tokens.peek()
+            if depth == 0 and token in (
+                    ('symbol', ','), ('word', 'from')):
+                break
+            depth += {'(': 1, ')': -1}.get(token[1], 0) \
+                if token[0] == 'symbol' else 0
+            item.append(tokens.take())
+        name = None
+        if len(item) > 2 and item[-2] == ('word', 'as'):
+            name = item[-1][1]
+            item = item[:-2]
+        words = set(value for kind, value in item if kind == 'word')
+        if 'way' in words and 'st_area' in words:
+            kind, column = 'area', None
+        elif 'way' in words:
+            geometry = (
+                'point' if 'st_pointonsurface' in words else 'geometry')
+            kind = None
+        elif len(item) == 1 and item[0][0] in ('word', 'identifier'):
+            kind, column = 'column', item[0][1]
+            name = name or column
+        else:
+            tokens.fail()
+        if kind is not None:
+            if name is None:
+                tokens.fail()
+            fields.append((name, kind, column))
+        if not tokens.accept('symbol', ','):
+            break
+    tokens.expect('word', 'from')
+    table = tokens.name()
+    if geometry is None or table not in (LINE_TABLE, POLYGON_TABLE):
+        raise UnsupportedShapefileExportException(
+            'Unsupported query of %s' % table)
+    condition = None
+    if tokens.accept('word', 'where'):
+        condition = _parse_condition(tokens)
+    if not tokens.at_end():
+        tokens.fail()
+    return geometry, fields, table, condition
+
+
+def _never(row):
+    """Condition matching no row."""
+    return False
+
+
+def _parse_value(tokens):
+    """Parse a string, NULL or a CASE of these, as a function of a row."""
+    if tokens.accept('word', 'case'):
+        branches = []
+        while tokens.accept('word', 'when'):
+            condition = _parse_condition(tokens)
+            tokens.expect('word', 'then')
+            branches.append((condition, _parse_value(tokens)))
+        if not branches:
+            tokens.fail()
+        default = _parse_value(tokens) \
+            if tokens.accept('word', 'else') else _null
+        tokens.expect('word', 'end')
+
+        def case(row):
+            for condition, value in branches:
+                if condition(row):
+                    return value(row)
+            return default(row)
+        return case
+
+    kind, value = tokens.take()
+    if (kind, value) == ('word', 'null'):
+        return _null
+    if kind != 'string':
+        tokens.index -= 1
+        tokens.fail()
+    return lambda row: value
+
+
+def _null(row):
+    """Value of NULL."""
+    return None
+
+
+def _parse_condition(tokens):
+    """Parse conditions joined by OR.
+
+    Conditions are evaluated like sql, None standing for NULL.
+    """
+    conditions = [_parse_conjunction(tokens)]
+    while tokens.accept('word', 'or'):
+        conditions.append(_parse_conjunction(tokens))
+    if len(conditions) == 1:
+        return conditions[0]
+
+    def disjunction(row):
+        result = False
+        for condition in conditions:
+            value = condition(row)
+            if value:
+                return True
+            if value is None:
+                result = None
+        return result
+    return disjunction
+
+
+def _parse_conjunction(tokens):
+    """Parse conditions joined by AND."""
+    conditions = [_parse_predicate(tokens)]
+    while tokens.accept('word', 'and'):
+        conditions.append(_parse_predicate(tokens))
+    if len(conditions) == 1:
+        return conditions[0]
+
+    def conjunction(row):
+        result = True
+        for condition in conditions:
+            value = condition(row)
+            if value is False:
+                return False
+            if value is None:
+                result = None
+        return result
+    return conjunction
+
+
+def _parse_predicate(tokens):
+    """Parse a negated or parenthesised condition, or a comparison."""
+    if tokens.accept('word', 'not'):
+        condition = _parse_predicate(tokens)
+
+        def negation(row):
+            value = condition(row)
+            return None if value is None else not value
+        return negation
+
+    if tokens.accept('symbol', '('):
+        condition = _parse_condition(tokens)
+        tokens.expect('symbol', ')')
+        return condition
+
+    left = _parse_operand(tokens)
+    if tokens.accept('word', 'is'):
+        negate = bool(tokens.accept('word', 'not'))
+        tokens.expect('word', 'null')
+        return lambda row: (left(row) is None) != negate
+
+    negate = bool(tokens.accept('word', 'not'))
+    matching = tokens.accept('word', 'like', 'ilike')
+    if matching:
+        right = _parse_operand(tokens)
+        flags = re.IGNORECASE if matching == 'ilike' else 0
+
+        def like(row):
+            value = left(row)
+            pattern = right(row)
+            if value is None or pattern is None:
+                return None
+            return bool(
+                _like_pattern(pattern, flags).match(value)) != negate
+        return like
+
+    if negate:
+        tokens.fail()
+    comparison = COMPARISONS[tokens.expect('symbol', *COMPARISONS)]
+    right = _parse_operand(tokens)
+
+    def compare(row):
+        value = left(row)
+        other = right(row)
+        if value is None or other is None:
+            return None
+        return comparison(value, other)
+    return compare
+
+
+def _parse_operand(tokens):
+    """Parse a column, a literal or NULL, as a function of a row."""
+    kind, value = tokens.take()
+    if (kind, value) == ('word', 'null'):
+        return _null
+    if kind in ('word', 'identifier'):
+        return lambda row: row.get(value)
+    if kind in ('string', 'number'):
+        return lambda row: value
+    tokens.index -= 1
+    tokens.fail()
+
+
+@lru_cache(maxsize=256)
+def _like_pattern(pattern, flags):
+    """Compile a LIKE pattern to a regular expression matching a whole
+    string."""
+    expression = ''.join(
+        '.*' if character == '%' else
+        '.' if character == '_' else
+        re.escape(character)
+        for character in pattern)
+    return re.compile('%s\\Z' % expression, flags | re.DOTALL)
+
+
+def osm_rows(file_path, columns, polygon_tags, table):
+    """Build the rows osm2pgsql imports from the ways of an OSM document.
+
+    A way is imported if it has at least one of the columns as tag. Nodes
+    missing from the document are skipped, then the way is a polygon if it
+    is closed, with at least 4 nodes, and has one of the polygon tags or
+    area=yes, unless it has area=no.
+
+    :param file_path: Path to the OSM document, xml or PBF.
+    :type file_path: str
+
+    :param columns: The columns of the ways, see parse_style.
+    :type columns: list
+
+    :param polygon_tags: The polygon tags, see parse_style.
+    :type polygon_tags: set
+
+    :param table: The table whose rows are built, LINE_TABLE or
+        POLYGON_TABLE.
+    :type table: str
+
+    :returns: The rows, dicts of tag values by column, and the (lon, lat)
+        points of the way under the 'way' key.
+    :rtype: list
+
+    :raises: UnsupportedShapefileExportException if the document has
+        multipolygon or boundary relations.
+    """
+    if is_pbf(file_path):
+        coordinates, ways = _read_pbf(file_path, columns)
+    else:
+        _check_xml_relations(file_path)
+        coordinates, ways = _read_xml(file_path, columns)
+
+    rows = []
+    for tags, refs in ways:
+        points = [
+            coordinates[ref] for ref in refs if ref in coordinates]
+        if len(set(points)) < 2:
+            continue
+        closed = len(points) >= 4 and points[0] == points[-1]
+        area = tags.get('area')
+        is_polygon = closed and area != 'no' and (
+            area == 'yes' or any(tag in polygon_tags for tag in tags))
+        if is_polygon != (table == POLYGON_TABLE):
+            continue
+        if len(set(points)) < (3 if is_polygon else 2):
+            continue
+        row = dict((column, tags.get(column)) for column in columns)
+        row['way'] = points
+        rows.append(row)
+    return rows
+
+
+def _check_relation(tags):
+    """Reject the relations osm2pgsql builds polygons from."""
+    if tags.get('type') in POLYGON_RELATION_TYPES:
+        raise UnsupportedShapefileExportException(
+            'Relations of type %s need Postgres' % tags['type'])
+
+
+def _check_xml_relations(file_path):
+    """Reject an xml document with polygon relations before parsing it.
+
+    The relations come last, so parsing the document to find them would
+    parse all of it first. The bytes are scanned instead, for the type
+    tags after the first relation. A way tagged with such a type after it,
+    which is not expected there, only makes the export use Postgres.
+
+    :param file_path: Path to the OSM xml document, compressed or not.
+    :type file_path: str
+
+    :raises: UnsupportedShapefileExportException if the document has
+        multipolygon or boundary relations.
+    """
+    carry = b''
+    in_relations = False
+    with open_osm_document(file_path) as document:
+        for chunk in iter(lambda: document.read(SCAN_CHUNK_SIZE), b''):
+            data = carry + chunk
+            if not in_relations:
+                start = data.find(RELATION_START)
+                if start < 0:
+                    carry = data[-len(RELATION_START):]
+                    continue
+                in_relations = True
+                data = data[start:]
+            for match in RELATION_TYPE_PATTERN.finditer(data):
+                _check_relation(
+                    {'type': match.group(3).decode('utf-8', 'replace')})
+            carry = data[-SCAN_OVERLAP:]
+
+
+def _read_xml(file_path, columns):
+    """Read the nodes, and the ways with a column, of an xml document.
+
+    :returns: (lon, lat) by node id, and (tags, node ids) of the ways.
+    :rtype: (dict, list)
+    """
+    column_set = set(columns)
+    coordinates = {}
+    ways = []
+    for _, element in iter_osm_elements(file_path):
+        if element.tag == 'node':
+            coordinates[int(element.get('id'))] = (
+                float(element.get('lon')), float(element.get('lat')))
+            continue
+        tags = dict(
+            (tag.get('k'), tag.get('v')) for tag in element.iter('tag'))
+        if element.tag == 'relation':
+            _check_relation(tags)
+        elif element.tag == 'way' and column_set.intersection(tags):
+            ways.append((
+                tags, [int(nd.get('ref')) for nd in element.iter('nd')]))
+    return coordinates, ways
+
+
+def _read_pbf(file_path, columns):
+    """Read the ways with a column, then their nodes, of a PBF file.
+
+    :returns: (lon, lat) by node id, and (tags, node ids) of the ways.
+    :rtype: (dict, list)
+    """
+    column_set = set(columns)
+    ways = []
+    needed = set()
+    for blob in read_blobs(file_path):
+        block = PrimitiveBlock(decompress_blob(blob))
+        for _, tags in block.relations():
+            _check_relation(tags)
+        for _, tags, refs, _, _ in block.ways():
+            if column_set.intersection(tags):
+                ways.append((tags, refs))
+                needed.update(refs)
+
+    coordinates = {}
+    for blob in read_blobs(file_path):
+        for node_id, lat, lon, _, _ in PrimitiveBlock(
+                decompress_blob(blob)).nodes():
+            if node_id in needed:
+                coordinates[node_id] = (lon, lat)
+    return coordinates, ways
+
+
+def to_mercator(point):
+    """Project a (lon, lat) point to web mercator (EPSG:3857)."""
+    lon, lat = point
+    lat = max(-MERCATOR_MAX_LATITUDE, min(MERCATOR_MAX_LATITUDE, lat))
+    y = math.log(math.tan(math.pi / 4 + math.radians(lat) / 2))
+    return math.radians(lon) * MERCATOR_RADIUS, y * MERCATOR_RADIUS
+
+
+def from_mercator(point):
+    """Get the (lon, lat) of a web mercator point."""
+    x, y = point
+    lat = 2 * math.atan(math.exp(y / MERCATOR_RADIUS)) - math.pi / 2
+    return math.degrees(x / MERCATOR_RADIUS), math.degrees(lat)
+
+
+def signed_area(ring):
+    """Get the area of a closed ring, positive if it is counterclockwise."""
+    return sum(
+        x0 * y1 - x1 * y0
+        for (x0, y0), (x1, y1) in zip(ring, ring[1:])) / 2
+
+
+def clockwise(ring):
+    """Get a ring oriented clockwise, as the outer rings of shapefiles."""
+    if signed_area(ring) > 0:
+        return ring[::-1]
+    return ring
+
+
+def mercator_area(ring):
+    """Get the area of a (lon, lat) ring in web mercator, as the integer
+    cast of st_area(st_transform(way, 3857)).
+
+    :rtype: int
+    """
+    return int(round(abs(signed_area([to_mercator(p) for p in ring]))))
+
+
+def point_on_surface(ring):
+    """Get a point inside a (lon, lat) ring, as st_pointonsurface does.
+
+    Like GEOS, the point is the middle of the widest section of the
+    polygon on a horizontal line through its middle, in web mercator,
+    avoiding the heights of the vertices.
+
+    :returns: The (lon, lat) of the point.
+    :rtype: tuple
+    """
+    ring = [to_mercator(point) for point in ring]
+    heights = [y for _, y in ring]
+    low = min(heights)
+    high = max(heights)
+    centre = (low + high) / 2
+    for y in heights:
+        if low < y <= centre:
+            low = y
+        elif centre < y < high:
+            high = y
+    scan = (low + high) / 2
+
+    crossings = sorted(
+        x0 + (scan - y0) * (x1 - x0) / (y1 - y0)
+        for (x0, y0), (x1, y1) in zip(ring, ring[1:])
+        if (y0 > scan) != (y1 > scan))
+    best = ring[0]
+    width = -1
+    for left, right in zip(crossings[::2], crossings[1::2]):
+        if right - left > width:
+            width = right - left
+            best = ((left + right) / 2, scan)
+    return from_mercator(best)
+
+
+def dbf_field_names(names):
+    """Get the dbf field names pgsql2shp writes for columns.
+
+    Names are upper cased and truncated to 10 characters, duplicates are
+    numbered.
+
+    :param names: The names of the columns.
+    :type names: list
+
+    :rtype: list
+    """
+    field_names = []
+    for name in names:
+        field_name = name.upper()[:10]
+        number = 1
+        while field_name in field_names:
+            field_name = '%s_%02d' % (name.upper()[:7], number)
+            number += 1
+        field_names.append(field_name)
+    return field_names
+
+
+def write_shapefile(shape_path, shape_type, shapes, fields, values):
+    """Write the .shp, .shx and .dbf files of a shapefile.
+
+    :param shape_path: Path of the .shp file.
+    :type shape_path: str
+
+    :param shape_type: POINT_SHAPE, POLYLINE_SHAPE or POLYGON_SHAPE.
+    :type shape_type: int
+
+    :param shapes: The parts of each record, lists of (x, y) points. A
+        point is a single part of a single point.
+    :type shapes: list
+
+    :param fields: The (name, type) of the dbf fields, 'C' for text and
+        'N' for integers.
+    :type fields: list
+
+    :param values: The values of the fields for each record, None for
+        NULL.
+    :type values: list
+    """
+    base_path = os.path.splitext(shape_path)[0]
+    contents = [_shape_content(shape_type, parts) for parts in shapes]
+    bbox = _bbox([
+        point for parts in shapes for part in parts for point in part])
+    with open('%s.shp' % base_path, 'wb') as shp_file, \
+            open('%s.shx' % base_path, 'wb') as shx_file:
+        shp_file.write(_shape_header(
+            shape_type, 100 + sum(8 + len(data) for data in contents), bbox))
+        shx_file.write(_shape_header(
+            shape_type, 100 + 8 * len(contents), bbox))
+        offset = 100
+        for number, content in enumerate(contents, 1):
+            shp_file.write(struct.pack('>2i', number, len(content) // 2))
+            shp_file.write(content)
+            shx_file.write(struct.pack('>2i', offset // 2, len(content) // 2))
+            offset += 8 + len(content)
+    _write_dbf('%s.dbf' % base_path, fields, values)
+
+
+def _bbox(points):
+    """Get the (xmin, ymin, xmax, ymax) of points, zeros if there are
+    none."""
+    if not points:
+        return 0., 0., 0., 0.
+    xs = [x for x, _ in points]
+    ys = [y for _, y in points]
+    return min(xs), min(ys), max(xs), max(ys)
+
+
+def _shape_header(shape_type, length, bbox):
+    """Encode the header of a .shp or .shx file of length bytes."""
+    return b''.join([
+        struct.pack('>7i', 9994, 0, 0, 0, 0, 0, length // 2),
+        struct.pack('<2i4d', 1000, shape_type, *bbox),
+        struct.pack('<4d', 0, 0, 0, 0)])
+
+
+def _shape_content(shape_type, parts):
+    """Encode a record of a .shp file."""
+    if shape_type == POINT_SHAPE:
+        return struct.pack('<i2d', shape_type, *parts[0][0])
+    points = [point for part in parts for point in part]
+    indexes = []
+    start = 0
+    for part in parts:
+        indexes.append(start)
+        start += len(part)
+    return b''.join([
+        struct.pack('<i4d', shape_type, *_bbox(points)),
+        struct.pack('<2i', len(parts), len(points)),
+        struct.pack('<%si' % len(indexes), *indexes),
+        struct.pack(
+            '<%sd' % (2 * len(points)),
+            *[coordinate for point in points for coordinate in point])])
+
+
+def _write_dbf(dbf_path, fields, values):
+    """Write a dbf file, text fields being as wide as their longest
+    value."""
+    encoded = [
+        [None if value is None else str(value).encode('utf-8')
+         for value in record]
+        for record in values]
+    widths = []
+    for index, (_, field_type) in enumerate(fields):
+        if field_type == 'N':
+            widths.append(INTEGER_WIDTH)
+            continue
+        widths.append(max(
+            [1] + [len(record[index]) for record in encoded
+                   if record[index] is not None]))
+        widths[-1] = min(widths[-1], TEXT_MAX_WIDTH)
+
+    today = date.today()
+    with open(dbf_path, 'wb') as dbf_file:
+        dbf_file.write(struct.pack(
+            '<4BIHH20x', 3, today.year - 1900, today.month, today.day,
+            len(encoded), 33 + 32 * len(fields), 1 + sum(widths)))
+        for (name, field_type), width in zip(fields, widths):
+            dbf_file.write(struct.pack(
+                '<11sc4xBB14x', name.encode('ascii'),
+                field_type.encode('ascii'), width, 0))
+        dbf_file.write(b'\r')
+        for record in encoded:
+            data = [b' ']
+            for (_, field_type), width, value in zip(fields, widths, record):
+                if value is None:
+                    data.append(b' ' * width)
+                elif field_type == 'N':
+                    data.append(value.rjust(width))
+                else:
+                    value = value[:width].decode('utf-8', 'ignore')
+                    data.append(value.encode('utf-8').ljust(width))
+            dbf_file.write(b''.join(data))
+        dbf_file.write(b'\x1a')
@@ -0,0 +1,232 @@
+# coding=utf-8
+"""Contribution counts of an area kept up to date with Overpass diffs.
+:copyright: (c) 2013 by Tim Sutton
+:license: GPLv3, see LICENSE for more details.
+"""
+import gzip
+import hashlib
+import json
+import os
+import socket
+import threading
+import time
+import xml.sax
+from collections import OrderedDict
+from urllib.error import URLError
+
+from reporter import config
+from reporter import LOGGER
+from reporter.cache import atomic_file, cache_lock, osm_cache
+from reporter.exceptions import (
+    OverpassBadRequestException,
+    OverpassConcurrentRequestException,
+    OverpassTimeoutException)
+from reporter.osm import fetch_osm, get_osm_file, osm_query_paths
+from reporter.osm_document import open_osm_document
+from reporter.osm_way_parser import OsmWayStateParser, way_state_counts
+from reporter.queries import OVERPASS_QUERY_MAP, TAG_FILTERS
+from reporter.utilities import (
+    CONTRIBUTIONS_SNAPSHOT_SUFFIX,
+    contribution_records)
+
+# Format of the dates of Overpass diff queries and osm_base
+DIFF_DATE_FORMAT = '%Y-%m-%dT%H:%M:%SZ'
+
+# Summaries of recent snapshots, see snapshot_contributions
+_SNAPSHOT_REPORTS = OrderedDict()
+_SNAPSHOT_REPORTS_GUARD = threading.Lock()
+
+
+def snapshot_contributions(coordinates, tag_names):
+    """Compile the summaries of user contributions in an area, for each tag.
+
+    The first request for an area downloads its contributions document
+    and keeps the state of its tagged ways in a snapshot. Once the
+    snapshot is older than the cache max age, only the changes since the
+    snapshot was taken are downloaded, with an Overpass [diff:...] query,
+    and applied to it. After config.CONTRIBUTIONS_SNAPSHOT_MAX_AGE seconds
+    the whole document is downloaded again.
+
+    If the diff can't be downloaded, the stale snapshot is used, and
+    updated again by the next request.
+
+    :param coordinates: Coordinates as returned by split_bbox.
+    :type coordinates: dict
+
+    :param tag_names: The tag names we want summaries for.
+    :type tag_names: list
+
+    :returns: A dict of the lists returned by osm_object_contributions, by
+        tag name.
+    :rtype: dict
+
+    :raises: The exceptions of get_osm_file, and xml.sax.SAXParseException
+        if Overpass returned invalid xml.
+    """
+    parameters = dict(coordinates, print_mode='meta')
+    query = OVERPASS_QUERY_MAP['contributions'].format(**parameters)
+    file_path = snapshot_path(query)
+    max_age = config.CACHE_MAX_AGE_BY_FEATURE.get(
+        'contributions', config.CACHE_MAX_AGE)
+    if not is_snapshot_fresh(file_path, max_age):
+        with cache_lock(file_path):
+            # Someone else may have updated it while we were waiting.
+            if not is_snapshot_fresh(file_path, max_age):
+                update_snapshot(file_path, query, coordinates)
+    osm_cache().record(file_path, config.CONTRIBUTIONS_SNAPSHOT_MAX_AGE)
+
+    stat = os.stat(file_path)
+    key = (file_path, stat.st_mtime_ns, stat.st_size, tuple(tag_names))
+    with _SNAPSHOT_REPORTS_GUARD:
+        if key in _SNAPSHOT_REPORTS:
+            _SNAPSHOT_REPORTS.move_to_end(key)
+            return _SNAPSHOT_REPORTS[key]
+    snapshot = load_snapshot(file_path)
+    way_count_dicts, node_count_dicts, timelines = way_state_counts(
+        snapshot['ways'], tag_names)
+    reports = dict(
+        (tag_name, contribution_records(
+            way_count_dicts[tag_name],
+            node_count_dicts[tag_name],
+            timelines[tag_name]))
+        for tag_name in tag_names)
+    with _SNAPSHOT_REPORTS_GUARD:
+        _SNAPSHOT_REPORTS[key] = reports
+        while len(_SNAPSHOT_REPORTS) > config.CONTRIBUTIONS_CACHE_SIZE:
+            _SNAPSHOT_REPORTS.popitem(last=False)
+    return reports
+
+
+def snapshot_path(query):
+    """Get the path of the snapshot of an Overpass query.
+
+    :param query: The Overpass QL query, without diff setting.
+    :type query: str
+
+    :returns: The path of the snapshot in config.CACHE_DIR.
+    :rtype: str
+    """
+    safe_name = hashlib.md5(query.encode('utf-8')).hexdigest()
+    return os.path.join(
+        config.CACHE_DIR, safe_name + CONTRIBUTIONS_SNAPSHOT_SUFFIX)
+
+
+def is_snapshot_fresh(file_path, max_age):
+    """Check whether a snapshot exists and was updated recently enough.
+
+    :param file_path: The path of the snapshot.
+    :type file_path: str
+
+    :param max_age: Maximum age in seconds.
+    :type max_age: int
+
+    :rtype: bool
+    """
+    try:
+        return time.time() - os.path.getmtime(file_path) <= max_age
+    except OSError:
+        return False
+
+
+def update_snapshot(file_path, query, coordinates):
+    """Bring a snapshot up to date, from a diff if possible.
+
+    The lock of the snapshot must be held, see cache_lock. A snapshot
+    whose diff fails is left as it is.
+
+    :param file_path: The path of the snapshot.
+    :type file_path: str
+
+    :param query: The Overpass QL query of the snapshot.
+    :type query: str
+
+    :param coordinates: Coordinates as returned by split_bbox.
+    :type coordinates: dict
+    """
+    snapshot = load_snapshot(file_path)
+    if snapshot:
+        age = time.time() - snapshot['baseline']
+        if age > config.CONTRIBUTIONS_SNAPSHOT_MAX_AGE:
+            snapshot = None
+    if not snapshot:
+        started = time.time()
+        parser = OsmWayStateParser(TAG_FILTERS.keys())
+        with get_osm_file(dict(coordinates), 'contributions', 'meta') as osm:
+            parser.parse(osm)
+            document_time = os.fstat(osm.fileno()).st_mtime
+        snapshot = {
+            'baseline': started,
+            'timestamp': parser.timestamp or time.strftime(
+                DIFF_DATE_FORMAT, time.gmtime(document_time)),
+            'ways': parser.ways,
+        }
+        LOGGER.info('New snapshot of %s ways', len(snapshot['ways']))
+    else:
+        diff_query = '[diff:"{date_from}"];{query}'.format(
+            date_from=snapshot['timestamp'], query=query)
+        diff_path, url_path = osm_query_paths(diff_query)
+        requested = time.strftime(DIFF_DATE_FORMAT, time.gmtime())
+        parser = OsmWayStateParser(TAG_FILTERS.keys())
+        try:
+            fetch_osm(diff_path, url_path)
+            with open_osm_document(diff_path) as diff:
+                parser.parse(diff)
+        except (
+                OverpassBadRequestException,
+                OverpassConcurrentRequestException,
+                OverpassTimeoutException,
+                URLError,
+                socket.timeout,
+                xml.sax.SAXParseException) as e:
+            LOGGER.warning(
+                'Serving the stale snapshot %s, its diff failed: %r',
+                file_path, e)
+            return
+        finally:
+            if os.path.exists(diff_path):
+                os.remove(diff_path)
+        ways = snapshot['ways']
+        for way_id in parser.removed:
+            ways.pop(way_id, None)
+        ways.update(parser.ways)
+        snapshot['timestamp'] = parser.timestamp or requested
+        LOGGER.info(
+            'Applied a diff of %s ways to a snapshot',
+            len(parser.ways) + len(parser.removed))
+    store_snapshot(file_path, snapshot)
+
+
+def load_snapshot(file_path):
+    """Read a snapshot.
+
+    :param file_path: The path of the snapshot.
+    :type file_path: str
+
+    :returns: The snapshot, a dict with the time of the last full download
+        as baseline, the osm_base of the data as timestamp and the ways
+        collected by OsmWayStateParser. None if it can't be read.
+    :rtype: dict
+    """
+    try:
+        with gzip.open(file_path, 'rb') as snapshot:
+            return json.loads(snapshot.read().decode('utf-8'))
+    except FileNotFoundError:
+        return None
+    except (OSError, EOFError, ValueError):
+        LOGGER.warning('Ignoring the unreadable snapshot %s', file_path)
+        return None
+
+
+def store_snapshot(file_path, snapshot):
+    """Write a snapshot, atomically.
+
+    :param file_path: The path of the snapshot.
+    :type file_path: str
+
+    :param snapshot: The snapshot, as returned by load_snapshot.
+    :type snapshot: dict
+    """
+    content = json.dumps(snapshot, separators=(',', ':'))
+    with atomic_file(file_path) as output_file:
+        with gzip.GzipFile(fileobj=output_file, mode='wb') as output:
+            output.write(content.encode('utf-8'))
@@ -4,10 +4,245 @@
 :license: GPLv3, see LICENSE for more details.
 """
 
+import calendar
 import os
+import struct
+import threading
+import time
+import zlib
+from xml.etree import ElementTree
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 
 FIXTURE_PATH = os.path.join(
     os.path.dirname(os.path.realpath(__file__)),
     'test_data',
     'swellendam.osm'
 )
+
+
+class OverpassStandIn(object):
+    """Local HTTP server standing in for Overpass in tests.
+
+    Use it as a context manager. Each GET is answered by the responder,
+    a callable taking the request path and returning a tuple
+    (status, body, headers). Connections stay open between requests.
+    """
+
+    def __init__(self, responder):
+        self.responder = responder
+        # Request paths, in the order they were received
+        self.requests = []
+        # Number of TCP connections accepted
+        self.connections = 0
+        self._server = None
+        self._thread = None
+
+    @property
+    def url(self):
+        """The URL of the interpreter on this server."""
+        host, port = self._server.server_address
+        return 'http://%s:%s/api/interpreter' % (host, port)
+
+    def __enter__(self):
+        stand_in = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def setup(self):
+                stand_in.connections += 1
+                BaseHTTPRequestHandler.setup(self)
+
+            def do_GET(self):
+                stand_in.requests.append(self.path)
+                status, body, headers = stand_in.responder(self.path)
+                self.send_response(status)
+                for key, value in headers.items():
+                    self.send_header(key, value)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self._server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self._server.daemon_threads = True
+        self._thread = threading.Thread(target=self._server.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self._server.shutdown()
+        self._server.server_close()
+
+
+def write_pbf(osm_path, pbf_path, block_size=100):
+    """Convert an OSM xml document to the PBF format.
+
+    Only what the reporter reads is written: the nodes (as dense nodes)
+    and the ways, with their tags, user and timestamp.
+
+    :param osm_path: Path of the OSM xml document.
+    :type osm_path: str
+
+    :param pbf_path: Path of the PBF file to write.
+    :type pbf_path: str
+
+    :param block_size: Number of elements per block.
+    :type block_size: int
+    """
+    def varint(value):
+        result = bytearray()
+        while True:
+            byte = value & 0x7f
+            value >>= 7
+            if value:
+                result.append(byte | 0x80)
+            else:
+                result.append(byte)
+                return bytes(result)
+
+    def zigzag(value):
+        return (value << 1) ^ (value >> 63)
+
+    def field(number, value):
+        if isinstance(value, int):
+            return varint(number << 3) + varint(value)
+        return varint(number << 3 | 2) + varint(len(value)) + value
+
+    def packed(number, values, signed=False, delta=False):
+        data = b''
+        previous = 0
+        for value in values:
+            if delta:
+                value, previous = value - previous, value
+            data += varint(zigzag(value) if signed else value)
+        return field(number, data)
+
+    def seconds(element):
+        return calendar.timegm(time.strptime(
+            element.get('timestamp'), '%Y-%m-%dT%H:%M:%SZ'))
+
+    def blob(blob_type, data):
+        encoded = field(2, len(data)) + field(3, zlib.compress(data))
+        header = field(1, blob_type.encode('utf-8')) + field(
+            3, len(encoded))
+        return struct.pack('!i', len(header)) + header + encoded
+
+    def block(elements):
+        strings = ['']
+        indexes = {}
+
+        def string(value):
+            if value not in indexes:
+                indexes[value] = len(strings)
+                strings.append(value)
+            return indexes[value]
+
+        nodes = [item for item in elements if item.tag == 'node']
+        ways = [item for item in elements if item.tag == 'way']
+        group = b''
+        if nodes:
+            keys_values = []
+            for node in nodes:
+                for tag in node.findall('tag'):
+                    keys_values += [string(tag.get('k')), string(tag.get('v'))]
+                keys_values.append(0)
+            dense_info = b''.join([
+                packed(1, [int(node.get('version')) for node in nodes]),
+                packed(2, [seconds(node) for node in nodes], True, True),
+                packed(5, [string(node.get('user')) for node in nodes],
+                       True, True)])
+            group += field(2, b''.join([
+                packed(1, [int(node.get('id')) for node in nodes],
+                       True, True),
+                field(5, dense_info),
+                packed(8, [round(float(node.get('lat')) * 1e7)
+                           for node in nodes], True, True),
+                packed(9, [round(float(node.get('lon')) * 1e7)
+                           for node in nodes], True, True),
+                packed(10, keys_values)]))
+        for way in ways:
+            tags = way.findall('tag')
+            info = b''.join([
+                field(1, int(way.get('version'))),
+                field(2, seconds(way)),
+                field(5, string(way.get('user')))])
+            group += field(3, b''.join([
+                field(1, int(way.get('id'))),
+                packed(2, [string(tag.get('k')) for tag in tags]),
+                packed(3, [string(tag.get('v')) for tag in tags]),
+                field(4, info),
+                packed(8, [int(nd.get('ref')) for nd in way.findall('nd')],
+                       True, True)]))
+        string_table = b''.join(
+            field(1, value.encode('utf-8')) for value in strings)
+        return field(1, string_table) + field(2, group)
+
+    elements = [
+        element for element in ElementTree.parse(osm_path).getroot()
+        if element.tag in ('node', 'way')]
+    with open(pbf_path, 'wb') as pbf_file:
+        header = b''.join(
+            field(4, feature)
+            for feature in (b'OsmSchema-V0.6', b'DenseNodes'))
+        pbf_file.write(blob('OSMHeader', header))
+        for start in range(0, len(elements), block_size):
+            pbf_file.write(blob(
+                'OSMData', block(elements[start:start + block_size])))
+
+
+def read_dbf(dbf_path, strict=True):
+    """Read the field names and the records of a dbf file.
+
+    With strict, the file must end right after its records and the end of
+    file marker.
+    """
+    with open(dbf_path, 'rb') as dbf_file:
+        data = dbf_file.read()
+    count, header_length, record_length = struct.unpack('<IHH', data[4:12])
+    fields = []
+    for start in range(32, header_length - 1, 32):
+        fields.append((
+            data[start:start + 11].split(b'\0')[0].decode('ascii'),
+            data[start + 16]))
+    records = []
+    for index in range(count):
+        start = header_length + index * record_length + 1
+        record = {}
+        for name, width in fields:
+            record[name] = data[start:start + width].decode(
+                'utf-8', 'replace').strip()
+            start += width
+        records.append(record)
+    if strict:
+        assert len(data) == header_length + count * record_length + 1
+    return [name for name, _ in fields], records
+
+
+def read_shp(shp_path):
+    """Read the shape type and the points of the records of a shp file.
+
+    The points of the parts of a record are returned one after the other.
+    """
+    with open(shp_path, 'rb') as shp_file:
+        data = shp_file.read()
+    assert struct.unpack('>i', data[24:28])[0] * 2 == len(data)
+    shape_type = struct.unpack('<i', data[32:36])[0]
+    shapes = []
+    position = 100
+    while position < len(data):
+        _, length = struct.unpack('>2i', data[position:position + 8])
+        content = data[position + 8:position + 8 + length * 2]
+        if shape_type == 1:
+            shapes.append([struct.unpack('<2d', content[4:20])])
+        else:
+            parts, points = struct.unpack('<2i', content[36:44])
+            start = 44 + 4 * parts
+            coordinates = struct.unpack(
+                '<%sd' % (2 * points), content[start:start + 16 * points])
+            shapes.append(list(zip(coordinates[::2], coordinates[1::2])))
+        position += 8 + length * 2
+    return shape_type, shapes
@@ -3,7 +3,18 @@
 :copyright: (c) 2013 by Tim Sutton
 :license: GPLv3, see LICENSE for more details.
 """
+import threading
+import zipfile
+from io import BytesIO
+from tempfile import mkdtemp
+from unittest import mock
+
+from reporter import config
+from reporter import jobs
+from reporter import views
+from reporter.jobs import ShapefileJobQueue
 from reporter.views import app
+from reporter.test.helpers import FIXTURE_PATH
 from reporter.test.logged_unittest import LoggedTestCase
 from reporter import LOGGER
 
@@ -29,3 +40,42 @@ class AppTestCase(LoggedTestCase):
         except Exception as e:
             LOGGER.exception('Basic front page load failed.')
             raise e
+
+    def test_shapefile_job(self):
+        """Test the submission, status and result of a download job."""
+        queue = ShapefileJobQueue(max_workers=1, max_queued=1, max_age=3600)
+        with mock.patch.object(config, 'CACHE_DIR', mkdtemp()), \
+                mock.patch.object(config, 'LOG_DIR', mkdtemp()), \
+                mock.patch.object(config, 'SHAPEFILE_ENGINE', 'python'), \
+                mock.patch.object(views, 'LOCAL_PBF_PATH', FIXTURE_PATH), \
+                mock.patch.object(jobs, '_SHAPEFILE_JOBS', queue):
+            self.assertEqual(
+                self.app.post('/unknown-shp/jobs').status_code, 404)
+            result = self.app.post(
+                '/buildings-shp/jobs',
+                data={'bbox': config.BBOX, 'output_prefix': 'test-'})
+            self.assertEqual(result.status_code, 202)
+            job = result.get_json()
+            self.assertEqual(
+                result.headers['Location'], job['status_url'])
+
+            for _ in range(500):
+                status = self.app.get(job['status_url']).get_json()
+                if status['state'] in ('done', 'failed'):
+                    break
+                threading.Event().wait(0.01)
+            self.assertEqual(status['state'], 'done', status['error'])
+            self.assertEqual(
+                [stage['state'] for stage in status['stages']],
+                ['done', 'skipped', 'done', 'done'])
+
+            result = self.app.get(job['result_url'])
+            self.assertEqual(result.status_code, 200)
+            self.assertEqual(result.mimetype, 'application/zip')
+            self.assertEqual(
+                result.headers['Content-Disposition'],
+                'attachment; filename=test-buildings.zip')
+            names = zipfile.ZipFile(BytesIO(result.data)).namelist()
+            self.assertIn('test-buildings.shp', names)
+            self.assertEqual(
+                self.app.get('/jobs/unknown/result').status_code, 404)
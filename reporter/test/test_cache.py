@@ -0,0 +1,200 @@
+# coding=utf-8
+"""Test cases for the cache module.
+:copyright: (c) 2013 by Tim Sutton
+:license: GPLv3, see LICENSE for more details.
+"""
+import os
+import threading
+import time
+from datetime import date
+from tempfile import mkdtemp
+from unittest import mock
+
+from reporter import cache
+from reporter.cache import CacheManager, ExtractIndex, cache_lock
+from reporter.test.logged_unittest import LoggedTestCase
+
+
+class CacheTestCase(LoggedTestCase):
+    """Test the cache helpers."""
+
+    def test_cache_lock(self):
+        """Check that only one thread at a time holds an entry lock."""
+        file_path = os.path.join(mkdtemp(), 'entry.osm')
+        active = []
+        overlaps = []
+
+        def worker():
+            with cache_lock(file_path):
+                active.append(1)
+                if len(active) > 1:
+                    overlaps.append(1)
+                time.sleep(0.01)
+                active.pop()
+
+        threads = [threading.Thread(target=worker) for _ in range(5)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(overlaps, [])
+        # The lock file is tidied away once nobody needs it.
+        self.assertFalse(os.path.exists('%s.lock' % file_path))
+
+    def test_cache_manager_lru(self):
+        """Check that the least recently used entries are evicted first."""
+        cache_path = mkdtemp()
+        manager = CacheManager(cache_path, max_entries=2)
+        paths = []
+        for name in ['a', 'b', 'c']:
+            file_path = os.path.join(cache_path, '%s.osm' % name)
+            with open(file_path, 'wb') as file_handle:
+                file_handle.write(b'<osm/>')
+            manager.record(file_path)
+            paths.append(file_path)
+        # Reading 'a' again makes 'b' the least recently used.
+        manager.record(paths[0])
+        manager.sweep()
+        self.assertTrue(os.path.exists(paths[0]))
+        self.assertFalse(os.path.exists(paths[1]))
+        self.assertTrue(os.path.exists(paths[2]))
+        self.assertEqual(len(manager), 2)
+
+    def test_cache_manager_size_and_age(self):
+        """Check that old entries go and the size limit is honoured."""
+        cache_path = mkdtemp()
+        manager = CacheManager(cache_path, max_age=60, max_bytes=15)
+        old_path = os.path.join(cache_path, 'old.osm')
+        with open(old_path, 'wb') as file_handle:
+            file_handle.write(b'0123456789')
+        old_time = time.time() - 120
+        os.utime(old_path, (old_time, old_time))
+        for name in ['first', 'second']:
+            with open(os.path.join(cache_path, '%s.osm' % name), 'wb') as f:
+                f.write(b'0123456789')
+            manager.record(os.path.join(cache_path, '%s.osm' % name))
+        # Files which are not cache entries are left alone.
+        other_path = os.path.join(cache_path, 'reporter.log')
+        open(other_path, 'w').close()
+
+        manager.sweep()
+        self.assertEqual(
+            sorted(os.listdir(cache_path)), ['reporter.log', 'second.osm'])
+        self.assertEqual(manager.total_bytes, 10)
+
+    def test_cache_manager_companions(self):
+        """Check that the files derived from an entry go with it."""
+        cache_path = mkdtemp()
+        manager = CacheManager(
+            cache_path, max_entries=1, companions=('.index',))
+        for name in ['old', 'new', 'gone']:
+            with open(os.path.join(cache_path, '%s.osm.index' % name), 'w'):
+                pass
+        for name in ['old', 'new']:
+            file_path = os.path.join(cache_path, '%s.osm' % name)
+            with open(file_path, 'wb') as file_handle:
+                file_handle.write(b'<osm/>')
+            manager.record(file_path)
+        manager.sweep()
+        self.assertEqual(
+            sorted(os.listdir(cache_path)), ['new.osm', 'new.osm.index'])
+
+    def test_cache_manager_max_ages(self):
+        """Check that the max age of an entry is kept across restarts."""
+        cache_path = mkdtemp()
+        old_time = time.time() - 120
+        paths = []
+        for name in ['boundary', 'roads']:
+            file_path = os.path.join(cache_path, '%s.osm' % name)
+            with open(file_path, 'wb') as file_handle:
+                file_handle.write(b'<osm/>')
+            os.utime(file_path, (old_time, old_time))
+            paths.append(file_path)
+        manager = CacheManager(cache_path, max_age=60)
+        manager.record(paths[0], 24 * 3600)
+        manager.record(paths[1])
+        self.assertEqual(
+            sorted(os.listdir(cache_path)),
+            ['boundary.osm', 'boundary.osm.max-age', 'roads.osm'])
+
+        # Another process only has the files.
+        CacheManager(cache_path, max_age=60).sweep()
+        self.assertEqual(
+            sorted(os.listdir(cache_path)),
+            ['boundary.osm', 'boundary.osm.max-age'])
+
+        manager.record(paths[0], 60)
+        self.assertEqual(os.listdir(cache_path), ['boundary.osm'])
+        manager.sweep()
+        self.assertEqual(os.listdir(cache_path), [])
+
+    def test_cache_manager_leftovers(self):
+        """Check that only our partial files and working files go."""
+        cache_path = mkdtemp()
+        work_root = os.path.join(mkdtemp(), 'osm-reporter')
+        old_time = time.time() - 120
+        today = date.today().isoformat()
+        paths = {}
+        for key, relative_path in [
+                ('old_part', '.entry.osm.1234.part'),
+                ('new_part', '.entry.osm.5678.part'),
+                ('directory', 'someone_else/file'),
+                ('old_work', '%s/user/buildings/tmp1/b.shp' % today),
+                ('new_work', '%s/user/buildings/tmp2/b.shp' % today),
+                ('old_day', '2012-08-23/user/impacts/tmp3.zip')]:
+            root = cache_path
+            if key.endswith(('work', 'day')):
+                root = work_root
+            paths[key] = os.path.join(root, relative_path)
+            if not os.path.exists(os.path.dirname(paths[key])):
+                os.makedirs(os.path.dirname(paths[key]))
+            open(paths[key], 'w').close()
+        for key in ['old_part', 'directory']:
+            os.utime(paths[key], (old_time, old_time))
+        for key in ['old_work', 'old_day']:
+            os.utime(
+                os.path.dirname(paths[key])
+                if key == 'old_work' else paths[key],
+                (old_time, old_time))
+        os.utime(
+            os.path.dirname(paths['directory']), (old_time, old_time))
+
+        with mock.patch.object(
+                cache, 'work_dir_root', return_value=work_root):
+            CacheManager(cache_path, max_age=60).sweep()
+            self.assertTrue(os.path.exists(paths['old_part']))
+            CacheManager(cache_path, max_age=60, sweep_leftovers=True).sweep()
+        self.assertFalse(os.path.exists(paths['old_part']))
+        self.assertTrue(os.path.exists(paths['new_part']))
+        self.assertTrue(os.path.exists(paths['directory']))
+        self.assertFalse(os.path.exists(os.path.dirname(paths['old_work'])))
+        self.assertTrue(os.path.exists(paths['new_work']))
+        self.assertEqual(os.listdir(work_root), [today])
+
+    def test_extract_index(self):
+        """Check that we find the smallest fresh extract covering a bbox."""
+        cache_path = mkdtemp()
+        index = ExtractIndex()
+        bboxes = {
+            'big': (-35.0, 20.0, -33.0, 21.0),
+            'small': (-34.1, 20.4, -34.0, 20.5),
+            'elsewhere': (-10.0, 10.0, -9.0, 11.0),
+        }
+        for name, bbox in bboxes.items():
+            file_path = os.path.join(cache_path, '%s.osm' % name)
+            open(file_path, 'w').close()
+            coordinates = dict(
+                zip(['SW_lat', 'SW_lng', 'NE_lat', 'NE_lng'], bbox))
+            index.add(('buildings', 'meta'), coordinates, file_path)
+
+        request = {
+            'SW_lat': -34.05, 'SW_lng': 20.45,
+            'NE_lat': -34.01, 'NE_lng': 20.46, 'print_mode': 'meta'}
+        found = index.find(('buildings', 'meta'), request, 3600)
+        self.assertEqual(found, os.path.join(cache_path, 'small.osm'))
+        self.assertIsNone(index.find(('roads', 'meta'), request, 3600))
+
+        os.remove(found)
+        found = index.find(('buildings', 'meta'), request, 3600)
+        self.assertEqual(found, os.path.join(cache_path, 'big.osm'))
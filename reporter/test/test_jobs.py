@@ -0,0 +1,120 @@
+# coding=utf-8
+"""Test cases for the shapefile download jobs.
+:copyright: (c) 2013 by Tim Sutton
+:license: GPLv3, see LICENSE for more details.
+"""
+import os
+import threading
+import unittest
+from tempfile import mkdtemp
+from unittest import mock
+
+from reporter import config
+from reporter import jobs
+from reporter.exceptions import JobQueueFullException
+from reporter.jobs import (
+    DONE,
+    FAILED,
+    Job,
+    JobQueue,
+    ShapefileJobQueue,
+    SHAPEFILE_JOB_STAGES,
+    submit_shapefile_job)
+from reporter.test.helpers import FIXTURE_PATH
+from reporter.test.logged_unittest import LoggedTestCase
+
+
+def stage_states(job):
+    """Get the state of each stage of a job."""
+    return [stage['state'] for stage in job.status()['stages']]
+
+
+def wait(job):
+    """Wait for a job submitted to a queue to finish."""
+    for _ in range(500):
+        if job.is_finished:
+            return job
+        threading.Event().wait(0.01)
+    raise AssertionError('Job %s did not finish' % job.name)
+
+
+class JobsTestCase(LoggedTestCase):
+    """Test the job queue."""
+
+    def test_stages(self):
+        """Check the states of the stages as a job goes through them."""
+        job = Job('test', ('download', 'import', 'extract', 'package'))
+        self.assertEqual(job.state, 'queued')
+        job.enter('download')
+        job.enter('extract')
+        self.assertEqual(job.state, 'running')
+        self.assertEqual(
+            stage_states(job), ['done', 'pending', 'running', 'pending'])
+        job.finish('result.zip')
+        self.assertEqual(
+            stage_states(job), ['done', 'skipped', 'done', 'skipped'])
+        self.assertEqual(job.outcome(), (DONE, 'result.zip'))
+
+        job = Job('test', ('download', 'import'))
+        job.enter('download')
+        job.fail('Timeout')
+        self.assertEqual(stage_states(job), ['failed', 'pending'])
+        self.assertEqual(job.status()['error'], 'Timeout')
+
+    def test_queue(self):
+        """Check that the queue is bounded and reports failures."""
+        release = threading.Event()
+
+        def blocked(job):
+            job.enter('work')
+            release.wait(5)
+            return job.name
+
+        def broken(job):
+            raise ValueError('broken')
+
+        queue = JobQueue(max_workers=1, max_queued=1, max_age=3600)
+        first = queue.submit(Job('first', ('work',)), blocked)
+        second = queue.submit(Job('second', ('work',)), blocked)
+        with self.assertRaises(JobQueueFullException):
+            queue.submit(Job('third', ('work',)), blocked)
+        release.set()
+        self.assertEqual(wait(first).result, 'first')
+        self.assertEqual(wait(second).result, 'second')
+        self.assertIs(queue.get(first.id), first)
+
+        job = wait(queue.submit(Job('broken', ('work',)), broken))
+        self.assertEqual(job.state, FAILED)
+        self.assertEqual(job.error, 'broken')
+        self.assertEqual(stage_states(job), ['pending'])
+
+    def test_prune(self):
+        """Check that old jobs are forgotten with their zips."""
+        zip_path = os.path.join(mkdtemp(), 'buildings.zip')
+        open(zip_path, 'w').close()
+        queue = ShapefileJobQueue(max_workers=1, max_queued=1, max_age=0)
+        job = wait(queue.submit(Job('old', ()), lambda job: zip_path))
+        threading.Event().wait(0.01)
+        self.assertEqual(queue.prune(), [job])
+        self.assertIsNone(queue.get(job.id))
+        self.assertFalse(os.path.exists(zip_path))
+
+    def test_shapefile_job(self):
+        """Check a shapefile job from an OSM file."""
+        queue = ShapefileJobQueue(max_workers=1, max_queued=1, max_age=3600)
+        with mock.patch.object(config, 'CACHE_DIR', mkdtemp()), \
+                mock.patch.object(config, 'SHAPEFILE_ENGINE', 'python'), \
+                mock.patch.object(jobs, '_SHAPEFILE_JOBS', queue):
+            job = wait(submit_shapefile_job(
+                'buildings', {}, source_path=FIXTURE_PATH))
+        self.assertEqual(job.state, DONE, job.error)
+        self.assertEqual(
+            [stage['name'] for stage in job.status()['stages']],
+            list(SHAPEFILE_JOB_STAGES))
+        self.assertEqual(
+            stage_states(job), ['done', 'skipped', 'done', 'done'])
+        self.assertTrue(os.path.exists(job.result))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -3,17 +3,32 @@
 :copyright: (c) 2013 by Tim Sutton
 :license: GPLv3, see LICENSE for more details.
 """
+import gzip
+import io
 import os
+import re
 import datetime
 import time
+import threading
+from tempfile import mkdtemp
+from unittest import mock
+from urllib.parse import unquote
 
 from reporter.utilities import LOGGER
+from reporter import osm
 from reporter.osm import (
     clear_osm_cache,
+    fetch_osm,
+    stream_to_file,
     load_osm_document,
     import_and_extract_shapefile,
     check_string)
-from reporter.test.helpers import FIXTURE_PATH
+from reporter.exceptions import (
+    OverpassConcurrentRequestException,
+    OverpassTimeoutException)
+from reporter.osm_document import clip_osm_document, iter_osm_elements
+from reporter.overpass import OverpassEndpoints
+from reporter.test.helpers import FIXTURE_PATH, OverpassStandIn
 from reporter import config
 
 from reporter.test.logged_unittest import LoggedTestCase
@@ -99,11 +114,347 @@ class OsmTestCase(LoggedTestCase):
         self.assertEqual(file_time, file_time2, message)
         LOGGER.info('....OK')
 
+    def test_load_osm_document_single_flight(self):
+        """Check that concurrent loads of one file download it once."""
+        file_path = os.path.join(mkdtemp(), 'coalesced.osm')
+        calls = []
+
+        def slow_fetch(path, url):
+            calls.append(url)
+            time.sleep(0.05)
+            with open(path, 'wb') as file_handle:
+                file_handle.write(b'<osm/>')
+
+        def worker():
+            load_osm_document(file_path, 'http://example.com').close()
+
+        with mock.patch.object(osm, 'fetch_osm', side_effect=slow_fetch):
+            threads = [threading.Thread(target=worker) for _ in range(5)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        self.assertEqual(len(calls), 1)
+
+    def test_load_osm_document_stale_while_revalidate(self):
+        """Check that an expired file is served while it is refreshed."""
+        file_path = os.path.join(mkdtemp(), 'stale.osm')
+        with open(file_path, 'wb') as file_handle:
+            file_handle.write(b'<osm>old</osm>')
+        old_time = time.time() - 120
+        os.utime(file_path, (old_time, old_time))
+        fetched = threading.Event()
+
+        def fetch(path, url):
+            with open(path, 'wb') as new_file:
+                new_file.write(b'<osm>new</osm>')
+            fetched.set()
+
+        with mock.patch.object(osm, 'fetch_osm', side_effect=fetch):
+            file_handle = load_osm_document(
+                file_path, 'http://example.com', 60, True)
+            self.assertEqual(file_handle.read(), b'<osm>old</osm>')
+            file_handle.close()
+            self.assertTrue(fetched.wait(5))
+
+            # Without it, the caller waits for the new file.
+            os.utime(file_path, (old_time, old_time))
+            file_handle = load_osm_document(
+                file_path, 'http://example.com', 60, False)
+            self.assertEqual(file_handle.read(), b'<osm>new</osm>')
+            file_handle.close()
+
+    def test_get_osm_file_from_containing_extract(self):
+        """Check that a smaller bbox is clipped from a cached extract."""
+        calls = []
+
+        def fetch(path, url):
+            calls.append(url)
+            with open(FIXTURE_PATH, 'rb') as source:
+                with open(path, 'wb') as file_handle:
+                    file_handle.write(source.read())
+
+        big = {
+            'SW_lat': -34.03, 'SW_lng': 20.44,
+            'NE_lat': -34.01, 'NE_lng': 20.46}
+        small = {
+            'SW_lat': -34.0200, 'SW_lng': 20.4480,
+            'NE_lat': -34.0185, 'NE_lng': 20.4530}
+        with mock.patch.object(osm, 'fetch_osm', side_effect=fetch), \
+                mock.patch.object(config, 'CACHE_DIR', mkdtemp()), \
+                mock.patch.object(config, 'CACHE_REUSE_CONTAINING_BBOX', True):
+            osm.get_osm_file(big, 'buildings', 'meta').close()
+            file_handle = osm.get_osm_file(small, 'buildings', 'meta')
+            clipped = file_handle.read()
+            file_handle.close()
+        self.assertEqual(len(calls), 1)
+        self.assertIn(b'<way', clipped)
+        self.assertLess(len(clipped), os.path.getsize(FIXTURE_PATH))
+
+    def test_get_osm_file_tiled(self):
+        """Check that overlapping bboxes share their grid tiles."""
+        calls = []
+
+        def fetch(path, url):
+            calls.append(url)
+            with open(FIXTURE_PATH, 'rb') as source:
+                with open(path, 'wb') as file_handle:
+                    file_handle.write(source.read())
+
+        west = {
+            'SW_lat': -34.0200, 'SW_lng': 20.4480,
+            'NE_lat': -34.0185, 'NE_lng': 20.4530}
+        east = {
+            'SW_lat': -34.0200, 'SW_lng': 20.4500,
+            'NE_lat': -34.0185, 'NE_lng': 20.4580}
+        with mock.patch.object(osm, 'fetch_osm', side_effect=fetch), \
+                mock.patch.object(config, 'CACHE_DIR', mkdtemp()), \
+                mock.patch.object(config, 'OVERPASS_TILE_ZOOM', 16):
+            file_handle = osm.get_osm_file(west, 'buildings', 'meta')
+            data = file_handle.read()
+            file_handle.close()
+            first_calls = len(calls)
+            osm.get_osm_file(east, 'buildings', 'meta').close()
+        self.assertEqual(first_calls, 2)
+        # Only the tile east of the first bbox had to be downloaded.
+        self.assertEqual(len(calls), 3)
+        self.assertIn(b'<way', data)
+
+    def test_get_osm_file_split_on_timeout(self):
+        """Check that a bbox Overpass can't handle is fetched in quarters."""
+        bbox = {
+            'SW_lat': -34.0212, 'SW_lng': 20.4463,
+            'NE_lat': -34.0181, 'NE_lng': 20.4562}
+        cache_path = mkdtemp()
+        calls = []
+
+        def fetch(path, url):
+            calls.append(url)
+            south, west, north, east = [
+                float(value) for value in re.search(
+                    r'\((-?[\d.]+),(-?[\d.]+),(-?[\d.]+),(-?[\d.]+)\)',
+                    unquote(url)).groups()]
+            if (south, west) == (bbox['SW_lat'], bbox['SW_lng']):
+                if (north, east) == (bbox['NE_lat'], bbox['NE_lng']):
+                    raise OverpassTimeoutException
+            clip_osm_document(FIXTURE_PATH, path, {
+                'SW_lat': south, 'SW_lng': west,
+                'NE_lat': north, 'NE_lng': east})
+
+        with mock.patch.object(osm, 'fetch_osm', side_effect=fetch), \
+                mock.patch.object(config, 'CACHE_DIR', cache_path):
+            file_handle = osm.get_osm_file(dict(bbox), 'buildings', 'meta')
+            file_handle.close()
+        self.assertEqual(len(calls), 5)
+
+        expected_path = os.path.join(cache_path, 'expected.osm')
+        clip_osm_document(FIXTURE_PATH, expected_path, bbox)
+
+        def way_ids(path):
+            return [
+                element.get('id')
+                for _, element in iter_osm_elements(path)
+                if element.tag == 'way']
+
+        self.assertEqual(
+            way_ids(file_handle.name), way_ids(expected_path))
+
+    def test_get_osm_file_no_split_on_timeout(self):
+        """Check that timeouts are raised when splitting is disabled."""
+        bbox = {
+            'SW_lat': -34.0212, 'SW_lng': 20.4463,
+            'NE_lat': -34.0181, 'NE_lng': 20.4562}
+        with mock.patch.object(
+                osm, 'fetch_osm', side_effect=OverpassTimeoutException), \
+                mock.patch.object(config, 'CACHE_DIR', mkdtemp()), \
+                mock.patch.object(config, 'OVERPASS_SPLIT_ON_TIMEOUT', False):
+            with self.assertRaises(OverpassTimeoutException):
+                osm.get_osm_file(bbox, 'buildings', 'meta')
+
+    def test_load_osm_part_backoff(self):
+        """Check that a part is retried while Overpass is busy."""
+        bbox = {
+            'SW_lat': -34.0212, 'SW_lng': 20.4463,
+            'NE_lat': -34.0181, 'NE_lng': 20.4562}
+        calls = []
+
+        def fetch(path, url):
+            calls.append(url)
+            if len(calls) < 3:
+                raise OverpassConcurrentRequestException
+            with open(path, 'wb') as file_handle:
+                file_handle.write(b'<osm version="0.6"></osm>')
+
+        with mock.patch.object(osm, 'fetch_osm', side_effect=fetch), \
+                mock.patch.object(config, 'CACHE_DIR', mkdtemp()), \
+                mock.patch.object(config, 'OVERPASS_RETRY_DELAY', 0):
+            file_path = osm.load_osm_part('buildings', 'meta', bbox, 60)
+        self.assertEqual(len(calls), 3)
+        self.assertTrue(os.path.exists(file_path))
+
+    def test_fetch_osm_streams_to_file(self):
+        """Check that a download is copied to its final path untouched."""
+        with open(FIXTURE_PATH, 'rb') as source:
+            data = source.read()
+        cache_path = mkdtemp()
+        file_path = os.path.join(cache_path, 'streamed.osm')
+        with OverpassStandIn(lambda path: (200, data, {})) as stand_in:
+            with mock.patch.object(osm, 'DOWNLOAD_CHUNK_SIZE', 1000):
+                fetch_osm(file_path, stand_in.url + '?data=node')
+        with open(file_path, 'rb') as result:
+            self.assertEqual(data, result.read())
+        # The temporary download must have been renamed, not copied.
+        self.assertEqual(os.listdir(cache_path), ['streamed.osm'])
+
+    def test_fetch_osm_runtime_error(self):
+        """Check the Overpass error marker is found across chunks."""
+        data = b''.join([
+            b'x' * 990,
+            b'<remark> runtime error: Query timed out',
+            b'</remark>'])
+        cache_path = mkdtemp()
+        file_path = os.path.join(cache_path, 'failed.osm')
+        with OverpassStandIn(lambda path: (200, data, {})) as stand_in:
+            with mock.patch.object(osm, 'DOWNLOAD_CHUNK_SIZE', 1000):
+                with self.assertRaises(OverpassTimeoutException):
+                    fetch_osm(file_path, stand_in.url + '?data=node')
+        self.assertEqual(os.listdir(cache_path), [])
+
+    def test_fetch_osm_concurrent_request(self):
+        """Check that a busy Overpass is reported as such."""
+        file_path = os.path.join(mkdtemp(), 'busy.osm')
+        with OverpassStandIn(lambda path: (429, b'', {})) as stand_in:
+            with self.assertRaises(OverpassConcurrentRequestException):
+                fetch_osm(file_path, stand_in.url + '?data=node')
+
+    def test_fetch_osm_failover(self):
+        """Check that queries fail over to the next Overpass server."""
+        with open(FIXTURE_PATH, 'rb') as source:
+            data = source.read()
+        file_path = os.path.join(mkdtemp(), 'failover.osm')
+        with OverpassStandIn(lambda path: (429, b'', {})) as busy, \
+                OverpassStandIn(lambda path: (200, data, {})) as idle:
+            endpoints = OverpassEndpoints([busy.url, idle.url])
+            with mock.patch.object(
+                    osm, 'overpass_endpoints', return_value=endpoints):
+                fetch_osm(file_path, busy.url + '?data=node')
+                # The busy server is avoided while it cools down.
+                fetch_osm(file_path, busy.url + '?data=node')
+        self.assertEqual(len(busy.requests), 1)
+        self.assertEqual(len(idle.requests), 2)
+        with open(file_path, 'rb') as result:
+            self.assertEqual(result.read(), data)
+
+    def test_stream_to_file_gzip(self):
+        """Check gzip responses are kept as is or decompressed as needed."""
+        with open(FIXTURE_PATH, 'rb') as source:
+            data = source.read()
+        body = gzip.compress(data)
+        cache_path = mkdtemp()
+        compressed_path = os.path.join(cache_path, 'kept.osm.gz')
+        plain_path = os.path.join(cache_path, 'decompressed.osm')
+        recompressed_path = os.path.join(cache_path, 'compressed.osm.gz')
+        with mock.patch.object(osm, 'DOWNLOAD_CHUNK_SIZE', 1000):
+            stream_to_file(io.BytesIO(body), compressed_path, 'gzip')
+            stream_to_file(io.BytesIO(body), plain_path, 'gzip')
+            stream_to_file(io.BytesIO(data), recompressed_path)
+            with self.assertRaises(OverpassTimeoutException):
+                stream_to_file(
+                    io.BytesIO(gzip.compress(
+                        data + b'<remark> runtime error: timed out')),
+                    os.path.join(cache_path, 'failed.osm.gz'),
+                    'gzip')
+        with open(compressed_path, 'rb') as result:
+            self.assertEqual(result.read(), body)
+        with open(plain_path, 'rb') as result:
+            self.assertEqual(result.read(), data)
+        with gzip.open(recompressed_path, 'rb') as result:
+            self.assertEqual(result.read(), data)
+        self.assertEqual(len(os.listdir(cache_path)), 3)
+
+    def test_get_osm_file_compressed(self):
+        """Check the cache can store documents compressed."""
+        def fetch(path, url):
+            with open(FIXTURE_PATH, 'rb') as source:
+                stream_to_file(source, path)
+
+        bbox = {
+            'SW_lat': -34.0212, 'SW_lng': 20.4463,
+            'NE_lat': -34.0181, 'NE_lng': 20.4562}
+        with mock.patch.object(osm, 'fetch_osm', side_effect=fetch), \
+                mock.patch.object(config, 'CACHE_DIR', mkdtemp()), \
+                mock.patch.object(config, 'CACHE_COMPRESSION', 'gzip'):
+            file_handle = osm.get_osm_file(bbox, 'buildings', 'meta')
+            with file_handle:
+                data = file_handle.read()
+        self.assertTrue(file_handle.name.endswith('.osm.gz'))
+        with open(FIXTURE_PATH, 'rb') as source:
+            self.assertEqual(data, source.read())
+
     def test_import_and_extract_shapefile(self):
         """Test the roads to shp converter."""
-        zip_path = import_and_extract_shapefile('buildings', FIXTURE_PATH)
+        with mock.patch.object(config, 'CACHE_DIR', mkdtemp()):
+            zip_path = import_and_extract_shapefile('buildings', FIXTURE_PATH)
         self.assertTrue(os.path.exists(zip_path), zip_path)
 
+    def test_cached_shapefile(self):
+        """Check that the zips are exported once per data and options."""
+        source_path = os.path.join(mkdtemp(), 'buildings.osm')
+        with open(FIXTURE_PATH, 'rb') as fixture, \
+                open(source_path, 'wb') as source:
+            source.write(fixture.read())
+        with mock.patch.object(config, 'CACHE_DIR', mkdtemp()), \
+                mock.patch.object(config, 'SHAPEFILE_ENGINE', 'python'), \
+                mock.patch.object(
+                    osm, 'export_shapefile',
+                    side_effect=osm.export_shapefile) as export:
+            zip_path = import_and_extract_shapefile('buildings', source_path)
+            self.assertEqual(
+                import_and_extract_shapefile('buildings', source_path),
+                zip_path)
+            self.assertEqual(export.call_count, 1)
+            self.assertEqual(os.path.dirname(zip_path), config.CACHE_DIR)
+
+            french_path = import_and_extract_shapefile(
+                'buildings', source_path, lang='fr')
+            self.assertNotEqual(french_path, zip_path)
+            self.assertEqual(export.call_count, 2)
+
+            # Other data, even at the same path, is exported again.
+            with open(source_path, 'ab') as source:
+                source.write(b'\n')
+            self.assertNotEqual(
+                import_and_extract_shapefile('buildings', source_path),
+                zip_path)
+            self.assertEqual(export.call_count, 3)
+
+            with mock.patch.object(config, 'EXPORT_CACHE', False):
+                self.assertNotEqual(
+                    os.path.dirname(
+                        import_and_extract_shapefile(
+                            'buildings', source_path)),
+                    config.CACHE_DIR)
+            self.assertEqual(export.call_count, 4)
+
+    def test_export_cache_path_resources(self):
+        """Check that editing a resource file changes the cached zip."""
+        generic_path = os.path.join(mkdtemp(), 'generic')
+        with open('%s.prj' % generic_path, 'w') as prj:
+            prj.write('GEOGCS["WGS 84"]')
+        with mock.patch.object(config, 'CACHE_DIR', mkdtemp()), \
+                mock.patch.object(
+                    osm, 'generic_shapefile_base_path',
+                    return_value=generic_path):
+            zip_path = osm.export_cache_path('buildings', FIXTURE_PATH)
+            self.assertEqual(
+                osm.export_cache_path('buildings', FIXTURE_PATH), zip_path)
+            self.assertNotEqual(
+                osm.export_cache_path('roads', FIXTURE_PATH), zip_path)
+            with open('%s.prj' % generic_path, 'a') as prj:
+                prj.write('\n')
+            self.assertNotEqual(
+                osm.export_cache_path('buildings', FIXTURE_PATH), zip_path)
+
     def test_clear_osm_cache(self):
         """Test we can clear the catch properly."""
         cache_path = config.CACHE_DIR
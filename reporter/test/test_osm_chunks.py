@@ -0,0 +1,117 @@
+# coding=utf-8
+"""Test cases for the parallel parsing of OSM documents.
+:copyright: (c) 2013 by Tim Sutton
+:license: GPLv3, see LICENSE for more details.
+"""
+import os
+import shutil
+import unittest
+import xml.sax
+from tempfile import mkdtemp
+from unittest import mock
+
+from reporter import config
+from reporter import osm_chunks
+from reporter import process_pool
+from reporter.osm_chunks import (
+    WAY_START,
+    chunked_osm_contribution_counts,
+    chunked_osm_object_counts,
+    way_chunks)
+from reporter.osm_way_parser import OsmMultiTagParser, OsmParser
+from reporter.test.helpers import FIXTURE_PATH
+from reporter.test.logged_unittest import LoggedTestCase
+from reporter.utilities import osm_object_contributions
+
+
+class OsmChunksTestCase(LoggedTestCase):
+    """Test the chunked parsing of OSM documents."""
+
+    def test_way_chunks(self):
+        """Check that chunks start at a way and cover all the ways."""
+        with open(FIXTURE_PATH, 'rb') as source:
+            data = source.read()
+        chunks = way_chunks(FIXTURE_PATH, 5000)
+        self.assertGreater(len(chunks), 2)
+        self.assertEqual(chunks[0][0], data.find(WAY_START))
+        self.assertEqual(chunks[-1][1], data.rfind(b'</osm>'))
+        for (_, end), (start, _) in zip(chunks, chunks[1:]):
+            self.assertEqual(end, start)
+            self.assertTrue(data.startswith(WAY_START, start))
+
+    def test_chunked_osm_object_counts(self):
+        """Check that the counts are those of OsmParser."""
+        parser = OsmParser(tag_name='building')
+        with open(FIXTURE_PATH, 'rb') as source:
+            xml.sax.parse(source, parser)
+        expected = (
+            parser.wayCountDict,
+            parser.nodeCountDict,
+            parser.userDayCountDict)
+        for processes in (1, 2):
+            with mock.patch.object(
+                    config, 'OSM_PARSER_PROCESSES', processes), \
+                    mock.patch.object(osm_chunks, 'CHUNK_SIZE', 5000):
+                self.assertEqual(
+                    chunked_osm_object_counts(FIXTURE_PATH, 'building'),
+                    expected)
+
+    def test_chunked_osm_contribution_counts(self):
+        """Check that the counts are those of OsmMultiTagParser."""
+        tag_names = ['building', 'highway', 'flood_prone']
+        parser = OsmMultiTagParser(tag_names)
+        with open(FIXTURE_PATH, 'rb') as source:
+            parser.parse(source)
+        with mock.patch.object(config, 'OSM_PARSER_PROCESSES', 2), \
+                mock.patch.object(osm_chunks, 'CHUNK_SIZE', 5000):
+            counts = chunked_osm_contribution_counts(FIXTURE_PATH, tag_names)
+        self.assertEqual(
+            counts,
+            (parser.wayCountDicts,
+             parser.nodeCountDicts,
+             parser.userDayCountDicts))
+
+    def test_chunked_invalid_document(self):
+        """Check that a broken way is reported as a parse error."""
+        file_path = os.path.join(mkdtemp(), 'broken.osm')
+        with open(file_path, 'wb') as document:
+            document.write(
+                b'<osm><way id="1" user="a" timestamp="2012-12-09T22:40:53Z">'
+                b'<nd ref="1"></way></osm>')
+        with mock.patch.object(config, 'OSM_PARSER_PROCESSES', 2):
+            with self.assertRaises(xml.sax.SAXParseException):
+                chunked_osm_object_counts(file_path, 'building')
+
+    def test_osm_object_contributions_in_parallel(self):
+        """Check that big documents are parsed in parallel."""
+        file_path = os.path.join(mkdtemp(), 'big.osm')
+        shutil.copy(FIXTURE_PATH, file_path)
+        with open(FIXTURE_PATH, 'rb') as source:
+            expected = osm_object_contributions(source, 'building')
+        with mock.patch.object(config, 'OSM_PARSER_PROCESSES', 2), \
+                mock.patch.object(config, 'OSM_PARSER_PARALLEL_SIZE', 1), \
+                mock.patch.object(
+                    osm_chunks,
+                    '_parse_chunks',
+                    wraps=osm_chunks._parse_chunks) as parse_chunks:
+            with open(file_path, 'rb') as source:
+                self.assertEqual(
+                    osm_object_contributions(source, 'building'), expected)
+        self.assertTrue(parse_chunks.called)
+
+    def test_shared_pool(self):
+        """Check that the documents are parsed by the same pool."""
+        with mock.patch.object(config, 'OSM_PARSER_PROCESSES', 2), \
+                mock.patch.object(osm_chunks, 'CHUNK_SIZE', 5000), \
+                mock.patch.object(process_pool, '_POOLS', {}):
+            first = chunked_osm_object_counts(FIXTURE_PATH, 'building')
+            processes, pool = process_pool._POOLS['osm-chunks']
+            self.assertEqual(
+                chunked_osm_object_counts(FIXTURE_PATH, 'building'), first)
+            self.assertIs(process_pool._POOLS['osm-chunks'][1], pool)
+            pool.shutdown()
+        self.assertEqual(processes, 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,117 @@
+# coding=utf-8
+"""Test cases for the OSM document module.
+:copyright: (c) 2013 by Tim Sutton
+:license: GPLv3, see LICENSE for more details.
+"""
+import gzip
+import os
+import unittest
+from tempfile import mkdtemp
+from xml.etree.ElementTree import parse
+
+from reporter.test.logged_unittest import LoggedTestCase
+from reporter.osm_document import (
+    clip_osm_document,
+    merge_osm_documents,
+    open_osm_document)
+from reporter.test.helpers import FIXTURE_PATH
+
+
+class OsmDocumentTestCase(LoggedTestCase):
+    """Test the local operations on OSM documents."""
+
+    def test_clip_osm_document(self):
+        """Test that we can cut a smaller bbox out of a document."""
+        coordinates = {
+            'SW_lat': -34.0200,
+            'SW_lng': 20.4480,
+            'NE_lat': -34.0185,
+            'NE_lng': 20.4530
+        }
+        file_path = os.path.join(mkdtemp(), 'clipped.osm')
+        clip_osm_document(FIXTURE_PATH, file_path, coordinates)
+
+        def inside(node):
+            if node is None:
+                # The fixture misses some of the nodes of its ways.
+                return False
+            lat = float(node.get('lat'))
+            lng = float(node.get('lon'))
+            lat_inside = coordinates['SW_lat'] <= lat <= coordinates['NE_lat']
+            lng_inside = coordinates['SW_lng'] <= lng <= coordinates['NE_lng']
+            return lat_inside and lng_inside
+
+        source = parse(FIXTURE_PATH).getroot()
+        source_nodes = dict(
+            (node.get('id'), node) for node in source.iter('node'))
+        expected_ways = set(
+            way.get('id') for way in source.iter('way')
+            if any(inside(source_nodes.get(nd.get('ref')))
+                   for nd in way.iter('nd')))
+
+        clipped = parse(file_path).getroot()
+        self.assertEqual(clipped.get('generator'), 'Overpass API')
+        ways = set(way.get('id') for way in clipped.iter('way'))
+        self.assertTrue(ways)
+        self.assertLess(len(ways), len(source.findall('way')))
+        self.assertEqual(ways, expected_ways)
+
+        # Every way can still be built from the clipped document.
+        nodes = set(node.get('id') for node in clipped.iter('node'))
+        for way in clipped.iter('way'):
+            for nd in way.iter('nd'):
+                if nd.get('ref') in source_nodes:
+                    self.assertIn(nd.get('ref'), nodes)
+
+    def test_merge_osm_documents(self):
+        """Test that overlapping documents merge without duplicates."""
+        directory = mkdtemp()
+        west_path = os.path.join(directory, 'west.osm')
+        east_path = os.path.join(directory, 'east.osm')
+        clip_osm_document(FIXTURE_PATH, west_path, {
+            'SW_lat': -34.03, 'SW_lng': 20.44,
+            'NE_lat': -34.01, 'NE_lng': 20.452})
+        clip_osm_document(FIXTURE_PATH, east_path, {
+            'SW_lat': -34.03, 'SW_lng': 20.450,
+            'NE_lat': -34.01, 'NE_lng': 20.46})
+        file_path = os.path.join(directory, 'merged.osm')
+        merge_osm_documents([west_path, east_path], file_path)
+
+        def elements(path):
+            return [
+                (element.tag, element.get('id'))
+                for element in parse(path).getroot()
+                if element.tag in ('node', 'way', 'relation')]
+
+        merged = elements(file_path)
+        self.assertEqual(len(merged), len(set(merged)))
+        self.assertEqual(
+            set(merged), set(elements(west_path) + elements(east_path)))
+        # Sorted by type then id, as osm2pgsql wants it.
+        self.assertEqual(merged, sorted(merged, key=lambda item: (
+            ('node', 'way', 'relation').index(item[0]), int(item[1]))))
+        self.assertEqual(parse(file_path).getroot()[0].tag, 'note')
+
+    def test_compressed_osm_documents(self):
+        """Test that documents ending with .gz are read and written gzipped."""
+        directory = mkdtemp()
+        compressed_path = os.path.join(directory, 'compressed.osm.gz')
+        plain_path = os.path.join(directory, 'plain.osm')
+        coordinates = {
+            'SW_lat': -34.03, 'SW_lng': 20.44,
+            'NE_lat': -34.01, 'NE_lng': 20.46}
+        clip_osm_document(FIXTURE_PATH, compressed_path, coordinates)
+        clip_osm_document(compressed_path, plain_path, coordinates)
+        with open(plain_path, 'rb') as plain:
+            data = plain.read()
+        with gzip.open(compressed_path, 'rb') as compressed:
+            self.assertEqual(compressed.read(), data)
+        with open_osm_document(compressed_path) as document:
+            self.assertEqual(document.read(), data)
+            self.assertEqual(document.name, compressed_path)
+        self.assertLess(
+            os.path.getsize(compressed_path), os.path.getsize(plain_path))
+
+
+if __name__ == '__main__':
+    unittest.main()
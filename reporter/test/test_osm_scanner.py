@@ -0,0 +1,115 @@
+# coding=utf-8
+"""Test cases for the OSM document scanner.
+:copyright: (c) 2013 by Tim Sutton
+:license: GPLv3, see LICENSE for more details.
+"""
+import os
+import unittest
+import xml.sax
+from tempfile import mkdtemp
+
+from reporter.exceptions import UnsupportedOsmDocumentException
+from reporter.osm_node_parser import OsmNodeParser
+from reporter.osm_scanner import (
+    scan_nodes_by_user,
+    scan_osm_contribution_counts,
+    scan_osm_object_counts)
+from reporter.osm_way_parser import OsmExpatParser, OsmMultiTagParser
+from reporter.test.helpers import FIXTURE_PATH
+from reporter.test.logged_unittest import LoggedTestCase
+from reporter.utilities import osm_nodes_by_user, osm_object_contributions
+
+WAY = (
+    '<way id="1" version="1" timestamp="2012-12-09T22:40:53Z" '
+    'user="%s"><nd ref="1"/><nd ref="2"/><tag k="building" v="yes"/></way>')
+
+
+class OsmScannerTestCase(LoggedTestCase):
+    """Test the scanner against the xml parsers."""
+
+    def write_document(self, body, header='<osm version="0.6">'):
+        """Write a small document and return its path."""
+        file_path = os.path.join(mkdtemp(), 'document.osm')
+        with open(file_path, 'wb') as document:
+            document.write(
+                ('<?xml version="1.0" encoding="UTF-8"?>\n'
+                 '%s\n%s\n</osm>\n' % (header, body)).encode('utf-8'))
+        return file_path
+
+    def test_scan_osm_object_counts(self):
+        """Check that the counts are those of OsmExpatParser."""
+        for tag_name in ('building', 'highway'):
+            parser = OsmExpatParser(tag_name)
+            with open(FIXTURE_PATH, 'rb') as source:
+                parser.parse(source)
+            self.assertEqual(
+                scan_osm_object_counts(FIXTURE_PATH, tag_name),
+                (parser.wayCountDict,
+                 parser.nodeCountDict,
+                 parser.userDayCountDict))
+
+    def test_scan_osm_contribution_counts(self):
+        """Check that the counts are those of OsmMultiTagParser."""
+        tag_names = ['building', 'highway', 'flood_prone']
+        parser = OsmMultiTagParser(tag_names)
+        with open(FIXTURE_PATH, 'rb') as source:
+            parser.parse(source)
+        self.assertEqual(
+            scan_osm_contribution_counts(FIXTURE_PATH, tag_names),
+            (parser.wayCountDicts,
+             parser.nodeCountDicts,
+             parser.userDayCountDicts))
+
+    def test_scan_nodes_by_user(self):
+        """Check that the nodes are those found by OsmNodeParser."""
+        parser = OsmNodeParser('Babsie')
+        with open(FIXTURE_PATH, 'rb') as source:
+            xml.sax.parse(source, parser)
+        self.assertEqual(
+            scan_nodes_by_user(FIXTURE_PATH, 'Babsie'), parser.nodes)
+
+    def test_scan_escaped_user(self):
+        """Check that user names are unescaped like xml parsers do."""
+        file_path = self.write_document(WAY % 'Tom &amp; &quot;Jerry&quot;')
+        way_counts, _, _ = scan_osm_object_counts(file_path, 'building')
+        self.assertEqual(way_counts, {'Tom & "Jerry"': 1})
+
+    def test_unsupported_documents(self):
+        """Check that unexpected documents are left to the xml parsers."""
+        documents = [
+            # Comment
+            self.write_document('<!-- note -->' + WAY % 'a'),
+            # Single quoted attribute
+            self.write_document(WAY.replace('user="%s"', "user='%s'") % 'a'),
+            # Attributes of a tag in another order
+            self.write_document(
+                WAY.replace('k="building" v="yes"', 'v="yes" k="building"')
+                % 'a'),
+            # Truncated
+            self.write_document(WAY % 'a', header='<osm>'),
+        ]
+        with open(documents[-1], 'rb+') as document:
+            document.truncate(os.path.getsize(documents[-1]) - 8)
+        for file_path in documents:
+            with self.assertRaises(UnsupportedOsmDocumentException):
+                scan_osm_object_counts(file_path, 'building')
+
+    def test_fallback(self):
+        """Check that the utilities fall back to the xml parsers."""
+        node = (
+            '<node id="1" lat="1.5" lon="2.5" user=\'a\' '
+            'timestamp="2012-12-09T22:40:53Z"/>')
+        file_path = self.write_document(
+            node + WAY.replace('user="%s"', "user='%s'") % 'a')
+        with open(file_path, 'rb') as document:
+            contributions = osm_object_contributions(document, 'building')
+        self.assertEqual(
+            [(d['name'], d['ways'], d['nodes']) for d in contributions],
+            [('a', 1, 2)])
+        with open(file_path, 'rb') as document:
+            self.assertEqual(
+                osm_nodes_by_user(document, 'a'), [(1.5, 2.5)])
+
+
+if __name__ == '__main__':
+    unittest.main()
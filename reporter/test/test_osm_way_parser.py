@@ -3,11 +3,15 @@
 :copyright: (c) 2013 by Tim Sutton
 :license: GPLv3, see LICENSE for more details.
 """
+import io
 import xml
 import unittest
 
 from reporter.test.logged_unittest import LoggedTestCase
-from reporter.osm_way_parser import OsmParser
+from reporter.osm_way_parser import (
+    OsmExpatParser,
+    OsmMultiTagParser,
+    OsmParser)
 from reporter.test.helpers import FIXTURE_PATH
 
 
@@ -61,6 +65,45 @@ class OsmParserTestCase(LoggedTestCase):
         # OsmParser timeline test
         self.assertDictEqual(expected_timeline_dict, parser.userDayCountDict)
 
+    def test_expat_parser(self):
+        """Test that the expat parser counts like the sax parser."""
+        for tag_name in ('building', 'highway'):
+            parser = OsmParser(tag_name=tag_name)
+            with open(FIXTURE_PATH, 'rb') as source:
+                xml.sax.parse(source, parser)
+            expat_parser = OsmExpatParser(tag_name=tag_name)
+            with open(FIXTURE_PATH, 'rb') as source:
+                expat_parser.parse(source)
+            self.assertDictEqual(
+                parser.wayCountDict, expat_parser.wayCountDict)
+            self.assertDictEqual(
+                parser.nodeCountDict, expat_parser.nodeCountDict)
+            self.assertDictEqual(
+                parser.userDayCountDict, expat_parser.userDayCountDict)
+
+        with self.assertRaises(xml.sax.SAXParseException):
+            OsmExpatParser(tag_name='building').parse(
+                io.BytesIO(b'<osm><node></osm>'))
+
+    def test_multi_tag_parser(self):
+        """Test that several tags are counted in a single pass."""
+        multi_parser = OsmMultiTagParser(['building', 'highway'])
+        with open(FIXTURE_PATH, 'rb') as source:
+            multi_parser.parse(source)
+        for tag_name in ('building', 'highway'):
+            parser = OsmParser(tag_name=tag_name)
+            with open(FIXTURE_PATH, 'rb') as source:
+                xml.sax.parse(source, parser)
+            self.assertDictEqual(
+                parser.wayCountDict, multi_parser.wayCountDicts[tag_name])
+            self.assertDictEqual(
+                parser.nodeCountDict, multi_parser.nodeCountDicts[tag_name])
+            timelines = multi_parser.userDayCountDicts[tag_name]
+            self.assertEqual(
+                dict((user, sum(timeline.values()))
+                     for user, timeline in timelines.items()),
+                parser.wayCountDict)
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,102 @@
+# coding=utf-8
+"""Test cases for the Overpass HTTP client.
+:copyright: (c) 2013 by Tim Sutton
+:license: GPLv3, see LICENSE for more details.
+"""
+import time
+import unittest
+from urllib.error import HTTPError
+
+from reporter.overpass import OverpassClient, OverpassEndpoints
+from reporter.test.helpers import OverpassStandIn
+from reporter.test.logged_unittest import LoggedTestCase
+
+
+class OverpassClientTestCase(LoggedTestCase):
+    """Test the pooled Overpass client."""
+
+    def test_keep_alive(self):
+        """Test that consecutive requests share a connection."""
+        client = OverpassClient(retry_delay=0)
+        with OverpassStandIn(lambda path: (200, b'<osm/>', {})) as stand_in:
+            for _ in range(3):
+                with client.get(stand_in.url + '?data=node') as response:
+                    self.assertEqual(response.read(), b'<osm/>')
+            client.close()
+        self.assertEqual(len(stand_in.requests), 3)
+        self.assertEqual(
+            stand_in.requests[0], '/api/interpreter?data=node')
+        self.assertEqual(stand_in.connections, 1)
+
+    def test_unread_response_is_not_reused(self):
+        """Test that a connection with a pending body is closed."""
+        client = OverpassClient(retry_delay=0)
+        with OverpassStandIn(lambda path: (200, b'<osm/>', {})) as stand_in:
+            with client.get(stand_in.url) as response:
+                response.read(2)
+            with client.get(stand_in.url) as response:
+                response.read()
+            client.close()
+        self.assertEqual(stand_in.connections, 2)
+
+    def test_retry(self):
+        """Test that unavailable servers are tried again."""
+        statuses = [503, 502, 200]
+
+        def respond(path):
+            return statuses.pop(0), b'<osm/>', {}
+
+        client = OverpassClient(retries=2, retry_delay=0)
+        with OverpassStandIn(respond) as stand_in:
+            with client.get(stand_in.url) as response:
+                self.assertEqual(response.status, 200)
+                response.read()
+            client.close()
+        self.assertEqual(len(stand_in.requests), 3)
+
+    def test_errors(self):
+        """Test that error statuses are raised once retries are exhausted."""
+        client = OverpassClient(retries=1, retry_delay=0)
+        with OverpassStandIn(lambda path: (504, b'', {})) as stand_in:
+            with self.assertRaises(HTTPError) as context:
+                with client.get(stand_in.url):
+                    pass
+            with self.assertRaises(ValueError):
+                with client.get('file:///etc/hosts'):
+                    pass
+            client.close()
+        self.assertEqual(context.exception.code, 504)
+        self.assertEqual(len(stand_in.requests), 2)
+
+    def test_endpoints_order(self):
+        """Test that queries go to the healthiest endpoint first."""
+        endpoints = OverpassEndpoints(
+            ['http://a/api/interpreter', 'http://b/api/interpreter'])
+        first, second = endpoints.endpoints
+
+        def urls():
+            return [url for _, url in endpoints.candidates(
+                'http://a/api/interpreter?data=node')]
+
+        self.assertEqual(urls(), [
+            'http://a/api/interpreter?data=node',
+            'http://b/api/interpreter?data=node'])
+        first.succeeded(2)
+        second.succeeded(1)
+        self.assertEqual(urls()[0], 'http://b/api/interpreter?data=node')
+        second.failed()
+        self.assertEqual(urls()[0], 'http://a/api/interpreter?data=node')
+        self.assertGreater(second.cooling_until, time.time())
+        with first.slot(), first.slot():
+            # All the slots of the first endpoint are in use.
+            self.assertEqual(urls()[0], 'http://a/api/interpreter?data=node')
+            second.succeeded(1)
+            self.assertEqual(urls()[0], 'http://b/api/interpreter?data=node')
+        # Unknown servers are queried as they are.
+        self.assertEqual(
+            [url for _, url in endpoints.candidates('http://c/?data=node')],
+            ['http://c/?data=node'])
+
+
+if __name__ == '__main__':
+    unittest.main()
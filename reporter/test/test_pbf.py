@@ -0,0 +1,106 @@
+# coding=utf-8
+"""Test cases for the PBF reader.
+:copyright: (c) 2013 by Tim Sutton
+:license: GPLv3, see LICENSE for more details.
+"""
+import os
+import unittest
+import xml.sax
+from tempfile import mkdtemp
+from unittest import mock
+
+from reporter import config
+from reporter import process_pool
+from reporter.osm_node_parser import OsmNodeParser
+from reporter.osm_way_parser import OsmMultiTagParser
+from reporter.pbf import pbf_contributions, pbf_nodes_by_user
+from reporter.test.helpers import FIXTURE_PATH, write_pbf
+from reporter.test.logged_unittest import LoggedTestCase
+from reporter.utilities import osm_nodes_by_user, osm_object_contributions
+
+
+class PbfTestCase(LoggedTestCase):
+    """Test the PBF reader against the xml parsers."""
+
+    def setUp(self):
+        """Write the fixture as a PBF file."""
+        self.pbf_path = os.path.join(mkdtemp(), 'swellendam.osm.pbf')
+        write_pbf(FIXTURE_PATH, self.pbf_path, block_size=100)
+
+    def test_pbf_contributions(self):
+        """Test that a PBF file is counted like the xml document."""
+        tag_names = ['building', 'highway']
+        parser = OsmMultiTagParser(tag_names)
+        with open(FIXTURE_PATH, 'rb') as source:
+            parser.parse(source)
+        for processes in (1, 2):
+            with mock.patch.object(config, 'PBF_PROCESSES', processes):
+                way_counts, node_counts, timelines = pbf_contributions(
+                    self.pbf_path, tag_names)
+            self.assertEqual(way_counts, parser.wayCountDicts)
+            self.assertEqual(node_counts, parser.nodeCountDicts)
+            self.assertEqual(timelines, parser.userDayCountDicts)
+
+    def test_shared_pool(self):
+        """Check that the requests share a pool which does not fork."""
+        with mock.patch.object(config, 'PBF_PROCESSES', 2), \
+                mock.patch.object(process_pool, '_POOLS', {}):
+            pbf_nodes_by_user(self.pbf_path, 'Babsie')
+            processes, pool = process_pool._POOLS['pbf']
+            pbf_nodes_by_user(self.pbf_path, 'Babsie')
+            self.assertIs(process_pool._POOLS['pbf'][1], pool)
+            pool.shutdown()
+        self.assertEqual(processes, 2)
+        self.assertIn(
+            pool._mp_context.get_start_method(), ('forkserver', 'spawn'))
+
+    def test_pbf_contributions_in_bbox(self):
+        """Test that only the ways with a node in the bbox are counted."""
+        coordinates = {
+            'SW_lat': -34.0200, 'SW_lng': 20.4480,
+            'NE_lat': -34.0185, 'NE_lng': 20.4530}
+        with mock.patch.object(config, 'PBF_PROCESSES', 1):
+            way_counts, _, _ = pbf_contributions(
+                self.pbf_path, ['building'], coordinates)
+            all_way_counts, _, _ = pbf_contributions(
+                self.pbf_path, ['building'])
+        with mock.patch.object(config, 'PBF_PROCESSES', 2):
+            self.assertEqual(
+                pbf_contributions(self.pbf_path, ['building'], coordinates)[0],
+                way_counts)
+        self.assertTrue(way_counts['building'])
+        self.assertLess(
+            sum(way_counts['building'].values()),
+            sum(all_way_counts['building'].values()))
+
+    def test_pbf_nodes_by_user(self):
+        """Test that the nodes of a user are found in a PBF file."""
+        parser = OsmNodeParser('Babsie')
+        with open(FIXTURE_PATH, 'rb') as source:
+            xml.sax.parse(source, parser)
+        with mock.patch.object(config, 'PBF_PROCESSES', 1):
+            nodes = pbf_nodes_by_user(self.pbf_path, 'Babsie')
+        self.assertEqual(len(nodes), len(parser.nodes))
+        for (lat, lon), (expected_lat, expected_lon) in zip(
+                nodes, parser.nodes):
+            self.assertAlmostEqual(lat, expected_lat, places=7)
+            self.assertAlmostEqual(lon, expected_lon, places=7)
+
+    def test_utilities_read_pbf(self):
+        """Test that the utilities accept PBF files."""
+        with mock.patch.object(config, 'PBF_PROCESSES', 1):
+            with open(self.pbf_path, 'rb') as pbf_file:
+                contributions = osm_object_contributions(
+                    pbf_file, 'building')
+            with open(self.pbf_path, 'rb') as pbf_file:
+                nodes = osm_nodes_by_user(pbf_file, 'Babsie')
+        with open(FIXTURE_PATH, 'rb') as source:
+            expected = osm_object_contributions(source, 'building')
+        self.assertEqual(
+            [(d['name'], d['ways'], d['nodes']) for d in contributions],
+            [(d['name'], d['ways'], d['nodes']) for d in expected])
+        self.assertTrue(nodes)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,108 @@
+# coding=utf-8
+"""Test cases for the pool of scratch PostGIS databases.
+:copyright: (c) 2013 by Tim Sutton
+:license: GPLv3, see LICENSE for more details.
+"""
+import threading
+import unittest
+from tempfile import mkdtemp
+from unittest import mock
+
+from reporter import config
+from reporter import postgis_pool
+from reporter.postgis_pool import leased_database
+from reporter.test.logged_unittest import LoggedTestCase
+
+
+class PostgisPoolTestCase(LoggedTestCase):
+    """Test the leases of the scratch databases."""
+
+    def setUp(self):
+        """Run the postgres commands with mocks."""
+        patches = [
+            mock.patch.object(config, 'CACHE_DIR', mkdtemp()),
+            mock.patch.object(config, 'POSTGIS_POOL_SIZE', 2),
+            mock.patch.object(config, 'POSTGIS_POOL_PREFIX', 'pool'),
+            mock.patch.object(postgis_pool, 'LEASE_POLL_INTERVAL', 0.01),
+            mock.patch.object(postgis_pool, '_PROVISIONED', set()),
+            mock.patch.object(postgis_pool, '_LEASED', set()),
+            mock.patch.object(
+                postgis_pool, 'which', side_effect=lambda name: [name])]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+        self.call = mock.patch.object(postgis_pool, 'call').start()
+        self.check_output = mock.patch.object(
+            postgis_pool, 'check_output', return_value=b'').start()
+        self.addCleanup(mock.patch.stopall)
+
+    def commands(self):
+        """Get the commands run, as strings."""
+        return [
+            args[0] if isinstance(args[0], str) else ' '.join(args[0][:2])
+            for args, _ in self.call.call_args_list]
+
+    def test_leased_database(self):
+        """Check that databases are created once and reset when released."""
+        with leased_database('unused') as first:
+            with leased_database('unused') as second:
+                self.assertEqual({first, second}, {'pool_0', 'pool_1'})
+        with leased_database('unused') as third:
+            self.assertEqual(third, 'pool_0')
+        self.assertEqual(self.commands(), [
+            'createdb -T template_postgis pool_0',
+            'createdb -T template_postgis pool_1',
+            'psql pool_1',
+            'psql pool_0',
+            'psql pool_0'])
+        self.assertIn('TRUNCATE', self.call.call_args[0][0][-1])
+        self.assertEqual(self.check_output.call_count, 2)
+
+    def test_leases_wait(self):
+        """Check that a lease waits for a database to be released."""
+        leased = []
+
+        def lease():
+            with leased_database('unused') as db_name:
+                leased.append(db_name)
+
+        with mock.patch.object(config, 'POSTGIS_POOL_SIZE', 1):
+            with leased_database('unused'):
+                waiting = threading.Thread(target=lease)
+                waiting.start()
+                waiting.join(0.2)
+                self.assertEqual(leased, [])
+            waiting.join()
+        self.assertEqual(leased, ['pool_0'])
+
+    def test_leases_without_lock_files(self):
+        """Check that threads lease distinct databases without flock."""
+        leased = []
+
+        def lease():
+            with leased_database('unused') as db_name:
+                leased.append(db_name)
+
+        with mock.patch.object(postgis_pool, 'fcntl', None):
+            with leased_database('unused') as first:
+                with leased_database('unused') as second:
+                    self.assertEqual({first, second}, {'pool_0', 'pool_1'})
+                    waiting = threading.Thread(target=lease)
+                    waiting.start()
+                    waiting.join(0.2)
+                    self.assertEqual(leased, [])
+            waiting.join()
+        self.assertIn(leased[0], {'pool_0', 'pool_1'})
+
+    def test_without_pool(self):
+        """Check that a database is created and dropped without a pool."""
+        with mock.patch.object(config, 'POSTGIS_POOL_SIZE', 0):
+            with leased_database('tmp1234') as db_name:
+                self.assertEqual(db_name, 'tmp1234')
+        self.assertEqual(self.commands(), [
+            'createdb -T template_postgis tmp1234',
+            'dropdb tmp1234'])
+
+
+if __name__ == '__main__':
+    unittest.main()
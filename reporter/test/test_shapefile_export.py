@@ -0,0 +1,236 @@
+# coding=utf-8
+"""Test cases for the shapefile export without Postgres.
+:copyright: (c) 2013 by Tim Sutton
+:license: GPLv3, see LICENSE for more details.
+"""
+import os
+import unittest
+from tempfile import mkdtemp
+from unittest import mock
+from xml.etree import ElementTree
+
+from reporter import shapefile_export
+from reporter.exceptions import UnsupportedShapefileExportException
+from reporter.queries import SQL_QUERY_MAP
+from reporter.shapefile_export import (
+    POINT_SHAPE,
+    POLYGON_SHAPE,
+    apply_transform,
+    export_shapefile,
+    parse_query,
+    parse_transform,
+    point_on_surface,
+    signed_area)
+from reporter.test.helpers import (
+    FIXTURE_PATH,
+    read_dbf,
+    read_shp,
+    write_pbf)
+from reporter.test.logged_unittest import LoggedTestCase
+from reporter.utilities import overpass_resource_base_path
+
+
+def read_transform(feature_type):
+    """Parse the .sql file of a feature."""
+    with open('%s.sql' % overpass_resource_base_path(feature_type)) as sql:
+        return parse_transform(sql.read())
+
+
+class ShapefileExportTestCase(LoggedTestCase):
+    """Test the in process shapefile export."""
+
+    def test_buildings_transform(self):
+        """Check that the types of the buildings are normalised."""
+        rows = [
+            {'amenity': 'Primary SCHOOL'},
+            {'amenity': 'place_of_worship', 'religion': 'muslim'},
+            {'amenity': 'place_of_worship', 'religion': 'christian'},
+            {'building:use': 'medical'},
+            {'leisure': ''},
+            {'leisure': 'pitch'},
+            {}]
+        apply_transform(
+            rows, 'planet_osm_polygon', read_transform('buildings'))
+        self.assertEqual([row['type'] for row in rows], [
+            'School',
+            'Place of Worship - Islam',
+            'Residential',
+            'Clinic/Doctor',
+            'Residential',
+            'Sports Facility',
+            'Residential'])
+
+    def test_roads_transform(self):
+        """Check that the types of the roads are normalised."""
+        rows = [
+            {'highway': 'Trunk'},
+            {'highway': None},
+            {'highway': 'footway'},
+            {'highway': 'bus_stop'}]
+        steps = read_transform('roads')
+        apply_transform(rows, 'planet_osm_polygon', steps)
+        self.assertNotIn('type', rows[0])
+        apply_transform(rows, 'planet_osm_line', steps)
+        self.assertEqual([row['type'] for row in rows], [
+            'Motorway or highway',
+            'Road, residential, living street, etc.',
+            'Cycleway, footpath, etc.',
+            None])
+
+    def test_case_transform(self):
+        """Check that the first matching branch of a CASE is set."""
+        steps = parse_transform(
+            'ALTER TABLE t ADD COLUMN "type" text; '
+            'UPDATE t SET "type" = CASE '
+            "WHEN a ILIKE '%x%' THEN 'X' "
+            "WHEN a = 'yx' OR b IS NULL THEN 'Y' "
+            "END WHERE a != 'skip';")
+        rows = [
+            {'a': 'yx', 'b': '1'},
+            {'a': 'y', 'b': None},
+            {'a': 'y', 'b': '1'},
+            {'a': 'skip', 'b': None}]
+        apply_transform(rows, 't', steps)
+        self.assertEqual(
+            [row['type'] for row in rows], ['X', 'Y', None, None])
+
+    def test_parse_query(self):
+        """Check the fields of the queries given to pgsql2shp."""
+        geometry, fields, table, condition = parse_query(
+            SQL_QUERY_MAP['building-points'])
+        self.assertEqual(geometry, 'point')
+        self.assertEqual(table, 'planet_osm_polygon')
+        self.assertEqual(fields[:4], [
+            ('building', 'column', 'building'),
+            ('type', 'column', 'type'),
+            ('area_meters', 'area', None),
+            ('structure', 'column', 'building:structure')])
+        self.assertFalse(condition({'building': 'no'}))
+        self.assertTrue(condition({'building': 'yes'}))
+        self.assertIsNone(condition({'building': None}))
+
+        _, fields, table, condition = parse_query(SQL_QUERY_MAP['roads'])
+        self.assertEqual(table, 'planet_osm_line')
+        self.assertEqual(fields[0], ('name', 'column', 'name'))
+
+    def test_unsupported(self):
+        """Check the features and documents needing Postgres."""
+        with self.assertRaises(UnsupportedShapefileExportException):
+            read_transform('potential-idp')
+        with self.assertRaises(UnsupportedShapefileExportException):
+            parse_transform('DELETE FROM planet_osm_point;')
+
+        osm_path = os.path.join(mkdtemp(), 'relation.osm')
+        with open(osm_path, 'w') as osm_file:
+            osm_file.write(
+                '<osm><way id="2"><tag k="type" v="boundary"/></way>'
+                '<relation id="3"><tag k="type" v="route"/></relation>'
+                '<relation id="1">'
+                '<tag k="type" v="multipolygon"/><tag k="building" v="yes"/>'
+                '</relation></osm>')
+        # Found from the bytes, over several reads, without parsing.
+        with mock.patch.object(shapefile_export, 'SCAN_CHUNK_SIZE', 7), \
+                mock.patch.object(
+                    shapefile_export, 'iter_osm_elements') as parse:
+            with self.assertRaises(UnsupportedShapefileExportException):
+                export_shapefile(
+                    'buildings', osm_path, os.path.join(mkdtemp(), 'b.shp'))
+        self.assertFalse(parse.called)
+
+    def test_export_buildings(self):
+        """Check the shapefile of the buildings of the fixture."""
+        root = ElementTree.parse(FIXTURE_PATH).getroot()
+        nodes = set(node.get('id') for node in root.iter('node'))
+        expected = []
+        for way in root.iter('way'):
+            tags = dict(
+                (tag.get('k'), tag.get('v')) for tag in way.iter('tag'))
+            refs = [
+                nd.get('ref') for nd in way.iter('nd')
+                if nd.get('ref') in nodes]
+            # Without their missing nodes, ways must still be closed rings.
+            if all(['building' in tags,
+                    len(refs) >= 4,
+                    refs[0] == refs[-1]]):
+                expected.append(tags)
+
+        shape_path = os.path.join(mkdtemp(), 'buildings', 'buildings.shp')
+        count = export_shapefile('buildings', FIXTURE_PATH, shape_path)
+        self.assertEqual(count, len(expected))
+        names, records = read_dbf(shape_path.replace('.shp', '.dbf'))
+        self.assertEqual(names[:3], ['BUILDING', 'TYPE', 'STRUCTURE'])
+        self.assertIn('FULL_ADDRE', names)
+        self.assertEqual(
+            [record['NAME'] for record in records],
+            [tags.get('name', '') for tags in expected])
+        self.assertTrue(all(record['TYPE'] for record in records))
+        shape_type, shapes = read_shp(shape_path)
+        self.assertEqual(shape_type, POLYGON_SHAPE)
+        self.assertEqual(len(shapes), count)
+        for ring in shapes:
+            self.assertEqual(ring[0], ring[-1])
+            self.assertLess(signed_area(ring), 0)
+        self.assertEqual(
+            os.path.getsize(shape_path.replace('.shp', '.shx')),
+            100 + 8 * count)
+
+        pbf_path = os.path.join(mkdtemp(), 'swellendam.osm.pbf')
+        write_pbf(FIXTURE_PATH, pbf_path)
+        pbf_shape_path = os.path.join(mkdtemp(), 'buildings.shp')
+        export_shapefile('buildings', pbf_path, pbf_shape_path)
+        self.assertEqual(
+            read_dbf(pbf_shape_path.replace('.shp', '.dbf')),
+            (names, records))
+        self.assertEqual(len(read_shp(pbf_shape_path)[1]), count)
+
+    def test_missing_nodes(self):
+        """Check that ways whose nodes are not in the document are skipped."""
+        osm_path = os.path.join(mkdtemp(), 'clipped.osm')
+        with open(osm_path, 'w') as osm_file:
+            osm_file.write(
+                '<osm>'
+                '<node id="1" lat="0" lon="0"/>'
+                '<node id="2" lat="0" lon="1"/>'
+                '<node id="3" lat="1" lon="1"/>'
+                '<way id="1"><nd ref="7"/><nd ref="8"/><nd ref="9"/>'
+                '<nd ref="7"/><tag k="building" v="yes"/></way>'
+                '<way id="2"><nd ref="1"/><nd ref="8"/><nd ref="1"/>'
+                '<tag k="building" v="yes"/></way>'
+                '<way id="3"><nd ref="1"/><nd ref="2"/><nd ref="3"/>'
+                '<nd ref="1"/><tag k="building" v="yes"/></way>'
+                '</osm>')
+        shape_path = os.path.join(mkdtemp(), 'buildings.shp')
+        self.assertEqual(
+            export_shapefile('buildings', osm_path, shape_path), 1)
+        self.assertEqual(
+            export_shapefile(
+                'roads', osm_path, os.path.join(mkdtemp(), 'roads.shp')),
+            0)
+
+    def test_export_building_points(self):
+        """Check that the buildings are exported as points with areas."""
+        shape_path = os.path.join(mkdtemp(), 'building-points.shp')
+        export_shapefile('building-points', FIXTURE_PATH, shape_path)
+        shape_type, shapes = read_shp(shape_path)
+        self.assertEqual(shape_type, POINT_SHAPE)
+        _, records = read_dbf(shape_path.replace('.shp', '.dbf'))
+        self.assertEqual(len(records), len(shapes))
+        self.assertTrue(all(
+            int(record['AREA_METER']) > 0 for record in records))
+
+    def test_point_on_surface(self):
+        """Check that the point is inside concave polygons."""
+        square = [(0, 0), (0, 2), (2, 2), (2, 0), (0, 0)]
+        lon, lat = point_on_surface(square)
+        self.assertAlmostEqual(lon, 1)
+        self.assertAlmostEqual(lat, 1, places=3)
+        # A U open to the north, whose centre is outside of it
+        shape = [
+            (0, 0), (3, 0), (3, 3), (2, 3), (2, 1), (1, 1), (1, 3), (0, 3),
+            (0, 0)]
+        lon, lat = point_on_surface(shape)
+        self.assertTrue(0 < lat < 1 or lon < 1 or lon > 2, (lon, lat))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,129 @@
+# coding=utf-8
+"""Test cases for the snapshots module.
+:copyright: (c) 2013 by Tim Sutton
+:license: GPLv3, see LICENSE for more details.
+"""
+import shutil
+import unittest
+from tempfile import mkdtemp
+from unittest import mock
+from urllib.parse import unquote
+
+from reporter import config
+from reporter import osm
+from reporter import snapshots
+from reporter.exceptions import OverpassTimeoutException
+from reporter.osm_way_parser import OsmMultiTagParser
+from reporter.snapshots import snapshot_contributions
+from reporter.test.helpers import FIXTURE_PATH
+from reporter.test.logged_unittest import LoggedTestCase
+
+DIFF = b'''<?xml version="1.0" encoding="UTF-8"?>
+<osm version="0.6" generator="Overpass API">
+<meta osm_base="2012-12-12T10:00:00Z"/>
+<action type="modify">
+<old>
+  <way id="195071645" version="3" timestamp="2012-12-08T10:03:25Z"
+       user="Babsie">
+    <nd ref="1"/>
+    <tag k="building" v="yes"/>
+  </way>
+</old>
+<new>
+  <way id="195071645" version="4" timestamp="2012-12-12T09:00:00Z"
+       user="Mapper">
+    <nd ref="1"/><nd ref="2"/><nd ref="3"/><nd ref="1"/>
+    <tag k="building" v="house"/>
+  </way>
+</new>
+</action>
+<action type="delete">
+<old>
+  <way id="195071798" version="2" timestamp="2012-12-08T10:02:51Z"
+       user="Babsie">
+    <tag k="building" v="yes"/>
+  </way>
+</old>
+<new>
+  <way id="195071798" version="3" timestamp="2012-12-12T09:30:00Z"
+       user="Mapper" visible="false"/>
+</new>
+</action>
+<action type="create">
+  <way id="999" version="1" timestamp="2012-12-12T09:45:00Z" user="Mapper">
+    <nd ref="4"/><nd ref="5"/><nd ref="4"/>
+    <tag k="building" v="yes"/>
+  </way>
+</action>
+</osm>
+'''
+
+
+class SnapshotsTestCase(LoggedTestCase):
+    """Test the contribution snapshots."""
+
+    def test_snapshot_contributions(self):
+        """Check that stale snapshots are updated from a diff."""
+        coordinates = {
+            'SW_lat': -34.03, 'SW_lng': 20.44,
+            'NE_lat': -34.01, 'NE_lng': 20.46}
+        urls = []
+
+        def fetch(path, url):
+            urls.append(unquote(url))
+            if '[diff:' in urls[-1]:
+                with open(path, 'wb') as file_handle:
+                    file_handle.write(DIFF)
+            else:
+                shutil.copy(FIXTURE_PATH, path)
+
+        tag_names = ['building', 'highway']
+        parser = OsmMultiTagParser(tag_names)
+        with open(FIXTURE_PATH, 'rb') as source:
+            parser.parse(source)
+        with mock.patch.object(osm, 'fetch_osm', side_effect=fetch), \
+                mock.patch.object(snapshots, 'fetch_osm', side_effect=fetch), \
+                mock.patch.object(config, 'CACHE_DIR', mkdtemp()):
+            reports = snapshot_contributions(coordinates, tag_names)
+            self.assertEqual(len(urls), 1)
+            for tag_name in tag_names:
+                self.assertEqual(
+                    dict((d['name'], (d['ways'], d['nodes']))
+                         for d in reports[tag_name]),
+                    dict((name, (ways, parser.nodeCountDicts[tag_name][name]))
+                         for name, ways
+                         in parser.wayCountDicts[tag_name].items()))
+
+            # Fresh snapshots are used as they are.
+            self.assertIs(
+                snapshot_contributions(coordinates, tag_names), reports)
+            self.assertEqual(len(urls), 1)
+
+            with mock.patch.object(
+                    config, 'CACHE_MAX_AGE_BY_FEATURE', {'contributions': -1}):
+                updated = snapshot_contributions(coordinates, tag_names)
+            self.assertEqual(len(urls), 2)
+            self.assertIn('[diff:"2012-12-11T18:20:03Z"]', urls[1])
+
+            # A failed diff leaves the snapshot as it was.
+            stale = {'contributions': -1}
+            with mock.patch.object(
+                    config, 'CACHE_MAX_AGE_BY_FEATURE', stale), \
+                    mock.patch.object(
+                        snapshots, 'fetch_osm',
+                        side_effect=OverpassTimeoutException):
+                self.assertIs(
+                    snapshot_contributions(coordinates, tag_names), updated)
+
+        buildings = dict((d['name'], d) for d in updated['building'])
+        babsie_ways = parser.wayCountDicts['building']['Babsie']
+        self.assertEqual(buildings['Babsie']['ways'], babsie_ways - 2)
+        self.assertEqual(
+            (buildings['Mapper']['ways'], buildings['Mapper']['nodes']),
+            (2, 7))
+        self.assertEqual(buildings['Mapper']['start'], '12-12-2012')
+        self.assertEqual(updated['highway'], reports['highway'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,128 @@
+# coding=utf-8
+"""Test cases for the timeline module.
+:copyright: (c) 2013 by Tim Sutton
+:license: GPLv3, see LICENSE for more details.
+"""
+import json
+import pickle
+import unittest
+from datetime import date
+from unittest import mock
+
+from reporter import timeline as timeline_module
+from reporter.test.logged_unittest import LoggedTestCase
+from reporter.timeline import (
+    Timeline,
+    TimelineAccumulator,
+    as_timeline,
+    day_ordinal,
+    timeline_statistics)
+from reporter.utilities import (
+    average_for_active_days,
+    best_active_day,
+    date_range,
+    interpolated_timeline,
+    worst_active_day)
+
+
+class TimelineTestCase(LoggedTestCase):
+    """Test the compact timelines."""
+
+    def test_day_ordinal(self):
+        """Check that days, timestamps and ordinals give the same ordinal."""
+        ordinal = date(2012, 12, 9).toordinal()
+        self.assertEqual(day_ordinal('2012-12-09'), ordinal)
+        self.assertEqual(day_ordinal(b'2012-12-09T22:40:53Z'), ordinal)
+        self.assertEqual(day_ordinal(ordinal), ordinal)
+
+    def test_timeline(self):
+        """Check that a Timeline is a mapping of days to counts."""
+        counts = {'2012-09-24': 1, '2012-09-21': 10, '2012-09-25': 5}
+        timeline = Timeline(counts)
+        self.assertEqual(timeline, counts)
+        self.assertEqual(counts, timeline)
+        self.assertEqual(
+            list(timeline), ['2012-09-21', '2012-09-24', '2012-09-25'])
+        self.assertEqual(len(timeline), 3)
+        self.assertEqual(timeline['2012-09-24'], 1)
+        self.assertNotIn('2012-09-22', timeline)
+        self.assertEqual(timeline.start(), date(2012, 9, 21))
+        self.assertEqual(timeline.end(), date(2012, 9, 25))
+        self.assertEqual(timeline.best(), 10)
+        self.assertEqual(timeline.worst(), 1)
+        self.assertEqual(timeline.average(), 5)
+        self.assertEqual(list(timeline.dense_counts()), [10, 0, 0, 1, 5])
+        self.assertIs(as_timeline(timeline), timeline)
+        self.assertEqual(pickle.loads(pickle.dumps(timeline)), timeline)
+        self.assertEqual(
+            timeline + Timeline({'2012-09-25': 1, '2012-10-01': 2}),
+            {'2012-09-24': 1, '2012-09-21': 10, '2012-09-25': 6,
+             '2012-10-01': 2})
+
+    def test_empty_timeline(self):
+        """Check the statistics of a timeline without days."""
+        timeline = Timeline()
+        self.assertEqual(timeline, {})
+        self.assertIsNone(timeline.start())
+        self.assertEqual(timeline.best(), 0)
+        self.assertEqual(timeline.worst(), 0)
+        self.assertEqual(list(timeline.dense_counts()), [])
+
+    def test_timeline_accumulator(self):
+        """Check that ways are counted by user and day."""
+        ways = [
+            ('Babsie', '2012-12-08'),
+            ('Jacoline', '2012-12-10'),
+            ('Babsie', '2012-12-08'),
+            ('Babsie', '2010-01-01'),
+            (None, '2012-12-08')] * 3
+        expected = {
+            'Babsie': {'2012-12-08': 6, '2010-01-01': 3},
+            'Jacoline': {'2012-12-10': 3},
+            None: {'2012-12-08': 3}}
+        for buffer_size in (2, 1024):
+            accumulator = TimelineAccumulator()
+            with mock.patch.object(
+                    timeline_module, 'BUFFER_SIZE', buffer_size):
+                for user, day in ways:
+                    accumulator.add(user, day)
+            self.assertEqual(accumulator.timelines(), expected)
+
+        accumulator.update({('Jacoline', '2012-12-10'): 2})
+        self.assertEqual(
+            accumulator.timelines()['Jacoline'], {'2012-12-10': 5})
+
+    def test_timeline_statistics(self):
+        """Check the statistics of several users against the utilities."""
+        timelines = {
+            'Babsie': {'2012-12-08': 15, '2012-12-10': 22},
+            'Jacoline': Timeline({'2011-12-31': 1}),
+            'timlinux': {'2010-12-09': 1, '2012-07-10': 3, '2012-07-11': 2},
+            'nobody': {}}
+        statistics = timeline_statistics(timelines)
+        lists = timeline_statistics(timelines, serialise=False)
+        for user, timeline in timelines.items():
+            if not timeline:
+                continue
+            start, end = date_range(timeline)
+            self.assertEqual(statistics[user], {
+                'timeline': interpolated_timeline(timeline),
+                'start': start,
+                'end': end,
+                'activeDays': len(timeline),
+                'best': best_active_day(timeline),
+                'worst': worst_active_day(timeline),
+                'average': average_for_active_days(timeline)})
+            self.assertEqual(
+                lists[user]['timeline'],
+                json.loads(statistics[user]['timeline']))
+        self.assertEqual(
+            statistics['Babsie']['timeline'],
+            '[["2012-12-08",15],["2012-12-09",0],["2012-12-10",22]]')
+        self.assertEqual(
+            (statistics['nobody']['timeline'], lists['nobody']['timeline']),
+            ('[]', []))
+
+
+if __name__ == '__main__':
+    unittest.main()
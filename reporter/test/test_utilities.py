@@ -5,11 +5,23 @@
 """
 import os
 import ast
+import shutil
+from tempfile import mkdtemp
+from unittest import mock
+
+from reporter import config
 
 from reporter.test.logged_unittest import LoggedTestCase
 from reporter.test.helpers import FIXTURE_PATH
 from reporter.utilities import (
     split_bbox,
+    cached_osm_object_contributions,
+    cached_osm_object_contributions_by_tag,
+    contributions_index_path,
+    osm_object_contributions_by_tag,
+    bbox_contains,
+    bbox_tiles,
+    tile_bbox,
     get_totals,
     osm_object_contributions,
     interpolated_timeline,
@@ -42,6 +54,22 @@ class UtilitiesTestCase(LoggedTestCase):
         with self.assertRaises(ValueError):
             split_bbox('invalid bbox string')
 
+    def test_bbox_tiles(self):
+        """Test we get the grid tiles covering a bounding box."""
+        coordinates = split_bbox(
+            '20.411482,-34.053726,20.467358,-34.009483')
+        tiles = bbox_tiles(coordinates, 14)
+        self.assertEqual(len(tiles), 16)
+        self.assertIn((9121, 9840), tiles)
+        covered = {
+            'SW_lat': min(tile_bbox(x, y, 14)['SW_lat'] for x, y in tiles),
+            'SW_lng': min(tile_bbox(x, y, 14)['SW_lng'] for x, y in tiles),
+            'NE_lat': max(tile_bbox(x, y, 14)['NE_lat'] for x, y in tiles),
+            'NE_lng': max(tile_bbox(x, y, 14)['NE_lng'] for x, y in tiles)
+        }
+        self.assertTrue(bbox_contains(covered, coordinates))
+        self.assertEqual(bbox_tiles(coordinates, 0), [(0, 0)])
+
     def test_osm_building_contributions(self):
         """Test that we can obtain correct contribution counts for a file."""
         file_handle = open(FIXTURE_PATH)
@@ -59,6 +87,107 @@ class UtilitiesTestCase(LoggedTestCase):
         print(contributor_list)
         self.assertListEqual(contributor_list, expected_list)
 
+    def test_osm_object_contributions_by_tag(self):
+        """Test that several tags are counted in a single parse."""
+        with open(FIXTURE_PATH, 'rb') as file_handle:
+            reports = osm_object_contributions_by_tag(
+                file_handle, ['building', 'highway'])
+        for tag_name in ('building', 'highway'):
+            with open(FIXTURE_PATH, 'rb') as file_handle:
+                expected_list = osm_object_contributions(
+                    file_handle, tag_name=tag_name)
+            self.assertEqual(
+                [(d['name'], d['ways'], d['nodes'])
+                 for d in reports[tag_name]],
+                [(d['name'], d['ways'], d['nodes']) for d in expected_list])
+
+    def test_cached_osm_object_contributions_by_tag(self):
+        """Test that summaries are reused until the document changes."""
+        file_path = os.path.join(mkdtemp(), 'cached.osm')
+        shutil.copy(FIXTURE_PATH, file_path)
+        with open(file_path, 'rb') as file_handle:
+            reports = cached_osm_object_contributions_by_tag(
+                file_handle, ['building'])
+        with open(file_path, 'rb') as file_handle:
+            self.assertIs(
+                cached_osm_object_contributions_by_tag(
+                    file_handle, ['building']),
+                reports)
+        with open(file_path, 'wb') as file_handle:
+            file_handle.write(b'<osm version="0.6"></osm>')
+        with open(file_path, 'rb') as file_handle:
+            self.assertEqual(
+                cached_osm_object_contributions_by_tag(
+                    file_handle, ['building']),
+                {'building': []})
+
+    def test_contributions_index(self):
+        """Test that cached documents are only parsed once."""
+        cache_path = mkdtemp()
+        file_path = os.path.join(cache_path, 'indexed.osm')
+        shutil.copy(FIXTURE_PATH, file_path)
+        with mock.patch.object(config, 'CACHE_DIR', cache_path):
+            with open(file_path, 'rb') as file_handle:
+                reports = cached_osm_object_contributions_by_tag(
+                    file_handle, ['building'])
+            self.assertTrue(
+                os.path.exists(contributions_index_path(file_path)))
+
+            # Another process only has the index, not the summaries.
+            with mock.patch(
+                    'reporter.utilities._CONTRIBUTIONS', {}), mock.patch(
+                    'reporter.utilities.OsmMultiTagParser') as parser:
+                with open(file_path, 'rb') as file_handle:
+                    self.assertEqual(
+                        cached_osm_object_contributions_by_tag(
+                            file_handle, ['building']),
+                        reports)
+            parser.assert_not_called()
+
+            # The index is not used once the document changed.
+            with open(file_path, 'wb') as file_handle:
+                file_handle.write(b'<osm version="0.6"></osm>')
+            with open(file_path, 'rb') as file_handle:
+                self.assertEqual(
+                    cached_osm_object_contributions_by_tag(
+                        file_handle, ['building']),
+                    {'building': []})
+
+    def test_cached_osm_object_contributions(self):
+        """Test that the summaries of a single tag are indexed too."""
+        cache_path = mkdtemp()
+        file_path = os.path.join(cache_path, 'indexed.osm')
+        shutil.copy(FIXTURE_PATH, file_path)
+        with open(file_path, 'rb') as file_handle:
+            expected = osm_object_contributions(file_handle, 'building')
+        with mock.patch.object(config, 'CACHE_DIR', cache_path):
+            with open(file_path, 'rb') as file_handle:
+                contributions = cached_osm_object_contributions(
+                    file_handle, 'building')
+            self.assertEqual(contributions, expected)
+            with open(file_path, 'rb') as file_handle:
+                by_tag = cached_osm_object_contributions_by_tag(
+                    file_handle, ['building'])['building']
+            # Both kinds of counts are in the index, apart.
+            with mock.patch(
+                    'reporter.utilities._CONTRIBUTIONS', {}), mock.patch(
+                    'reporter.utilities.osm_object_counts') as counts, \
+                    mock.patch(
+                        'reporter.utilities.osm_contribution_counts') as \
+                    tag_counts:
+                with open(file_path, 'rb') as file_handle:
+                    self.assertEqual(
+                        cached_osm_object_contributions(
+                            file_handle, 'building'),
+                        expected)
+                with open(file_path, 'rb') as file_handle:
+                    self.assertEqual(
+                        cached_osm_object_contributions_by_tag(
+                            file_handle, ['building'])['building'],
+                        by_tag)
+            counts.assert_not_called()
+            tag_counts.assert_not_called()
+
     def test_get_totals(self):
         """Test we get the proper totals from a sorted user list."""
         sorted_user_list = osm_object_contributions(
@@ -67,6 +196,24 @@ class UtilitiesTestCase(LoggedTestCase):
         ways, nodes = get_totals(sorted_user_list)
         self.assertEquals((ways, nodes), (427, 52))
 
+    def test_top_contributors(self):
+        """Test that only the top contributors get a record."""
+        with open(FIXTURE_PATH, 'rb') as file_handle:
+            expected_list = osm_object_contributions(
+                file_handle, tag_name='building')
+        with mock.patch.object(config, 'CONTRIBUTORS_LIMIT', 2):
+            with open(FIXTURE_PATH, 'rb') as file_handle:
+                sorted_user_list = osm_object_contributions(
+                    file_handle, tag_name='building')
+        self.assertEqual(sorted_user_list, expected_list[:2])
+        self.assertEqual(sorted_user_list.others, {
+            'users': len(expected_list) - 2,
+            'ways': sum(d['ways'] for d in expected_list[2:]),
+            'nodes': sum(d['nodes'] for d in expected_list[2:])})
+        self.assertEqual(
+            get_totals(sorted_user_list), get_totals(expected_list))
+        self.assertEqual(expected_list.others['users'], 0)
+
     def test_interpolated_time_line(self):
         """Check that we can get an interpolated time_line,"""
         time_line = {
@@ -0,0 +1,335 @@
+# coding=utf-8
+"""Module for compact timelines of the ways of contributors by day.
+
+Parsers used to keep a dict of 'YYYY-MM-DD' strings by user, a string and
+a dict entry per user and day. Here days are day ordinals (as returned by
+date.toordinal) and users are interned to integer ids: the
+TimelineAccumulator buffers the (user, day) of the ways, and counts a full
+buffer at once with Counter. The distinct (user, day) of the buffer are
+then converted to integer keys, once each. When the parse is done the
+counts are folded in per user Timelines, holding the days and counts of a
+user in two sorted arrays. The statistics of the reports are reductions
+over these arrays.
+
+A Timeline is a read only mapping of 'YYYY-MM-DD' strings to counts, so it
+compares equal to the dicts of the older parsers and can be used where
+these were.
+
+:copyright: (c) 2013 by Tim Sutton
+:license: GPLv3, see LICENSE for more details.
+"""
+from array import array
+from bisect import bisect_left
+from collections import Counter
+from collections.abc import Mapping
+from datetime import date
+
+# Ordinal of the unix epoch, for days counted from 1970-01-01.
+EPOCH_ORDINAL = date(1970, 1, 1).toordinal()
+
+# Bits of a key of a way holding its day ordinal, the higher bits hold the
+# id of its user. date.max.toordinal() needs 22 bits.
+DAY_BITS = 22
+DAY_MASK = (1 << DAY_BITS) - 1
+
+# Ways buffered by a TimelineAccumulator before being counted.
+BUFFER_SIZE = 64 * 1024
+
+
+def day_ordinal(day):
+    """Get the ordinal of a day.
+
+    :param day: A day in YYYY-MM-DD, or a timestamp starting with one, as
+        str or bytes. Ordinals are returned as they are.
+    :type day: str, bytes, int
+
+    :returns: The day ordinal, as returned by date.toordinal.
+    :rtype: int
+    """
+    if isinstance(day, int):
+        return day
+    return date(int(day[0:4]), int(day[5:7]), int(day[8:10])).toordinal()
+
+
+def as_timeline(timeline):
+    """Get a timeline as a Timeline.
+
+    :param timeline: A Timeline, or a dict of counts by day (YYYY-MM-DD).
+    :type timeline: Timeline, dict
+
+    :rtype: Timeline
+    """
+    if isinstance(timeline, Timeline):
+        return timeline
+    return Timeline(timeline)
+
+
+class Timeline(Mapping):
+    """Number of ways of a user by day, in arrays sorted by day."""
+
+    __slots__ = ('days', 'counts')
+
+    def __init__(self, counts=None):
+        """Constructor.
+
+        :param counts: Counts by day, the days in YYYY-MM-DD or day
+            ordinals.
+        :type counts: dict
+        """
+        self.days = array('i')
+        self.counts = array('l')
+        if counts:
+            for day, count in sorted(
+                    (day_ordinal(day), count)
+                    for day, count in counts.items()):
+                self.days.append(day)
+                self.counts.append(count)
+
+    @classmethod
+    def from_arrays(cls, days, counts):
+        """Create a timeline from its arrays.
+
+        :param days: Day ordinals, sorted without duplicates.
+        :type days: array
+
+        :param counts: Count of each day.
+        :type counts: array
+
+        :rtype: Timeline
+        """
+        timeline = cls()
+        timeline.days = days
+        timeline.counts = counts
+        return timeline
+
+    def __reduce__(self):
+        return self.from_arrays, (self.days, self.counts)
+
+    def __getitem__(self, day):
+        ordinal = day_ordinal(day)
+        index = bisect_left(self.days, ordinal)
+        if index == len(self.days) or self.days[index] != ordinal:
+            raise KeyError(day)
+        return self.counts[index]
+
+    def __iter__(self):
+        for ordinal in self.days:
+            yield date.fromordinal(ordinal).isoformat()
+
+    def __len__(self):
+        return len(self.days)
+
+    def __add__(self, other):
+        counts = Counter(dict(zip(self.days, self.counts)))
+        counts.update(dict(zip(other.days, other.counts)))
+        return Timeline(counts)
+
+    def __repr__(self):
+        return 'Timeline(%r)' % dict(self.items())
+
+    def start(self):
+        """Get the first day of the timeline.
+
+        :returns: The first day, None if the timeline is empty.
+        :rtype: date
+        """
+        if not self.days:
+            return None
+        return date.fromordinal(self.days[0])
+
+    def end(self):
+        """Get the last day of the timeline.
+
+        :returns: The last day, None if the timeline is empty.
+        :rtype: date
+        """
+        if not self.days:
+            return None
+        return date.fromordinal(self.days[-1])
+
+    def best(self):
+        """Get the highest count of a day.
+
+        :returns: The best count, 0 if the timeline is empty.
+        :rtype: int
+        """
+        return max(self.counts, default=0)
+
+    def worst(self):
+        """Get the lowest count of an active day.
+
+        :returns: The worst count ignoring days without ways, 0 if there are
+            none.
+        :rtype: int
+        """
+        if 0 not in self.counts:
+            return min(self.counts, default=0)
+        return min((count for count in self.counts if count), default=0)
+
+    def average(self):
+        """Get the average count of the active days.
+
+        :returns: The average count, rounded down.
+        :rtype: int
+
+        :raises: ZeroDivisionError if there are no active days.
+        """
+        active_days = len(self.counts) - self.counts.count(0)
+        return int(sum(self.counts) / active_days)
+
+    def dense_counts(self):
+        """Get the counts of every day from the first day to the last.
+
+        :returns: The count of each day, 0 for days without ways.
+        :rtype: array
+        """
+        if not self.days:
+            return array('l')
+        first = self.days[0]
+        counts = array('l', [0]) * (self.days[-1] - first + 1)
+        for day, count in zip(self.days, self.counts):
+            counts[day - first] = count
+        return counts
+
+
+class TimelineAccumulator(object):
+    """Count ways by user and day while parsing, see Timeline."""
+
+    def __init__(self):
+        """Constructor."""
+        # Interned users: ids by user and users by id
+        self.user_ids = {}
+        self.users = []
+        # Ordinals by day as given to add
+        self._ordinals = {}
+        # (user, day) of the ways not counted yet, and counts by key
+        self._buffer = []
+        self._counts = Counter()
+
+    def add(self, user, day):
+        """Count a way.
+
+        :param user: The user of the way.
+        :type user: str
+
+        :param day: The day of the way, see day_ordinal. Callers should pass
+            the day only, not the whole timestamp, as days are converted
+            once per distinct value.
+        :type day: str, bytes, int
+        """
+        buffer = self._buffer
+        buffer.append((user, day))
+        if len(buffer) >= BUFFER_SIZE:
+            self._count_buffer()
+
+    def update(self, counts):
+        """Count ways already counted by (user, day).
+
+        :param counts: Number of ways by (user, day), the days as in add.
+        :type counts: dict
+        """
+        user_ids = self.user_ids
+        ordinals = self._ordinals
+        key_counts = self._counts
+        for (user, day), count in counts.items():
+            user_id = user_ids.get(user)
+            if user_id is None:
+                user_id = user_ids[user] = len(self.users)
+                self.users.append(user)
+            ordinal = ordinals.get(day)
+            if ordinal is None:
+                ordinal = ordinals[day] = day_ordinal(day)
+            key_counts[user_id << DAY_BITS | ordinal] += count
+
+    def timelines(self):
+        """Get the timelines of the ways counted.
+
+        :returns: The Timeline of each user.
+        :rtype: dict
+        """
+        self._count_buffer()
+        counts = self._counts
+        timelines = {}
+        current = None
+        for key in sorted(counts):
+            user_id = key >> DAY_BITS
+            if user_id != current:
+                current = user_id
+                timeline = Timeline()
+                timelines[self.users[user_id]] = timeline
+            timeline.days.append(key & DAY_MASK)
+            timeline.counts.append(counts[key])
+        return timelines
+
+    def _count_buffer(self):
+        """Count the ways of the buffer and empty it."""
+        self.update(Counter(self._buffer))
+        del self._buffer[:]
+
+
+def timeline_statistics(timelines, serialise=True):
+    """Compute the statistics of the timelines of several users at once.
+
+    The days of all the users are formatted once, for the range from the
+    first day of any user to the last. The dense timeline of a user is then
+    a slice of the entries of this range, with the entries of the active
+    days of the user replaced.
+
+    :param timelines: The Timeline, or dict of counts by day (YYYY-MM-DD),
+        of each user.
+    :type timelines: dict
+
+    :param serialise: Whether the dense timelines are json strings, as shown
+        in the reports, or lists of [day, count].
+    :type serialise: bool
+
+    :returns: The statistics of each user, a dict with the keys: timeline
+        (dense timeline with an entry per day from the start to the end),
+        start and end (dates, None for an empty timeline), activeDays,
+        best, worst and average (0 for an empty timeline).
+    :rtype: dict
+    """
+    timelines = dict(
+        (user, as_timeline(timeline)) for user, timeline in timelines.items())
+    active = [timeline for timeline in timelines.values() if timeline]
+    first = min((timeline.days[0] for timeline in active), default=0)
+    last = max((timeline.days[-1] for timeline in active), default=-1)
+    days = [
+        date.fromordinal(ordinal).isoformat()
+        for ordinal in range(first, last + 1)]
+    if serialise:
+        empty_days = ['["%s",0]' % day for day in days]
+
+    statistics = {}
+    for user, timeline in timelines.items():
+        if not timeline:
+            statistics[user] = {
+                'timeline': '[]' if serialise else [],
+                'start': None,
+                'end': None,
+                'activeDays': 0,
+                'best': 0,
+                'worst': 0,
+                'average': 0}
+            continue
+        start = timeline.days[0] - first
+        end = timeline.days[-1] - first + 1
+        if serialise:
+            entries = empty_days[start:end]
+            for day, count in zip(timeline.days, timeline.counts):
+                index = day - first
+                entries[index - start] = '["%s",%i]' % (days[index], count)
+            dense_timeline = '[%s]' % ','.join(entries)
+        else:
+            dense_timeline = [
+                [day, count] for day, count
+                in zip(days[start:end], timeline.dense_counts())]
+        statistics[user] = {
+            'timeline': dense_timeline,
+            'start': timeline.start(),
+            'end': timeline.end(),
+            'activeDays': len(timeline),
+            'best': timeline.best(),
+            'worst': timeline.worst(),
+            'average': timeline.average()}
+    return statistics
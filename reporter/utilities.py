@@ -6,18 +6,57 @@
 import os
 import sys
 import getpass
+import gzip
+import heapq
+import json
 from tempfile import mkstemp
 import xml
-import time
+import math
 from datetime import date, timedelta
 import zipfile
+import threading
+from collections import OrderedDict
 
 from reporter import config
+from reporter.osm_chunks import (
+    chunked_osm_contribution_counts,
+    chunked_osm_object_counts,
+    is_chunkable)
 from reporter.osm_node_parser import OsmNodeParser
-from reporter.osm_way_parser import OsmParser
+from reporter.osm_scanner import (
+    is_scannable,
+    scan_nodes_by_user,
+    scan_osm_contribution_counts,
+    scan_osm_object_counts)
+from reporter.osm_way_parser import (
+    OsmExpatParser,
+    OsmMultiTagParser,
+    OsmParser)
+from reporter.pbf import is_pbf, pbf_contributions, pbf_nodes_by_user
+from reporter.timeline import as_timeline, timeline_statistics
+from reporter.exceptions import UnsupportedOsmDocumentException
 from reporter.queries import RESOURCES_MAP
 from reporter import LOGGER
 
+# Summaries of recently parsed documents, see
+# cached_osm_object_contributions_by_tag and cached_osm_object_contributions
+_CONTRIBUTIONS = OrderedDict()
+_CONTRIBUTIONS_GUARD = threading.Lock()
+
+# Suffix of the contribution index stored next to a cached document, see
+# contributions_index_path.
+CONTRIBUTIONS_INDEX_SUFFIX = '.contributions.json.gz'
+
+# Kinds of contribution counts in an index: those of
+# osm_contribution_counts, whose timelines only count the tagged ways, and
+# those of osm_object_counts, whose timelines count everything the users
+# edited.
+TAG_CONTRIBUTIONS = 'tags'
+OBJECT_CONTRIBUTIONS = 'objects'
+
+# Suffix of the snapshots of the ways of an area, see reporter.snapshots.
+CONTRIBUTIONS_SNAPSHOT_SUFFIX = '.ways.json.gz'
+
 
 def overpass_resource_base_path(feature_type):
     """Get the overpass resource base path according to the feature we extract.
@@ -86,6 +125,9 @@ def get_totals(sorted_user_list):
     for user in sorted_user_list:
         way_count += user['ways']
         node_count += user['nodes']
+    if isinstance(sorted_user_list, ContributorList):
+        way_count += sorted_user_list.others['ways']
+        node_count += sorted_user_list.others['nodes']
     return node_count, way_count
 
 
@@ -114,15 +156,151 @@ def split_bbox(bbox):
     return coordinates
 
 
-def osm_object_contributions(osm_file, tag_name):
+def bbox_contains(outer, inner):
+    """Check whether a bounding box lies inside another one.
+
+    :param outer: Coordinates as returned by split_bbox.
+    :type outer: dict
+
+    :param inner: Coordinates as returned by split_bbox.
+    :type inner: dict
+
+    :rtype: bool
+    """
+    south_west = (
+        outer['SW_lat'] <= inner['SW_lat'], outer['SW_lng'] <= inner['SW_lng'])
+    north_east = (
+        outer['NE_lat'] >= inner['NE_lat'], outer['NE_lng'] >= inner['NE_lng'])
+    return all(south_west) and all(north_east)
+
+
+def bbox_area(coordinates):
+    """Get the area of a bounding box.
+
+    :param coordinates: Coordinates as returned by split_bbox.
+    :type coordinates: dict
+
+    :returns: The area in square degrees.
+    :rtype: float
+    """
+    height = coordinates['NE_lat'] - coordinates['SW_lat']
+    width = coordinates['NE_lng'] - coordinates['SW_lng']
+    return height * width
+
+
+def bbox_quarters(coordinates):
+    """Split a bounding box in four equal parts.
+
+    :param coordinates: Coordinates as returned by split_bbox.
+    :type coordinates: dict
+
+    :returns: Coordinates of the four parts, in the same form as split_bbox.
+    :rtype: list
+    """
+    middle_lat = (coordinates['SW_lat'] + coordinates['NE_lat']) / 2
+    middle_lng = (coordinates['SW_lng'] + coordinates['NE_lng']) / 2
+    latitudes = [
+        (coordinates['SW_lat'], middle_lat),
+        (middle_lat, coordinates['NE_lat'])]
+    longitudes = [
+        (coordinates['SW_lng'], middle_lng),
+        (middle_lng, coordinates['NE_lng'])]
+    return [
+        {'SW_lat': south, 'NE_lat': north, 'SW_lng': west, 'NE_lng': east}
+        for south, north in latitudes
+        for west, east in longitudes]
+
+
+def tile_bbox(x, y, zoom):
+    """Get the bounding box of a slippy map tile.
+
+    :param x: Column of the tile.
+    :type x: int
+
+    :param y: Row of the tile, from the north.
+    :type y: int
+
+    :param zoom: Zoom level of the tile.
+    :type zoom: int
+
+    :returns: Coordinates in the same form as split_bbox.
+    :rtype: dict
+    """
+    tile_count = 2 ** zoom
+
+    def latitude(row):
+        return math.degrees(
+            math.atan(math.sinh(math.pi * (1 - 2.0 * row / tile_count))))
+
+    return {
+        'SW_lng': x * 360.0 / tile_count - 180.0,
+        'SW_lat': latitude(y + 1),
+        'NE_lng': (x + 1) * 360.0 / tile_count - 180.0,
+        'NE_lat': latitude(y)
+    }
+
+
+def bbox_tiles(coordinates, zoom):
+    """Get the slippy map tiles covering a bounding box.
+
+    :param coordinates: Coordinates as returned by split_bbox.
+    :type coordinates: dict
+
+    :param zoom: Zoom level of the tiles.
+    :type zoom: int
+
+    :returns: A list of (x, y) tuples.
+    :rtype: list
+    """
+    tile_count = 2 ** zoom
+
+    def column(longitude):
+        x = int((longitude + 180.0) / 360.0 * tile_count)
+        return min(max(x, 0), tile_count - 1)
+
+    def row(latitude):
+        # Web mercator stops at about 85.05 degrees
+        latitude = min(max(latitude, -85.0511), 85.0511)
+        mercator = math.asinh(math.tan(math.radians(latitude)))
+        y = int((1 - mercator / math.pi) / 2.0 * tile_count)
+        return min(max(y, 0), tile_count - 1)
+
+    return [
+        (x, y)
+        for x in range(
+            column(coordinates['SW_lng']), column(coordinates['NE_lng']) + 1)
+        for y in range(
+            row(coordinates['NE_lat']), row(coordinates['SW_lat']) + 1)]
+
+
+def scan_osm_file(osm_file):
+    """Check whether a document should be read by the osm_scanner.
+
+    :param osm_file: A file object reading from an OSM document.
+    :type osm_file: file
+
+    :returns: True if the scanner is the configured backend and can map the
+        document.
+    :rtype: bool
+    """
+    return config.OSM_PARSER_BACKEND == 'scan' and is_scannable(osm_file)
+
+
+def osm_object_contributions(osm_file, tag_name, coordinates=None):
     """Compile a summary of user contributions for the selected osm data type.
 
-    :param osm_file: A file object reading from a .osm file.
+    :param osm_file: A file object reading from a .osm or .pbf file. The
+        timelines of a .pbf file only count the ways having the tag.
     :type osm_file: file, FileIO
 
     :param tag_name: The tag name we want to filter on.
     :type tag_name: str
 
+    :param coordinates: Only count the ways in this bbox, as returned by
+        split_bbox. Only used for .pbf files, which are not limited to a
+        bbox.
+    :type coordinates: dict
+
     :returns: A list of dicts where items in the list are sorted from highest
         contributor (based on number of ways) down to lowest. Each element
         in the list is a dict in the form: {
@@ -142,60 +320,444 @@ def osm_object_contributions(osm_file, tag_name):
             u'2010-12-09': 10,
             u'2012-07-10': 14
         }
-    :rtype: list
+        Only the top config.CONTRIBUTORS_LIMIT users are in the list, the
+        totals of the others are in its others attribute.
+    :rtype: ContributorList
     """
-    parser = OsmParser(tag_name=tag_name)
+    return contribution_records(
+        *osm_object_counts(osm_file, tag_name, coordinates))
+
+
+def osm_object_counts(osm_file, tag_name, coordinates=None):
+    """Count the contributions of each user for the selected osm data type.
+
+    See osm_object_contributions for the parameters.
+
+    :returns: The way count dict, node count dict and timelines, the
+        arguments of contribution_records.
+    :rtype: tuple
+    """
+    if is_pbf(getattr(osm_file, 'name', None)):
+        return osm_contribution_counts(
+            osm_file, [tag_name], coordinates)[tag_name]
     try:
-        xml.sax.parse(osm_file, parser)
+        if is_chunkable(osm_file):
+            return chunked_osm_object_counts(osm_file.name, tag_name)
+        if scan_osm_file(osm_file):
+            try:
+                return scan_osm_object_counts(osm_file.name, tag_name)
+            except UnsupportedOsmDocumentException:
+                LOGGER.info('Parsing %s as xml', osm_file.name)
+        if config.OSM_PARSER_BACKEND == 'sax':
+            parser = OsmParser(tag_name=tag_name)
+            xml.sax.parse(osm_file, parser)
+        else:
+            parser = OsmExpatParser(tag_name=tag_name)
+            parser.parse(osm_file)
     except xml.sax.SAXParseException:
         LOGGER.exception('Failed to parse OSM xml.')
         raise
 
-    way_count_dict = parser.wayCountDict
-    node_count_dict = parser.nodeCountDict
-    timelines = parser.userDayCountDict
+    return (
+        parser.wayCountDict,
+        parser.nodeCountDict,
+        parser.userDayCountDict)
+
+
+def osm_contribution_counts(osm_file, tag_names, coordinates=None):
+    """Count the contributions of each user for several tags at once.
+
+    The document is parsed a single time, see OsmMultiTagParser, or
+    pbf_contributions for .pbf files.
+
+    :param osm_file: A file object reading from a .osm or .pbf file.
+    :type osm_file: file, FileIO
+
+    :param tag_names: The tag names we want counts for.
+    :type tag_names: list
+
+    :param coordinates: Only count the ways in this bbox, as returned by
+        split_bbox. Only used for .pbf files.
+    :type coordinates: dict
+
+    :returns: A dict of (way count dict, node count dict, timelines) by tag
+        name, the arguments of contribution_records.
+    :rtype: dict
+    """
+    if is_pbf(getattr(osm_file, 'name', None)):
+        way_count_dicts, node_count_dicts, timelines = pbf_contributions(
+            osm_file.name, tag_names, coordinates)
+    elif is_chunkable(osm_file):
+        try:
+            way_count_dicts, node_count_dicts, timelines = (
+                chunked_osm_contribution_counts(osm_file.name, tag_names))
+        except xml.sax.SAXParseException:
+            LOGGER.exception('Failed to parse OSM xml.')
+            raise
+    else:
+        counts = None
+        if scan_osm_file(osm_file):
+            try:
+                counts = scan_osm_contribution_counts(
+                    osm_file.name, tag_names)
+            except UnsupportedOsmDocumentException:
+                LOGGER.info('Parsing %s as xml', osm_file.name)
+        if counts is None:
+            parser = OsmMultiTagParser(tag_names)
+            try:
+                parser.parse(osm_file)
+            except xml.sax.SAXParseException:
+                LOGGER.exception('Failed to parse OSM xml.')
+                raise
+            counts = (
+                parser.wayCountDicts,
+                parser.nodeCountDicts,
+                parser.userDayCountDicts)
+        way_count_dicts, node_count_dicts, timelines = counts
+    return dict(
+        (tag_name, (
+            way_count_dicts[tag_name],
+            node_count_dicts[tag_name],
+            timelines[tag_name]))
+        for tag_name in tag_names)
+
+
+def osm_object_contributions_by_tag(osm_file, tag_names, coordinates=None):
+    """Compile the summaries of user contributions for several tags at once.
+
+    The document is parsed a single time, see osm_contribution_counts.
+
+    :param osm_file: A file object reading from a .osm or .pbf file.
+    :type osm_file: file, FileIO
+
+    :param tag_names: The tag names we want summaries for.
+    :type tag_names: list
+
+    :param coordinates: Only count the ways in this bbox, as returned by
+        split_bbox. Only used for .pbf files.
+    :type coordinates: dict
+
+    :returns: A dict of the lists returned by osm_object_contributions, by
+        tag name.
+    :rtype: dict
+    """
+    counts = osm_contribution_counts(osm_file, tag_names, coordinates)
+    return dict(
+        (tag_name, contribution_records(*counts[tag_name]))
+        for tag_name in tag_names)
+
+
+def cached_osm_object_contributions(osm_file, tag_name, coordinates=None):
+    """Like osm_object_contributions, reusing previous summaries.
+
+    The summaries are kept in memory and on disk as described in
+    cached_osm_object_contributions_by_tag, apart from its counts, which
+    are made differently.
+
+    :param osm_file: A file object reading from a cached .osm file.
+    :type osm_file: file, FileIO
+
+    :param tag_name: The tag name we want to filter on.
+    :type tag_name: str
+
+    :param coordinates: Only count the ways in this bbox, as returned by
+        split_bbox. Only used for .pbf files.
+    :type coordinates: dict
 
-    # Convert to a list of dicts so we can sort it.
+    :returns: The list returned by osm_object_contributions.
+    :rtype: ContributorList
+    """
+    return _cached_contributions(
+        osm_file,
+        [tag_name],
+        coordinates,
+        OBJECT_CONTRIBUTIONS,
+        lambda missing: dict(
+            (name, osm_object_counts(osm_file, name, coordinates))
+            for name in missing))[tag_name]
+
+
+def cached_osm_object_contributions_by_tag(
+        osm_file, tag_names, coordinates=None):
+    """Like osm_object_contributions_by_tag, reusing previous summaries.
+
+    Summaries are kept in memory for the config.CONTRIBUTIONS_CACHE_SIZE
+    most recently used documents, so switching between tags does not parse
+    the document again. The counts of the documents in config.CACHE_DIR
+    are also stored on disk next to them (see contributions_index_path),
+    so other processes and restarts skip the parsing too. A document that
+    changed on disk is parsed again.
+
+    :param osm_file: A file object reading from a cached .osm file.
+    :type osm_file: file, FileIO
+
+    :param tag_names: The tag names we want summaries for.
+    :type tag_names: list
+
+    :param coordinates: Only count the ways in this bbox, as returned by
+        split_bbox. Only used for .pbf files.
+    :type coordinates: dict
+
+    :returns: A dict of the lists returned by osm_object_contributions, by
+        tag name.
+    :rtype: dict
+    """
+    return _cached_contributions(
+        osm_file,
+        tag_names,
+        coordinates,
+        TAG_CONTRIBUTIONS,
+        lambda missing: osm_contribution_counts(
+            osm_file, missing, coordinates))
+
+
+def _cached_contributions(osm_file, tag_names, coordinates, kind, count):
+    """Get the summaries of a document from the caches, or count them.
+
+    :param kind: How the counts are made, TAG_CONTRIBUTIONS or
+        OBJECT_CONTRIBUTIONS, they are cached separately.
+    :type kind: str
+
+    :param count: Counts the contributions for a list of tag names, and
+        returns them by tag name.
+    :type count: callable
+
+    :returns: A dict of the lists returned by osm_object_contributions, by
+        tag name.
+    :rtype: dict
+    """
+    stat = os.stat(osm_file.name)
+    fingerprint = (stat.st_mtime_ns, stat.st_size)
+    key = (osm_file.name,) + fingerprint + (kind, tuple(tag_names))
+    if is_pbf(getattr(osm_file, 'name', None)) and coordinates is not None:
+        key += tuple(sorted(coordinates.items()))
+    with _CONTRIBUTIONS_GUARD:
+        if key in _CONTRIBUTIONS:
+            _CONTRIBUTIONS.move_to_end(key)
+            return _CONTRIBUTIONS[key]
+
+    indexed = has_contributions_index(osm_file.name)
+    counts = {}
+    if indexed:
+        counts = load_contributions_index(osm_file.name, fingerprint, kind)
+    missing = [tag_name for tag_name in tag_names if tag_name not in counts]
+    if missing:
+        counts.update(count(missing))
+        if indexed:
+            store_contributions_index(
+                osm_file.name, fingerprint, counts, kind)
+    reports = dict(
+        (tag_name, contribution_records(*counts[tag_name]))
+        for tag_name in tag_names)
+
+    with _CONTRIBUTIONS_GUARD:
+        _CONTRIBUTIONS[key] = reports
+        while len(_CONTRIBUTIONS) > config.CONTRIBUTIONS_CACHE_SIZE:
+            _CONTRIBUTIONS.popitem(last=False)
+    return reports
+
+
+def contributions_index_path(file_path):
+    """Get the path of the contribution index of a cached document.
+
+    :param file_path: Path of the cached OSM document.
+    :type file_path: str
+
+    :returns: The path of the index, next to the document.
+    :rtype: str
+    """
+    return file_path + CONTRIBUTIONS_INDEX_SUFFIX
+
+
+def has_contributions_index(file_path):
+    """Check whether the contributions of a document are stored on disk.
+
+    Only the xml documents in config.CACHE_DIR are indexed, the cache
+    removes their index with them.
+
+    :param file_path: Path of the OSM document.
+    :type file_path: str
+
+    :rtype: bool
+    """
+    if not config.CONTRIBUTIONS_INDEX or is_pbf(file_path):
+        return False
+    directory = os.path.dirname(os.path.abspath(file_path))
+    return directory == os.path.abspath(config.CACHE_DIR)
+
+
+def load_contributions_index(
+        file_path, fingerprint, kind=TAG_CONTRIBUTIONS):
+    """Read the contribution counts stored for a document.
+
+    :param file_path: Path of the OSM document.
+    :type file_path: str
+
+    :param fingerprint: The modification time in nanoseconds and the size
+        of the document, the index is ignored if they changed since it was
+        written.
+    :type fingerprint: tuple
+
+    :param kind: How the counts were made, TAG_CONTRIBUTIONS or
+        OBJECT_CONTRIBUTIONS.
+    :type kind: str
+
+    :returns: The counts by tag name as returned by osm_contribution_counts,
+        empty if there is no up to date index.
+    :rtype: dict
+    """
+    return _read_contributions_index(file_path, fingerprint).get(kind, {})
+
+
+def store_contributions_index(
+        file_path, fingerprint, counts, kind=TAG_CONTRIBUTIONS):
+    """Write the contribution counts of a document next to it.
+
+    The counts of the other kind stay in the index.
+
+    :param file_path: Path of the OSM document.
+    :type file_path: str
+
+    :param fingerprint: The modification time in nanoseconds and the size
+        of the document the counts come from.
+    :type fingerprint: tuple
+
+    :param counts: The counts by tag name as returned by
+        osm_contribution_counts.
+    :type counts: dict
+
+    :param kind: How the counts were made, TAG_CONTRIBUTIONS or
+        OBJECT_CONTRIBUTIONS.
+    :type kind: str
+    """
+    # reporter.cache imports this module
+    from reporter.cache import atomic_file
+    content = _read_contributions_index(file_path, fingerprint)
+    content['source'] = list(fingerprint)
+    content[kind] = counts
+    content = json.dumps(
+        content,
+        separators=(',', ':'),
+        # Timelines are mappings
+        default=dict)
+    try:
+        with atomic_file(contributions_index_path(file_path)) as index:
+            with gzip.GzipFile(fileobj=index, mode='wb') as output:
+                output.write(content.encode('utf-8'))
+    except OSError:
+        # Only a cache, the counts are computed again next time.
+        LOGGER.exception('Failed to store the index of %s', file_path)
+
+
+def _read_contributions_index(file_path, fingerprint):
+    """Read the index of a document, empty if it is missing or outdated."""
+    try:
+        with gzip.open(contributions_index_path(file_path), 'rb') as index:
+            content = json.loads(index.read().decode('utf-8'))
+    except FileNotFoundError:
+        return {}
+    except (OSError, EOFError, ValueError):
+        LOGGER.warning('Ignoring the unreadable index of %s', file_path)
+        return {}
+    if content.get('source') != list(fingerprint):
+        return {}
+    return content
+
+
+class ContributorList(list):
+    """Records of the top contributors, with the totals of the others.
+
+    The others attribute holds the number of users, ways and nodes of the
+    contributors without a record, under the keys 'users', 'ways' and
+    'nodes'.
+    """
+
+    def __init__(self, records=(), others=None):
+        """Constructor.
+
+        :param records: The records of the top contributors, sorted.
+        :type records: list
+
+        :param others: The totals of the other contributors, none by
+            default.
+        :type others: dict
+        """
+        super(ContributorList, self).__init__(records)
+        self.others = others or {'users': 0, 'ways': 0, 'nodes': 0}
+
+
+def rank_contributors(way_count_dict, node_count_dict, limit=0):
+    """Rank users by number of ways, then nodes, then name.
+
+    :param way_count_dict: Number of ways by user.
+    :type way_count_dict: dict
+
+    :param node_count_dict: Number of nodes of these ways by user.
+    :type node_count_dict: dict
+
+    :param limit: Number of top users to rank, 0 for all the users.
+    :type limit: int
+
+    :returns: The top users, sorted, and the totals of the other users as
+        in ContributorList.others.
+    :rtype: (list, dict)
+    """
+    def key(user):
+        return -way_count_dict[user], node_count_dict[user], user
+
+    if not limit or limit >= len(way_count_dict):
+        return sorted(way_count_dict, key=key), None
+    # Only the top users are sorted
+    users = heapq.nsmallest(limit, way_count_dict, key=key)
+    others = {
+        'users': len(way_count_dict) - len(users),
+        'ways': sum(way_count_dict.values()),
+        'nodes': sum(node_count_dict[user] for user in way_count_dict)}
+    for user in users:
+        others['ways'] -= way_count_dict[user]
+        others['nodes'] -= node_count_dict[user]
+    return users, others
+
+
+def contribution_records(way_count_dict, node_count_dict, timelines):
+    """Build the sorted summary of user contributions from parsed counts.
+
+    Only the top config.CONTRIBUTORS_LIMIT contributors get a record, the
+    others are totalled, see ContributorList.
+
+    :param way_count_dict: Number of ways by user.
+    :type way_count_dict: dict
+
+    :param node_count_dict: Number of nodes of these ways by user.
+    :type node_count_dict: dict
+
+    :param timelines: Number of ways by day ('YYYY-MM-DD'), by user.
+    :type timelines: dict
+
+    :returns: The list described in osm_object_contributions.
+    :rtype: ContributorList
+    """
     crew_list = config.CREW
-    user_list = []
+    users, others = rank_contributors(
+        way_count_dict, node_count_dict, config.CONTRIBUTORS_LIMIT)
+    statistics = timeline_statistics(
+        dict((key, timelines[key]) for key in users))
+    sorted_user_list = ContributorList(others=others)
 
-    for key, value in way_count_dict.items():
+    for key in users:
         crew_flag = False
         if key in crew_list:
             crew_flag = True
-        start_date, end_date = date_range(timelines[key])
-        start_date = time.strftime('%d-%m-%Y', start_date.timetuple())
-        end_date = time.strftime('%d-%m-%Y', end_date.timetuple())
-        user_timeline = timelines[key]
-        record = {
+        record = statistics[key]
+        record.update({
             'name': key,
-            'ways': value,
+            'ways': way_count_dict[key],
             'nodes': node_count_dict[key],
-            'timeline': interpolated_timeline(user_timeline),
-            'start': start_date,
-            'end': end_date,
-            'activeDays': len(user_timeline),
-            'best': best_active_day(user_timeline),
-            'worst': worst_active_day(user_timeline),
-            'average': average_for_active_days(user_timeline),
+            'start': record['start'].strftime('%d-%m-%Y'),
+            'end': record['end'].strftime('%d-%m-%Y'),
             'crew': crew_flag
-        }
-        user_list.append(record)
-
-    # Sort it
-    sorted_user_list = sorted(
-        user_list, key=lambda d: (
-            -d['ways'],
-            d['nodes'],
-            d['name'],
-            d['timeline'],
-            d['start'],
-            d['end'],
-            d['activeDays'],
-            d['best'],
-            d['worst'],
-            d['average'],
-            d['crew']))
+        })
+        sorted_user_list.append(record)
     return sorted_user_list
 
 
@@ -203,12 +765,13 @@ def date_range(timeline):
     """Given a timeline, determine the start and end dates.
 
     The timeline may be sparse (containing fewer entries than all the dates
-    between the min and max dates) and since it is a dict,
+    between the min and max dates) and if it is a dict,
     the dates may be in any order.
 
-    :param timeline: A dictionary of non-sequential dates (in YYYY-MM-DD) as
-    keys and values (representing ways collected on that day).
-    :type timeline: dict
+    :param timeline: A Timeline, or a dictionary of non-sequential dates (in
+        YYYY-MM-DD) as keys and values (representing ways collected on that
+        day).
+    :type timeline: Timeline, dict
 
     :returns: A tuple containing two dates:
         * start_date - a date object representing the earliest date in the
@@ -218,84 +781,53 @@ def date_range(timeline):
     :rtype: (date, date)
 
     """
-    start_date = None
-    end_date = None
-    for next_date in timeline.keys():
-        year, month, day = next_date.split('-')
-        message = 'Date: %s' % next_date
-        LOGGER.info(message)
-        timeline_date = date(int(year), int(month), int(day))
-        if start_date is None:
-            start_date = timeline_date
-        if end_date is None:
-            end_date = timeline_date
-        if timeline_date < start_date:
-            start_date = timeline_date
-        if timeline_date > end_date:
-            end_date = timeline_date
-    return start_date, end_date
+    timeline = as_timeline(timeline)
+    return timeline.start(), timeline.end()
 
 
 def average_for_active_days(timeline):
     """Compute the average activity per active day in a sparse timeline.
 
-    :param timeline: A dictionary of non-sequential dates (in YYYY-MM-DD) as
-        keys and values (representing ways collected on that day).
-    :type timeline: dict
+    :param timeline: A Timeline, or a dictionary of non-sequential dates (in
+        YYYY-MM-DD) as keys and values (representing ways collected on that
+        day).
+    :type timeline: Timeline, dict
 
     :returns: Number of entities captured per day rounded to the nearest int.
     :rtype: int
     """
-    count = 0
-    total = 0
-    for value in list(timeline.values()):
-        if value > 0:
-            count += 1
-            total += value
-    # Python 3 seems to automagically turn integer maths into float if needed
-    average = int(total / count)
-    return average
+    return as_timeline(timeline).average()
 
 
 def best_active_day(timeline):
     """Compute the best activity for a single active day in a sparse timeline.
 
-    :param timeline: A dictionary of non-sequential dates (in YYYY-MM-DD) as
-        keys and values (representing ways collected on that day).
-    :type timeline: dict
+    :param timeline: A Timeline, or a dictionary of non-sequential dates (in
+        YYYY-MM-DD) as keys and values (representing ways collected on that
+        day).
+    :type timeline: Timeline, dict
 
     :returns: Number of entities captured for the user's best day.
     :rtype: int
     """
-    best = 0
-    for value in list(timeline.values()):
-        if value > best:
-            best = value
-    return best
+    return as_timeline(timeline).best()
 
 
 def worst_active_day(timeline):
     """Compute the worst activity for a single active day in a sparse timeline.
 
-    :param timeline: A dictionary of non-sequential dates (in YYYY-MM-DD) as
-        keys and values (representing ways collected on that day).
-    :type timeline: dict
+    :param timeline: A Timeline, or a dictionary of non-sequential dates (in
+        YYYY-MM-DD) as keys and values (representing ways collected on that
+        day).
+    :type timeline: Timeline, dict
 
     :returns: Number of entities captured for the user's worst day.
     :rtype: int
     """
-    if len(timeline) < 1:
-        return 0
-    worst = list(timeline.values())[0]
-    for value in list(timeline.values()):
-        if value == 0:  # should never be but just in case
-            continue
-        if value < worst:
-            worst = value
-    return worst
+    return as_timeline(timeline).worst()
 
 
-def interpolated_timeline(timeline):
+def interpolated_timeline(timeline, serialise=True):
     """Interpolate a timeline given a sparse timeline.
 
     A sparse timelines is a sequence of dates containing no days of zero
@@ -303,14 +835,19 @@ def interpolated_timeline(timeline):
     an entry per day in the date range regardless of whether there was any
     activity or not.
 
-    :param timeline: A dictionary of non-sequential dates (in YYYY-MM-DD) as
-        keys and values (representing ways collected on that day).
-    :type timeline: dict
+    :param timeline: A Timeline, or a dictionary of non-sequential dates (in
+        YYYY-MM-DD) as keys and values (representing ways collected on that
+        day).
+    :type timeline: Timeline, dict
+
+    :param serialise: Whether the list is returned as json, as shown in the
+        reports. See timeline_statistics for the timelines of several users.
+    :type serialise: bool
 
     :returns:  An interpolated list where each date in the original input
         date is present, and all days where no total was provided are added
         to include that day.
-    :rtype: list
+    :rtype: str, list
 
     Given an input looking like this::
 
@@ -323,28 +860,15 @@ def interpolated_timeline(timeline):
     The returned list will be in the form::
 
         [
-            [Date(2012,09,21), 10],
-            [Date(2012,09,22), 0],
-            [Date(2012,09,23), 0],
-            [Date(2012,09,24), 1],
-            [Date(2012,09,25), 5],
+            ['2012-09-21', 10],
+            ['2012-09-22', 0],
+            ['2012-09-23', 0],
+            ['2012-09-24', 1],
+            ['2012-09-25', 5],
         ]
     """
-    # Work out the earliest and latest day
-    start_date, end_date = date_range(timeline)
-    # Loop through them, adding an entry for each day
-    time_line = '['
-    for current_date in date_range_iterator(start_date, end_date):
-        date_string = time.strftime('%Y-%m-%d', current_date.timetuple())
-        if date_string in timeline:
-            value = timeline[date_string]
-        else:
-            value = 0
-        if time_line != '[':
-            time_line += ','
-        time_line += '["%s",%i]' % (date_string, value)
-    time_line += ']'
-    return time_line
+    statistics = timeline_statistics({None: timeline}, serialise)
+    return statistics[None]['timeline']
 
 
 def date_range_iterator(start_date, end_date):
@@ -363,23 +887,55 @@ def date_range_iterator(start_date, end_date):
         yield start_date + timedelta(n)
 
 
-def osm_nodes_by_user(file_handle, username):
+def osm_nodes_by_user(file_handle, username, coordinates=None):
     """Obtain the nodes collected by a single user from an OSM file.
 
-    :param file_handle: File handle to an open OSM XML document.
+    :param file_handle: File handle to an open OSM XML or PBF document.
     :type file_handle: file
 
     :param username: Name of the user for whom nodes should be collected.
     :type username: str
 
+    :param coordinates: Only get the nodes in this bbox, as returned by
+        split_bbox. Only used for .pbf files.
+    :type coordinates: dict
+
     :returns: A list of nodes for the given user.
     :rtype: list
     """
+    if is_pbf(getattr(file_handle, 'name', None)):
+        return pbf_nodes_by_user(file_handle.name, username, coordinates)
+    if scan_osm_file(file_handle):
+        try:
+            return scan_nodes_by_user(file_handle.name, username)
+        except UnsupportedOsmDocumentException:
+            LOGGER.info('Parsing %s as xml', file_handle.name)
     parser = OsmNodeParser(username)
     xml.sax.parse(file_handle, parser)
     return parser.nodes
 
 
+def work_dir_root():
+    """Get the directory holding the working directories, see temp_dir.
+
+    It is the osm-reporter subdirectory of OSM_REPORTER_WORK_DIR if this
+    environment variable is set, of the system temp directory otherwise.
+
+    :returns: Path of the directory, which may not exist yet.
+    :rtype: str
+    """
+    if 'OSM_REPORTER_WORK_DIR' in os.environ:
+        new_directory = os.environ['OSM_REPORTER_WORK_DIR']
+    else:
+        # Following 4 lines are a workaround for tempfile.tempdir()
+        # unreliabilty
+        handle, filename = mkstemp()
+        os.close(handle)
+        new_directory = os.path.dirname(filename)
+        os.remove(filename)
+    return os.path.join(new_directory, 'osm-reporter')
+
+
 def temp_dir(sub_dir='work'):
     """Obtain the temporary working directory for the operating system.
 
@@ -409,18 +965,7 @@ def temp_dir(sub_dir='work'):
     user = getpass.getuser().replace(' ', '_')
     current_date = date.today()
     date_string = current_date.isoformat()
-    if 'OSM_REPORTER_WORK_DIR' in os.environ:
-        new_directory = os.environ['OSM_REPORTER_WORK_DIR']
-    else:
-        # Following 4 lines are a workaround for tempfile.tempdir()
-        # unreliabilty
-        handle, filename = mkstemp()
-        os.close(handle)
-        new_directory = os.path.dirname(filename)
-        os.remove(filename)
-
-    path = os.path.join(
-        new_directory, 'osm-reporter', date_string, user, sub_dir)
+    path = os.path.join(work_dir_root(), date_string, user, sub_dir)
 
     if not os.path.exists(path):
         # Ensure that the dir is world writable
@@ -12,28 +12,39 @@ import os
 import optparse
 import datetime
 import xml
-from flask import request, jsonify, render_template, Response, abort
+from flask import (
+    request, jsonify, render_template, Response, abort, url_for)
 # App declared directly in __init__ as per
 # http://flask.pocoo.org/docs/patterns/packages/#larger-applications
 from reporter import app
 from reporter import config
 from reporter.utilities import (
     split_bbox,
-    osm_object_contributions,
+    ContributorList,
+    cached_osm_object_contributions,
+    cached_osm_object_contributions_by_tag,
     get_totals, osm_nodes_by_user)
 from reporter.osm import (
+    DOWNLOAD_CHUNK_SIZE,
     get_osm_file,
     import_and_extract_shapefile)
 from reporter.exceptions import (
+    JobQueueFullException,
     OverpassTimeoutException,
     OverpassBadRequestException,
     OverpassConcurrentRequestException)
+from reporter.jobs import DONE, shapefile_jobs, submit_shapefile_job
 from reporter.queries import FEATURES, TAG_MAPPING
+from reporter.snapshots import snapshot_contributions
 from reporter.static_files import static_file
 from reporter import LOGGER
 # noinspection PyPep8Naming
 from urllib.error import URLError
 
+# When this file exists it is used instead of the Overpass API
+LOCAL_PBF_PATH = abspath(
+    join(dirname(__file__), 'resources', 'pbf', 'data.pbf'))
+
 
 @app.route('/')
 def home():
@@ -42,7 +53,7 @@ def home():
     On this page a map and the report will be shown.
     """
     default_tag = 'highway'
-    sorted_user_list = []
+    sorted_user_list = ContributorList()
     bbox = request.args.get('bbox', config.BBOX)
     tag_name = request.args.get('obj', default_tag)
     date_from = request.args.get('date_from', None)
@@ -58,14 +69,34 @@ def home():
         if tag_name not in list(TAG_MAPPING.keys()):
             error = "Unsupported object type"
             tag_name = default_tag
-        try:
+        if config.CONTRIBUTIONS_ALL_TAGS:
+            # All the tabs are served by the same document
+            feature_type = 'contributions'
+        else:
             feature_type = TAG_MAPPING[tag_name]
-            file_handle = get_osm_file(
-                coordinates,
-                feature_type,
-                'meta',
-                date_from,
-                date_to)
+        invalid_xml_error = (
+            'Invalid OSM xml file retrieved. Please try again later.')
+        date_range = date_from and date_to
+        incremental = all([
+            config.CONTRIBUTIONS_INCREMENTAL,
+            feature_type == 'contributions',
+            not date_range])
+        reports = None
+        try:
+            if exists(LOCAL_PBF_PATH) and not date_range:
+                LOGGER.info('Local PBF file detected, using it for stats.')
+                file_handle = open(LOCAL_PBF_PATH, 'rb')
+            elif incremental:
+                # Kept up to date with Overpass diffs
+                reports = snapshot_contributions(
+                    coordinates, sorted(TAG_MAPPING.keys()))
+            else:
+                file_handle = get_osm_file(
+                    coordinates,
+                    feature_type,
+                    'meta',
+                    date_from,
+                    date_to)
         except OverpassTimeoutException:
             error = 'Timeout, try a smaller area.'
         except OverpassBadRequestException:
@@ -74,16 +105,25 @@ def home():
             error = 'Please try again later, another query is running.'
         except URLError:
             error = 'Bad request.'
+        except xml.sax.SAXParseException:
+            error = invalid_xml_error
         else:
             try:
-                sorted_user_list = osm_object_contributions(
-                    file_handle, tag_name)
+                if reports is not None:
+                    sorted_user_list = reports[tag_name]
+                elif config.CONTRIBUTIONS_ALL_TAGS:
+                    sorted_user_list = cached_osm_object_contributions_by_tag(
+                        file_handle,
+                        sorted(TAG_MAPPING.keys()),
+                        coordinates)[tag_name]
+                else:
+                    sorted_user_list = cached_osm_object_contributions(
+                        file_handle, tag_name, coordinates)
             except xml.sax.SAXParseException:
-                error = (
-                    'Invalid OSM xml file retrieved. Please try again '
-                    'later.')
+                error = invalid_xml_error
 
     node_count, way_count = get_totals(sorted_user_list)
+    other_contributors = sorted_user_list.others
 
     # We need to manually cast float in string, otherwise floats are
     # truncated, and then rounds in Leaflet result in a wrong bbox
@@ -95,7 +135,8 @@ def home():
         sorted_user_list=sorted_user_list,
         way_count=way_count,
         node_count=node_count,
-        user_count=len(sorted_user_list),
+        user_count=len(sorted_user_list) + other_contributors['users'],
+        other_contributors=other_contributors,
         bbox=bbox,
         current_tag_name=tag_name,
         download_url=download_url,
@@ -121,17 +162,8 @@ def download_feature(feature_type):
         abort(404)
 
     bbox = request.args.get('bbox', config.BBOX)
-    # Get the QGIS version
-    # Currently 1, 2 are accepted, default to 2
-    # A different qml style file will be returned depending on the version
-    qgis_version = int(request.args.get('qgis_version', '2'))
-    # Optional parameter that allows the user to specify the filename.
-    output_prefix = request.args.get('output_prefix', feature_type)
-    # A different keywords file will be returned depending on the version.
-    inasafe_version = request.args.get('inasafe_version', None)
-    # Optional parameter that allows the user to specify the language for
-    # the legend in QGIS.
-    lang = request.args.get('lang', 'en')
+    qgis_version, output_prefix, inasafe_version, lang = shapefile_options(
+        feature_type)
 
     # error = None
     try:
@@ -141,9 +173,7 @@ def download_feature(feature_type):
         # coordinates = split_bbox(config.BBOX)
         abort(500)
     else:
-        local_osm_file = abspath(
-            join(dirname(__file__), 'resources', 'pbf', 'data.pbf'))
-        if not exists(local_osm_file):
+        if not exists(LOCAL_PBF_PATH):
             LOGGER.info('Going to download data from overpass.')
             try:
                 file_handle = get_osm_file(coordinates, feature_type, 'body')
@@ -158,8 +188,175 @@ def download_feature(feature_type):
         else:
             LOGGER.info(
                 'Local PBF file detected. We will not use the Overpass API.')
-            file_handle = open(local_osm_file, 'rb')
+            file_handle = open(LOCAL_PBF_PATH, 'rb')
+
+    log_download(feature_type, qgis_version, inasafe_version, coordinates)
+
+    try:
+        # noinspection PyUnboundLocalVariable
+        zip_file = import_and_extract_shapefile(
+            feature_type,
+            file_handle.name,
+            qgis_version,
+            output_prefix,
+            inasafe_version,
+            lang)
+
+        f = open(zip_file, 'rb')
+    except IOError:
+        abort(404)
+        return
+    return Response(f.read(), mimetype='application/zip')
+
+
+@app.route('/<feature_type>-shp/jobs', methods=['POST'])
+def submit_feature_job(feature_type):
+    """Submit a download of OSM data, run in the background.
+
+    It takes the parameters of download_feature.
+
+    :param feature_type The feature to extract.
+    :type feature_type str
 
+    :return A json doc with the id of the job and the urls of its status
+        and of its result, see job_status and job_result.
+    """
+    if feature_type not in FEATURES:
+        abort(404)
+
+    values = request.values
+    bbox = values.get('bbox', config.BBOX)
+    qgis_version, output_prefix, inasafe_version, lang = shapefile_options(
+        feature_type, values)
+    try:
+        coordinates = split_bbox(bbox)
+    except ValueError:
+        abort(400)
+        return
+    source_path = LOCAL_PBF_PATH if exists(LOCAL_PBF_PATH) else None
+
+    log_download(feature_type, qgis_version, inasafe_version, coordinates)
+    try:
+        job = submit_shapefile_job(
+            feature_type,
+            coordinates,
+            qgis_version,
+            output_prefix,
+            inasafe_version,
+            lang,
+            source_path)
+    except JobQueueFullException:
+        abort(503)
+        return
+    status_url = url_for('job_status', job_id=job.id)
+    response = jsonify(
+        id=job.id,
+        status_url=status_url,
+        result_url=url_for('job_result', job_id=job.id))
+    response.status_code = 202
+    response.headers['Location'] = status_url
+    return response
+
+
+@app.route('/jobs/<job_id>')
+def job_status(job_id):
+    """Get the status of a download job as a json doc.
+
+    :param job_id The id of the job.
+    :type job_id str
+
+    :return The state of the job and of each of its stages.
+    """
+    job = shapefile_jobs().get(job_id)
+    if job is None:
+        abort(404)
+    return jsonify(job.status())
+
+
+@app.route('/jobs/<job_id>/result')
+def job_result(job_id):
+    """Stream the zip of a finished download job.
+
+    :param job_id The id of the job.
+    :type job_id str
+
+    :return The zip file, or the status of the job with a 409 while it is
+        running or if it failed.
+    """
+    job = shapefile_jobs().get(job_id)
+    if job is None:
+        abort(404)
+    state, zip_path = job.outcome()
+    if state != DONE:
+        response = jsonify(job.status())
+        response.status_code = 409
+        return response
+    try:
+        zip_file = open(zip_path, 'rb')
+    except IOError:
+        # Evicted from the export cache meanwhile
+        abort(404)
+        return
+
+    def stream():
+        with zip_file:
+            for chunk in iter(
+                    lambda: zip_file.read(DOWNLOAD_CHUNK_SIZE), b''):
+                yield chunk
+
+    response = Response(stream(), mimetype='application/zip')
+    response.headers['Content-Length'] = str(
+        os.fstat(zip_file.fileno()).st_size)
+    response.headers['Content-Disposition'] = (
+        'attachment; filename=%s' % job.result_name)
+    return response
+
+
+def shapefile_options(feature_type, values=None):
+    """Get the options of a shapefile download from the request.
+
+    :param feature_type The feature to extract.
+    :type feature_type str
+
+    :param values The parameters of the request, defaults to the query
+        string.
+    :type values dict
+
+    :return The qgis version, output prefix, InaSAFE version and language,
+        see import_and_extract_shapefile.
+    :rtype tuple
+    """
+    if values is None:
+        values = request.args
+    # Get the QGIS version
+    # Currently 1, 2 are accepted, default to 2
+    # A different qml style file will be returned depending on the version
+    qgis_version = int(values.get('qgis_version', '2'))
+    # Optional parameter that allows the user to specify the filename.
+    output_prefix = values.get('output_prefix', feature_type)
+    # A different keywords file will be returned depending on the version.
+    inasafe_version = values.get('inasafe_version', None)
+    # Optional parameter that allows the user to specify the language for
+    # the legend in QGIS.
+    lang = values.get('lang', 'en')
+    return qgis_version, output_prefix, inasafe_version, lang
+
+
+def log_download(feature_type, qgis_version, inasafe_version, coordinates):
+    """Write a download request to a geojson file in config.LOG_DIR.
+
+    :param feature_type The feature to extract.
+    :type feature_type str
+
+    :param qgis_version The QGIS version.
+    :type qgis_version int
+
+    :param inasafe_version The InaSAFE version.
+    :type inasafe_version str
+
+    :param coordinates The bbox, as returned by split_bbox.
+    :type coordinates dict
+    """
     # This is for logging requests so we can see what queries we received
     date_time = datetime.datetime.now()
 
@@ -232,22 +429,6 @@ def download_feature(feature_type):
     log_file.write(log_message)
     log_file.close()
 
-    try:
-        # noinspection PyUnboundLocalVariable
-        zip_file = import_and_extract_shapefile(
-            feature_type,
-            file_handle.name,
-            qgis_version,
-            output_prefix,
-            inasafe_version,
-            lang)
-
-        f = open(zip_file, 'rb')
-    except IOError:
-        abort(404)
-        return
-    return Response(f.read(), mimetype='application/zip')
-
 
 @app.route('/user')
 def user_status():
@@ -272,7 +453,10 @@ def user_status():
         LOGGER.exception(error + str(coordinates))
     else:
         try:
-            file_handle = get_osm_file(coordinates)
+            if exists(LOCAL_PBF_PATH):
+                file_handle = open(LOCAL_PBF_PATH, 'rb')
+            else:
+                file_handle = get_osm_file(coordinates)
         except OverpassTimeoutException:
             error = "Bad request. Maybe the bbox is too big!"
             LOGGER.exception(error + str(coordinates))
@@ -286,7 +470,7 @@ def user_status():
             error = "Bad request."
             LOGGER.exception(error + str(coordinates))
         else:
-            node_data = osm_nodes_by_user(file_handle, username)
+            node_data = osm_nodes_by_user(file_handle, username, coordinates)
             return jsonify(d=node_data)
 
 